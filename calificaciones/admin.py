@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import Usuario, ArchivoCarga, CalificacionTributaria, FactorCalificacion, LogAuditoria
+from django.template.response import TemplateResponse
+from django.urls import path
+from .models import Usuario, ArchivoCarga, CalificacionTributaria, FactorCalificacion, LogAuditoria, TokenApi
 
 @admin.register(Usuario)
 class UsuarioAdmin(UserAdmin):
@@ -52,4 +54,48 @@ class LogAuditoriaAdmin(admin.ModelAdmin):
     list_display = ['accion', 'usuario_responsable', 'fecha_hora', 'ip_origen']
     list_filter = ['accion', 'fecha_hora']
     readonly_fields = ['fecha_hora', 'id_log']
-    search_fields = ['usuario_responsable__nombre', 'detalle']
\ No newline at end of file
+    search_fields = ['usuario_responsable__nombre', 'detalle']
+    list_select_related = ['usuario_responsable']
+    # Evita el COUNT(*) completo de la tabla en cada página (usar /auditoria/ para búsquedas)
+    show_full_result_count = False
+    change_list_template = 'admin/calificaciones/logauditoria/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('archivados/', self.admin_site.admin_view(self.archivados_view), name='calificaciones_logauditoria_archivados'),
+        ] + super().get_urls()
+
+    def archivados_view(self, request):
+        """Logs de un mes del archivo comprimido (ver archivo_auditoria.py), más los que sigan en la tabla"""
+        from .archivo_auditoria import buscar_logs, meses_en_archivo, rango_mes
+
+        meses = meses_en_archivo()
+        mes = None
+        try:
+            mes = (int(request.GET['anio']), int(request.GET['mes']))
+        except (KeyError, ValueError):
+            pass
+        if mes not in meses:
+            mes = meses[-1] if meses else None
+        logs = buscar_logs(*rango_mes(*mes)) if mes else []
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Logs archivados',
+            'meses': meses,
+            'mes': mes,
+            'logs': logs,
+        }
+        return TemplateResponse(request, 'admin/calificaciones/logauditoria/archivados.html', context)
+
+@admin.register(TokenApi)
+class TokenApiAdmin(admin.ModelAdmin):
+    # Los tokens se crean con `manage.py crear_token_api`; aquí solo se consultan y revocan
+    list_display = ['nombre', 'prefijo', 'usuario', 'activo', 'expira', 'ultimo_uso']
+    list_filter = ['activo']
+    readonly_fields = ['id_token', 'prefijo', 'hash_token', 'fecha_creacion', 'ultimo_uso']
+    search_fields = ['nombre', 'prefijo', 'usuario__correo']
+    list_select_related = ['usuario']
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,209 @@
+"""
+Detección estadística de anomalías en los vectores de factores.
+
+Busca errores de digitación que pasan las reglas de reglas.py (columnas
+corridas, porcentajes ingresados en vez de fracciones) comparando cada
+calificación activa con:
+
+- MAD: la mediana y la desviación absoluta mediana de cada factor en su grupo
+  mercado/ejercicio. El puntaje es el mayor z robusto |x - mediana| / (1.4826·MAD)
+  entre sus factores y se marca si supera ANOMALIAS_UMBRAL_MAD. Los grupos o
+  factores con menos de ANOMALIAS_MINIMO_GRUPO valores, y los factores con MAD 0
+  (más de la mitad de los valores iguales), no se evalúan.
+- EJERCICIO_ANTERIOR: la distancia L1 entre su vector y el de la última
+  calificación del mismo mercado e instrumento en el ejercicio anterior; se
+  marca si supera ANOMALIAS_DISTANCIA_MAXIMA.
+
+Todo se calcula con NumPy sobre una matriz_factores recién construida: un
+ordenamiento por grupo y medianas por columna, sin recorrer filas en Python.
+Los resultados se reconcilian con la cola AnomaliaFactor: las pendientes que
+ya no se detectan se borran, las nuevas se agregan y las confirmadas o
+descartadas conservan su estado.
+
+`programar()` lanza la detección en un hilo de fondo al confirmar la
+transacción en curso, para correrla después de cada carga masiva.
+"""
+import logging
+import threading
+import time
+import warnings
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+from . import matriz_factores
+from .matriz_factores import CAMPOS_FACTORES, ESCALA
+from .metricas import registro as metricas
+from .models import AnomaliaFactor
+
+logger = logging.getLogger(__name__)
+
+
+def puntajes_mad(matriz, minimo_grupo):
+    """(z robusto de cada fila, columna de su peor factor, mediana del grupo en esa columna)"""
+    n = len(matriz)
+    puntaje = np.zeros(n)
+    peor = np.zeros(n, dtype=np.int64)
+    mediana_peor = np.full(n, np.nan)
+    if not n:
+        return puntaje, peor, mediana_peor
+
+    x = np.where(matriz.presentes, matriz.valores / ESCALA, np.nan)
+    mercados, _ = pd.factorize(matriz.mercado)
+    _, grupo = np.unique(np.stack([mercados, matriz.ejercicio]), axis=1, return_inverse=True)
+    orden = np.argsort(grupo, kind='stable')
+    limites = np.flatnonzero(np.diff(grupo[orden])) + 1
+    with warnings.catch_warnings():
+        # Columnas sin ningún valor en el grupo: nanmedian avisa y retorna NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for filas in np.split(orden, limites):
+            if len(filas) < minimo_grupo:
+                continue
+            bloque = x[filas]
+            mediana = np.nanmedian(bloque, axis=0)
+            desvio = np.abs(bloque - mediana)
+            escala = 1.4826 * np.nanmedian(desvio, axis=0)
+            evaluables = (np.count_nonzero(~np.isnan(bloque), axis=0) >= minimo_grupo) & (escala > 0)
+            z = np.nan_to_num(desvio / np.where(evaluables, escala, np.inf), nan=0.0)
+            columnas = z.argmax(axis=1)
+            puntaje[filas] = z[np.arange(len(filas)), columnas]
+            peor[filas] = columnas
+            mediana_peor[filas] = mediana[columnas]
+    return puntaje, peor, mediana_peor
+
+
+def distancias_ejercicio_anterior(matriz):
+    """(distancia L1 de cada fila a su ejercicio anterior, posición de la fila comparada o -1)"""
+    claves = pd.DataFrame({'mercado': matriz.mercado, 'instrumento': matriz.instrumento, 'ejercicio': matriz.ejercicio})
+    # La matriz está ordenada por id: la última de cada clave es la calificación más reciente
+    ultimas = claves.reset_index().drop_duplicates(['mercado', 'instrumento', 'ejercicio'], keep='last')
+    ultimas['ejercicio'] += 1
+    anterior = claves.merge(ultimas, on=['mercado', 'instrumento', 'ejercicio'], how='left')['index']
+    anterior = anterior.fillna(-1).to_numpy(dtype=np.int64)
+
+    distancia = np.zeros(len(matriz))
+    con_anterior = anterior >= 0
+    # Enteros en punto fijo (nulos como 0): la diferencia es exacta
+    fijos = np.where(matriz.presentes, matriz.valores, 0)
+    distancia[con_anterior] = np.abs(fijos[con_anterior] - fijos[anterior[con_anterior]]).sum(axis=1) / ESCALA
+    return distancia, anterior
+
+
+def _fijo(entero):
+    return Decimal(int(entero)).scaleb(-8)
+
+
+def _reconciliar(encontradas):
+    """Deja como pendientes exactamente las anomalías `encontradas` ({(id, metodo): (puntaje, detalle)})"""
+    lote = connection.features.max_query_params or 999
+    with transaction.atomic():
+        # Solo la cola pendiente y las ya revisadas de las calificaciones encontradas, no todo el historial
+        pendientes = {
+            (anomalia.id_calificacion_id, anomalia.metodo): anomalia
+            for anomalia in AnomaliaFactor.objects.filter(estado='PENDIENTE')
+        }
+        ids = sorted({id_calificacion for id_calificacion, _ in encontradas})
+        revisadas = set()
+        for inicio in range(0, len(ids), lote):
+            revisadas.update(AnomaliaFactor.objects.filter(
+                id_calificacion_id__in=ids[inicio:inicio + lote],
+            ).exclude(estado='PENDIENTE').values_list('id_calificacion_id', 'metodo'))
+
+        superadas = [a.pk for clave, a in pendientes.items() if clave not in encontradas]
+        for inicio in range(0, len(superadas), lote):
+            AnomaliaFactor.objects.filter(pk__in=superadas[inicio:inicio + lote]).delete()
+
+        vigentes = []
+        for clave, (puntaje, detalle) in encontradas.items():
+            anomalia = pendientes.get(clave)
+            if anomalia is not None:
+                anomalia.puntaje, anomalia.detalle = puntaje, detalle
+                vigentes.append(anomalia)
+        AnomaliaFactor.objects.bulk_update(vigentes, ['puntaje', 'detalle'])
+        # ignore_conflicts: otro proceso (otro worker, el comando) puede haber insertado la misma anomalía
+        AnomaliaFactor.objects.bulk_create([
+            AnomaliaFactor(id_calificacion_id=id_calificacion, metodo=metodo, puntaje=puntaje, detalle=detalle)
+            for (id_calificacion, metodo), (puntaje, detalle) in encontradas.items()
+            if (id_calificacion, metodo) not in pendientes and (id_calificacion, metodo) not in revisadas
+        ], ignore_conflicts=True)
+
+
+def detectar(matriz=None):
+    """Evalúa toda la tabla, actualiza la cola de revisión y retorna un resumen"""
+    inicio = time.perf_counter()
+    if matriz is None:
+        matriz = matriz_factores.construir()
+    umbral = getattr(settings, 'ANOMALIAS_UMBRAL_MAD', 3.5)
+    minimo_grupo = getattr(settings, 'ANOMALIAS_MINIMO_GRUPO', 20)
+    distancia_maxima = getattr(settings, 'ANOMALIAS_DISTANCIA_MAXIMA', 1.0)
+    encontradas = {}
+
+    puntaje, peor, mediana = puntajes_mad(matriz, minimo_grupo)
+    for fila in np.flatnonzero(puntaje > umbral):
+        columna = peor[fila]
+        encontradas[(int(matriz.ids[fila]), 'MAD')] = (float(puntaje[fila]), (
+            f'{CAMPOS_FACTORES[columna]} = {_fijo(matriz.valores[fila, columna])} '
+            f'(mediana en {matriz.mercado[fila]} {matriz.ejercicio[fila]} = {mediana[fila]:.8f}, '
+            f'z robusto {puntaje[fila]:.1f})'
+        ))
+
+    distancia, anterior = distancias_ejercicio_anterior(matriz)
+    for fila in np.flatnonzero(distancia > distancia_maxima):
+        encontradas[(int(matriz.ids[fila]), 'EJERCICIO_ANTERIOR')] = (float(distancia[fila]), (
+            f'Distancia L1 = {distancia[fila]:.8f} a la calificación {matriz.ids[anterior[fila]]} '
+            f'del ejercicio {matriz.ejercicio[fila] - 1}'
+        ))
+
+    _reconciliar(encontradas)
+    segundos = time.perf_counter() - inicio
+    metricas.observar('nuam_anomalias_deteccion_segundos', segundos)
+    metodos = [metodo for _, metodo in encontradas]
+    return {
+        'calificaciones': len(matriz),
+        'mad': metodos.count('MAD'),
+        'ejercicio_anterior': metodos.count('EJERCICIO_ANTERIOR'),
+        'segundos': segundos,
+    }
+
+
+class _Programador:
+    """Un solo hilo de detección por proceso; los pedidos que llegan mientras corre se agrupan en una repetición"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._pendiente = False
+
+    def programar(self):
+        with self._lock:
+            if self._hilo is not None:
+                self._pendiente = True
+                return
+            self._hilo = threading.Thread(target=self._ejecutar, name='detector-anomalias', daemon=True)
+            self._hilo.start()
+
+    def _ejecutar(self):
+        while True:
+            try:
+                detectar()
+            except Exception:
+                logger.exception("Falló la detección de anomalías de factores")
+            with self._lock:
+                if not self._pendiente:
+                    self._hilo = None
+                    break
+                self._pendiente = False
+        # El hilo termina: su conexión no se reutilizará aunque CONN_MAX_AGE sea persistente
+        connections.close_all()
+
+
+programador = _Programador()
+
+
+def programar():
+    """Detecta anomalías en segundo plano cuando se confirme la transacción actual (ANOMALIAS_TRAS_CARGA)"""
+    if getattr(settings, 'ANOMALIAS_TRAS_CARGA', True):
+        transaction.on_commit(programador.programar)
@@ -0,0 +1,199 @@
+"""
+Archivo mensual de LOG_AUDITORIA.
+
+Los meses completos anteriores a AUDITORIA_HORIZONTE_DIAS se mueven a
+`AUDITORIA_ARCHIVO_DIR/auditoria_AAAA_MM.jsonl.gz` (un JSON por línea, meses
+en UTC) y se borran de la tabla en lotes pequeños, cada uno en su propia
+transacción, para no bloquear la tabla. `buscar_logs` combina la tabla y los
+archivos cuando el rango pedido cae en meses archivados.
+"""
+import glob
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import LogAuditoria
+
+CAMPOS_ARCHIVO = [
+    'id_log', 'fecha_hora', 'accion', 'usuario_responsable_id', 'usuario_nombre',
+    'id_calificacion_id', 'detalle', 'ip_origen',
+]
+PATRON_ARCHIVO = re.compile(r'auditoria_(\d{4})_(\d{2})\.jsonl\.gz$')
+ACCIONES = dict(LogAuditoria.ACCION_OPCIONES)
+
+
+class LogArchivado:
+    """Fila leída desde un archivo, con los mismos atributos que LogAuditoria"""
+
+    archivado = True
+
+    def __init__(self, datos):
+        for campo in CAMPOS_ARCHIVO:
+            setattr(self, campo, datos.get(campo))
+        self.fecha_hora = datetime.fromisoformat(self.fecha_hora)
+
+    def get_accion_display(self):
+        return ACCIONES.get(self.accion, self.accion)
+
+
+def _directorio():
+    return str(settings.AUDITORIA_ARCHIVO_DIR)
+
+
+def ruta_mes(anio, mes):
+    return os.path.join(_directorio(), f'auditoria_{anio:04d}_{mes:02d}.jsonl.gz')
+
+
+def _inicio_mes(anio, mes):
+    return datetime(anio, mes, 1, tzinfo=dt_timezone.utc)
+
+
+def _mes_siguiente(anio, mes):
+    return (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+
+
+def rango_mes(anio, mes):
+    """[inicio, fin) en UTC del mes, el mismo rango que guarda su archivo"""
+    return _inicio_mes(anio, mes), _inicio_mes(*_mes_siguiente(anio, mes))
+
+
+def limite_archivado(ahora=None, horizonte_dias=None):
+    """Inicio (UTC) del mes que contiene `ahora - horizonte`: todo lo anterior es archivable"""
+    if horizonte_dias is None:
+        horizonte_dias = settings.AUDITORIA_HORIZONTE_DIAS
+    corte = (ahora or timezone.now()).astimezone(dt_timezone.utc) - timedelta(days=horizonte_dias)
+    return _inicio_mes(corte.year, corte.month)
+
+
+def meses_archivables(limite):
+    """Meses (anio, mes) con filas anteriores a `limite`, del más antiguo al más reciente"""
+    primera = LogAuditoria.objects.filter(fecha_hora__lt=limite).order_by('fecha_hora').values_list('fecha_hora', flat=True).first()
+    if primera is None:
+        return []
+    primera = primera.astimezone(dt_timezone.utc)
+    meses = []
+    anio, mes = primera.year, primera.month
+    while _inicio_mes(anio, mes) < limite:
+        meses.append((anio, mes))
+        anio, mes = _mes_siguiente(anio, mes)
+    return meses
+
+
+def _escribir_lote(ruta, filas):
+    """Agrega un miembro gzip al archivo del mes y lo persiste antes de borrar"""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta, 'ab') as crudo:
+        with gzip.GzipFile(fileobj=crudo, mode='ab') as comprimido:
+            for fila in filas:
+                fila = dict(fila, fecha_hora=fila['fecha_hora'].isoformat())
+                comprimido.write((json.dumps(fila, ensure_ascii=False) + '\n').encode('utf-8'))
+        crudo.flush()
+        os.fsync(crudo.fileno())
+
+
+def archivar_mes(anio, mes, tamano_lote=None):
+    """Mueve las filas del mes al archivo comprimido; retorna cuántas se movieron"""
+    if tamano_lote is None:
+        tamano_lote = settings.AUDITORIA_TAMANO_BORRADO
+    desde = _inicio_mes(anio, mes)
+    hasta = _inicio_mes(*_mes_siguiente(anio, mes))
+    qs = LogAuditoria.objects.filter(fecha_hora__gte=desde, fecha_hora__lt=hasta).order_by('id_log')
+    ruta = ruta_mes(anio, mes)
+    movidas = 0
+    while True:
+        filas = list(qs.values(*CAMPOS_ARCHIVO)[:tamano_lote])
+        if not filas:
+            return movidas
+        _escribir_lote(ruta, filas)
+        # Un lote por transacción: el bloqueo dura lo que tarda un DELETE pequeño.
+        # Si el proceso se corta entre escribir y borrar, las filas quedan en la tabla y en
+        # el archivo: leer_archivo, buscar_logs y pagina_logs descartan las copias por id_log
+        with transaction.atomic():
+            LogAuditoria.objects.filter(pk__in=[f['id_log'] for f in filas]).delete()
+        movidas += len(filas)
+
+
+def archivar_auditoria(horizonte_dias=None, tamano_lote=None, ahora=None):
+    """Archiva todos los meses completos fuera del horizonte; retorna {(anio, mes): filas}"""
+    limite = limite_archivado(ahora, horizonte_dias)
+    return {(anio, mes): archivar_mes(anio, mes, tamano_lote) for anio, mes in meses_archivables(limite)}
+
+
+def meses_en_archivo():
+    meses = []
+    for ruta in glob.glob(os.path.join(_directorio(), 'auditoria_*.jsonl.gz')):
+        coincidencia = PATRON_ARCHIVO.search(ruta)
+        if coincidencia:
+            meses.append((int(coincidencia.group(1)), int(coincidencia.group(2))))
+    return sorted(meses)
+
+
+def leer_archivo(desde=None, hasta=None, accion=None, usuario_responsable_id=None, id_calificacion_id=None):
+    """Itera los LogArchivado del rango [desde, hasta) que cumplen los filtros"""
+    vistos = set()
+    for anio, mes in meses_en_archivo():
+        if hasta is not None and _inicio_mes(anio, mes) >= hasta:
+            continue
+        if desde is not None and _inicio_mes(*_mes_siguiente(anio, mes)) <= desde:
+            continue
+        with gzip.open(ruta_mes(anio, mes), 'rt', encoding='utf-8') as f:
+            for linea in f:
+                datos = json.loads(linea)
+                if datos['id_log'] in vistos:
+                    continue
+                if accion is not None and datos['accion'] != accion:
+                    continue
+                if usuario_responsable_id is not None and datos['usuario_responsable_id'] != usuario_responsable_id:
+                    continue
+                if id_calificacion_id is not None and datos['id_calificacion_id'] != id_calificacion_id:
+                    continue
+                log = LogArchivado(datos)
+                if desde is not None and log.fecha_hora < desde:
+                    continue
+                if hasta is not None and log.fecha_hora >= hasta:
+                    continue
+                vistos.add(datos['id_log'])
+                yield log
+
+
+def leer_archivo_recientes(desde=None, hasta=None, **filtros):
+    """Como leer_archivo, pero ordenado por (fecha_hora, id_log) descendente.
+
+    Los meses se leen del más reciente al más antiguo y cada uno se ordena por
+    separado (un archivo no guarda sus filas en orden de fecha): quien deja de
+    iterar no abre los meses anteriores.
+    """
+    for anio, mes in reversed(meses_en_archivo()):
+        inicio, fin = rango_mes(anio, mes)
+        inicio = max(inicio, desde) if desde is not None else inicio
+        fin = min(fin, hasta) if hasta is not None else fin
+        if inicio >= fin:
+            continue
+        yield from sorted(leer_archivo(inicio, fin, **filtros), key=lambda log: (log.fecha_hora, log.id_log), reverse=True)
+
+
+def buscar_logs(desde=None, hasta=None, **filtros):
+    """Logs del rango [desde, hasta) desde la tabla y, si corresponde, desde los archivos.
+
+    Filtros admitidos: accion, usuario_responsable_id, id_calificacion_id.
+    Retorna una lista ordenada por fecha_hora descendente.
+    """
+    qs = LogAuditoria.objects.filter(**{k: v for k, v in filtros.items() if v is not None})
+    if desde is not None:
+        qs = qs.filter(fecha_hora__gte=desde)
+    if hasta is not None:
+        qs = qs.filter(fecha_hora__lt=hasta)
+    resultados = list(qs.order_by('-fecha_hora'))
+
+    meses = meses_en_archivo()
+    if meses and (desde is None or desde < _inicio_mes(*_mes_siguiente(*meses[-1]))):
+        en_tabla = {log.id_log for log in resultados}
+        resultados.extend(log for log in leer_archivo(desde, hasta, **filtros) if log.id_log not in en_tabla)
+        resultados.sort(key=lambda log: log.fecha_hora, reverse=True)
+    return resultados
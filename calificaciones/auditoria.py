@@ -0,0 +1,173 @@
+"""
+Escritura de LogAuditoria fuera del ciclo de la petición.
+
+Los eventos se encolan en memoria y un hilo de fondo los inserta con
+`bulk_create` por lotes (AUDITORIA_TAMANO_LOTE) o cada
+AUDITORIA_INTERVALO_VOLCADO segundos. La cola se vacía al terminar el proceso.
+
+Se escriben de forma síncrona:
+- las acciones críticas (AUDITORIA_ACCIONES_CRITICAS),
+- los eventos registrados dentro de una transacción, para que el log quede
+  en la misma unidad atómica que el cambio que describe,
+- los eventos que no caben en la cola.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .metricas import registro as metricas
+from .models import LogAuditoria
+
+logger = logging.getLogger(__name__)
+
+
+def _insertar(logs):
+    """Inserta un lote; si falla, reintenta fila a fila para no perder el resto"""
+    try:
+        LogAuditoria.objects.bulk_create(logs)
+    except Exception:
+        logger.exception("Fallo bulk_create de %s logs de auditoría, reintentando uno a uno", len(logs))
+        insertados = []
+        for log in logs:
+            try:
+                LogAuditoria.objects.bulk_create([log])
+                insertados.append(log)
+            except Exception:
+                logger.exception("Log de auditoría descartado: %s - %s", log.accion, log.detalle)
+        logs = insertados
+    for log in logs:
+        metricas.incrementar('nuam_auditoria_acciones_total', accion=log.accion)
+    return logs
+
+
+class EscritorAuditoria:
+    """Cola en memoria con un hilo de fondo que vuelca los logs por lotes"""
+
+    def __init__(self):
+        self._cola = queue.Queue(maxsize=getattr(settings, 'AUDITORIA_MAX_COLA', 10000))
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        self._pid = None
+
+    def _asegurar_hilo(self):
+        # Se inicia de forma perezosa y se reinicia tras un fork (workers de gunicorn)
+        if self._hilo is not None and self._hilo.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._ejecutar, name='escritor-auditoria', daemon=True)
+            self._hilo.start()
+
+    def encolar(self, log):
+        """Encola un log; devuelve False si la cola está llena"""
+        self._asegurar_hilo()
+        try:
+            self._cola.put_nowait(log)
+            return True
+        except queue.Full:
+            return False
+
+    def _tomar_lote(self, espera):
+        """Toma hasta AUDITORIA_TAMANO_LOTE logs esperando como máximo `espera` segundos
+        desde el primero, para agrupar los eventos que llegan juntos"""
+        tamano = getattr(settings, 'AUDITORIA_TAMANO_LOTE', 100)
+        lote = []
+        try:
+            lote.append(self._cola.get(timeout=espera) if espera else self._cola.get_nowait())
+        except queue.Empty:
+            return lote
+        limite = time.monotonic() + (espera or 0)
+        while len(lote) < tamano:
+            restante = limite - time.monotonic()
+            try:
+                if restante > 0 and not self._detener.is_set():
+                    lote.append(self._cola.get(timeout=restante))
+                else:
+                    lote.append(self._cola.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def vaciar(self):
+        """Inserta todo lo pendiente en el hilo actual"""
+        total = 0
+        while True:
+            lote = self._tomar_lote(espera=None)
+            if not lote:
+                return total
+            total += len(_insertar(lote))
+
+    def _ejecutar(self):
+        intervalo = getattr(settings, 'AUDITORIA_INTERVALO_VOLCADO', 0.5)
+        while not self._detener.is_set():
+            lote = self._tomar_lote(espera=intervalo)
+            if lote:
+                close_old_connections()
+                _insertar(lote)
+        close_old_connections()
+
+    def detener(self, timeout=5):
+        """Detiene el hilo y vuelca lo que quede en la cola"""
+        self._detener.set()
+        if self._hilo is not None and self._pid == os.getpid():
+            self._hilo.join(timeout)
+        self.vaciar()
+
+    def pendientes(self):
+        return self._cola.qsize()
+
+
+escritor = EscritorAuditoria()
+atexit.register(escritor.detener)
+
+
+def registrar_auditoria(accion, usuario_responsable, critica=None, **campos):
+    """Registra un evento de auditoría.
+
+    `usuario_responsable` puede ser una instancia de Usuario o su id. `campos` son los
+    del modelo LogAuditoria (detalle, id_calificacion, ip_origen...).
+    Retorna la instancia (sin `id_log` si quedó en la cola).
+    """
+    # El nombre del usuario se desnormaliza ahora y fecha_hora toma la hora del evento
+    # (default del modelo), así el volcado posterior es un bulk_create sin consultas extra
+    if isinstance(usuario_responsable, int):
+        campos['usuario_responsable_id'] = usuario_responsable
+    else:
+        campos['usuario_responsable'] = usuario_responsable
+    log = LogAuditoria.objects.preparar([dict(accion=accion, **campos)])[0]
+
+    if critica is None:
+        critica = accion in getattr(settings, 'AUDITORIA_ACCIONES_CRITICAS', ())
+    asincrona = getattr(settings, 'AUDITORIA_ASINCRONA', True)
+
+    if critica or not asincrona or transaction.get_connection().in_atomic_block:
+        # Escritura síncrona: los errores se propagan igual que con objects.create
+        LogAuditoria.objects.bulk_create([log])
+        metricas.incrementar('nuam_auditoria_acciones_total', accion=log.accion)
+    elif not escritor.encolar(log):
+        _insertar([log])
+    return log
+
+
+def registrar_auditoria_lote(usuario_responsable, eventos):
+    """Registra varios eventos del mismo usuario con un solo bulk_create síncrono.
+
+    Pensado para cargas por lotes dentro de la transacción que describen.
+    """
+    logs = LogAuditoria.objects.preparar([
+        dict(evento, usuario_responsable=usuario_responsable) for evento in eventos
+    ])
+    LogAuditoria.objects.bulk_create(logs)
+    for log in logs:
+        metricas.incrementar('nuam_auditoria_acciones_total', accion=log.accion)
+    return logs
@@ -0,0 +1,37 @@
+"""
+Backend de autenticación por correo.
+
+Busca el usuario con Usuario.objects.para_login: una sola consulta, sin
+distinguir mayúsculas y con el estado MFA anotado. Al pasar por
+django.contrib.auth.authenticate se emite user_login_failed y se respeta
+user_can_authenticate; las cuentas bloqueadas no se autentican.
+
+El usuario encontrado, autentique o no, queda en `request.usuario_login`
+para que login_view registre el fallo o informe el bloqueo sin repetir la
+consulta.
+"""
+from django.contrib.auth.backends import ModelBackend
+
+from .models import Usuario
+
+
+class CorreoBackend(ModelBackend):
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(Usuario.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        usuario = Usuario.objects.para_login(username.strip())
+        if request is not None:
+            request.usuario_login = usuario
+        if usuario is None:
+            # Correo inexistente: calcular igual un hash para no revelar qué correos existen
+            Usuario().set_password(password)
+            return None
+        # Una cuenta bloqueada no verifica la contraseña hasta que venza el bloqueo
+        if usuario.is_locked() or not self.user_can_authenticate(usuario):
+            return None
+        if usuario.check_password(password):
+            return usuario
+        return None
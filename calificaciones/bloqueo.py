@@ -0,0 +1,149 @@
+"""
+Contadores de intentos de login fallidos, compartidos por todos los procesos.
+
+Se usan ventanas deslizantes aproximadas (ventana actual + la anterior
+ponderada). Con un cache compartido (memcached, redis, base de datos) los
+contadores viven ahí y `cache.incr` es atómico. LocMemCache es por proceso:
+con varios workers cada uno contaría sus propios fallos y el límite se
+multiplicaría, así que en ese caso (y con DummyCache) los contadores se guardan
+en CONTADOR_FALLOS_LOGIN con incrementos atómicos F('valor') + 1.
+
+Así un ataque de fuerza bruta o de password spraying no escribe en USUARIO:
+solo se persiste `locked_until` al bloquear una cuenta. El limitador de tasa
+(limite_tasa.py) usa los mismos contadores.
+"""
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import CharField, Exists, F, OuterRef, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+
+# Fracción de escrituras en CONTADOR_FALLOS_LOGIN que borran los contadores vencidos
+PROBABILIDAD_PURGA = 0.01
+
+
+def cache_compartido():
+    """True si el cache por defecto es visible desde todos los procesos"""
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+class _ContadoresBD:
+    """Las operaciones de cache que usan los contadores, sobre CONTADOR_FALLOS_LOGIN"""
+
+    def _vigentes(self):
+        from .models import ContadorFallosLogin
+        return ContadorFallosLogin.objects.filter(expira__gt=timezone.now())
+
+    def add(self, clave, valor, timeout):
+        from .models import ContadorFallosLogin
+        ahora = timezone.now()
+        # Las claves incluyen la ventana y no se reutilizan al vencer: purgar de vez en cuando basta
+        if random.random() < PROBABILIDAD_PURGA:
+            ContadorFallosLogin.objects.filter(expira__lte=ahora).delete()
+        ContadorFallosLogin.objects.bulk_create(
+            [ContadorFallosLogin(clave=clave, valor=valor, expira=ahora + timedelta(seconds=timeout))],
+            ignore_conflicts=True,
+        )
+
+    def incr(self, clave):
+        if not self._vigentes().filter(clave=clave).update(valor=F('valor') + 1):
+            raise ValueError(f'La clave {clave} no existe')
+        return self.get(clave, 1)
+
+    def get(self, clave, default=None):
+        valor = self._vigentes().filter(clave=clave).values_list('valor', flat=True).first()
+        return default if valor is None else valor
+
+    def set(self, clave, valor, timeout):
+        from .models import ContadorFallosLogin
+        ContadorFallosLogin.objects.update_or_create(
+            clave=clave, defaults={'valor': valor, 'expira': timezone.now() + timedelta(seconds=timeout)},
+        )
+
+    def delete_many(self, claves):
+        from .models import ContadorFallosLogin
+        ContadorFallosLogin.objects.filter(clave__in=claves).delete()
+
+
+_contadores_bd = _ContadoresBD()
+
+
+def _almacen():
+    return cache if cache_compartido() else _contadores_bd
+
+
+def _claves(clave, ventana, ahora):
+    actual = int(ahora // ventana)
+    return f'{clave}:{actual}', f'{clave}:{actual - 1}', actual * ventana
+
+
+def contar_en_ventana(clave, ventana):
+    """Suma uno al contador `clave` y retorna su valor en la ventana deslizante (aproximado)"""
+    almacen = _almacen()
+    ahora = time.time()
+    k_actual, k_anterior, inicio = _claves(clave, ventana, ahora)
+    almacen.add(k_actual, 0, timeout=ventana * 2)
+    try:
+        actual = almacen.incr(k_actual)
+    except ValueError:
+        # La clave expiró entre add e incr
+        almacen.set(k_actual, 1, timeout=ventana * 2)
+        actual = 1
+    anterior = almacen.get(k_anterior, 0)
+    return actual + anterior * (1 - (ahora - inicio) / ventana)
+
+
+def _limpiar(clave, ventana):
+    k_actual, k_anterior, _ = _claves(clave, ventana, time.time())
+    _almacen().delete_many([k_actual, k_anterior])
+
+
+def _ventana():
+    return getattr(settings, 'LOGIN_VENTANA_SEGUNDOS', 900)
+
+
+def registrar_fallo_cuenta(usuario_id):
+    """Suma un fallo a la cuenta y retorna los intentos en la ventana (entero)"""
+    return int(round(contar_en_ventana(f'login_fallos:cuenta:{usuario_id}', _ventana())))
+
+
+def limpiar_fallos_cuenta(usuario_id):
+    _limpiar(f'login_fallos:cuenta:{usuario_id}', _ventana())
+
+
+def fallos_cuenta_pendientes():
+    """Exists() de contadores vigentes para la cuenta OuterRef('pk').
+
+    None si los contadores viven en el cache compartido: limpiarlos no consulta la base.
+    """
+    if cache_compartido():
+        return None
+    from .models import ContadorFallosLogin
+    prefijo = Concat(Value('login_fallos:cuenta:'), Cast(OuterRef('pk'), CharField()), Value(':'))
+    return Exists(ContadorFallosLogin.objects.filter(clave__startswith=prefijo, expira__gt=timezone.now()))
+
+
+def ip_bloqueada(ip):
+    return bool(ip) and _almacen().get(f'login_ip_bloqueada:{ip}') is not None
+
+
+def registrar_fallo_ip(ip):
+    """Suma un fallo a la IP y la bloquea al superar LOGIN_MAX_INTENTOS_IP.
+
+    Retorna True si la IP quedó bloqueada.
+    """
+    if not ip:
+        return False
+    intentos = contar_en_ventana(f'login_fallos:ip:{ip}', _ventana())
+    if intentos >= getattr(settings, 'LOGIN_MAX_INTENTOS_IP', 20):
+        minutos = getattr(settings, 'LOGIN_MINUTOS_BLOQUEO', 15)
+        _almacen().set(f'login_ip_bloqueada:{ip}', 1, timeout=minutos * 60)
+        _limpiar(f'login_fallos:ip:{ip}', _ventana())
+        return True
+    return False
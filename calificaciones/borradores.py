@@ -0,0 +1,100 @@
+"""
+Borradores del asistente de creación/edición de calificaciones.
+
+Reemplazan las claves de sesión calificacion_paso1, montos_paso2 y
+factores_calculados: cada borrador es una fila de BORRADOR_CALIFICACION por
+(usuario, clave) y cada paso actualiza solo sus columnas, sin escribir la
+sesión. Los valores se guardan como JSON y se reconstruyen según el tipo del
+campo de destino (fechas ISO, Decimal como texto), sin heurísticas sobre el
+contenido. Los borradores vencen a las BORRADOR_HORAS sin actividad.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django import forms
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from .forms import MontosForm
+from .models import BorradorCalificacion, CalificacionTributaria, FactorCalificacion
+
+CREAR = 'crear'
+
+Borrador = namedtuple('Borrador', ['datos_basicos', 'montos', 'factores'])
+
+
+def clave_edicion(id_calificacion):
+    return f'editar:{id_calificacion}'
+
+
+def _codificar(datos):
+    codificados = {}
+    for campo, valor in datos.items():
+        if isinstance(valor, (date, datetime)):
+            valor = valor.isoformat()
+        elif isinstance(valor, Decimal):
+            valor = str(valor)
+        codificados[campo] = valor
+    return codificados
+
+
+def _decodificar(datos, campos):
+    """Reconstruye los tipos a partir de los campos (de modelo o formulario) de destino"""
+    decodificados = {}
+    for nombre, valor in datos.items():
+        campo = campos.get(nombre)
+        if valor is not None:
+            if isinstance(campo, (models.DateTimeField, forms.DateTimeField)):
+                valor = datetime.fromisoformat(valor)
+            elif isinstance(campo, (models.DateField, forms.DateField)):
+                valor = date.fromisoformat(valor)
+            elif isinstance(campo, (models.DecimalField, forms.DecimalField)):
+                valor = Decimal(valor)
+        decodificados[nombre] = valor
+    return decodificados
+
+
+def _campos_modelo(modelo):
+    return {campo.name: campo for campo in modelo._meta.concrete_fields}
+
+
+def _expiracion():
+    return timezone.now() + timedelta(hours=getattr(settings, 'BORRADOR_HORAS', 24))
+
+
+def _vigentes(usuario, clave):
+    return BorradorCalificacion.objects.filter(usuario=usuario, clave=clave, expira__gt=timezone.now())
+
+
+def iniciar(usuario, clave, datos_basicos):
+    """Paso 1: crea el borrador o lo reinicia con nuevos datos básicos"""
+    BorradorCalificacion.objects.filter(expira__lte=timezone.now()).delete()
+    BorradorCalificacion.objects.update_or_create(
+        usuario=usuario, clave=clave,
+        defaults={'datos_basicos': _codificar(datos_basicos), 'montos': {}, 'factores': {}, 'expira': _expiracion()},
+    )
+
+
+def guardar_montos(usuario, clave, montos, factores):
+    """Paso 2: actualiza solo montos y factores. Retorna False si no hay borrador vigente"""
+    return bool(_vigentes(usuario, clave).update(
+        montos=_codificar(montos), factores=_codificar(factores), expira=_expiracion(),
+    ))
+
+
+def obtener(usuario, clave):
+    """Borrador vigente con los tipos reconstruidos, o None"""
+    fila = _vigentes(usuario, clave).values('datos_basicos', 'montos', 'factores').first()
+    if fila is None:
+        return None
+    return Borrador(
+        datos_basicos=_decodificar(fila['datos_basicos'], _campos_modelo(CalificacionTributaria)),
+        montos=_decodificar(fila['montos'], MontosForm.base_fields),
+        factores=_decodificar(fila['factores'], _campos_modelo(FactorCalificacion)),
+    )
+
+
+def descartar(usuario, clave):
+    BorradorCalificacion.objects.filter(usuario=usuario, clave=clave).delete()
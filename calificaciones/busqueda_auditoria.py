@@ -0,0 +1,132 @@
+"""
+Consultas del explorador de auditoría: filtros indexados, búsqueda de texto
+completo sobre `detalle` y paginación por cursor (keyset) sobre
+(fecha_hora, id_log) descendente, sin OFFSET ni COUNT(*).
+
+El índice de texto lo crea la migración 0011. En SQLite son triggers sobre
+LOG_AUDITORIA: si una migración futura reconstruye esa tabla hay que volver
+a crearlos (los triggers se borran junto con la tabla original).
+"""
+import base64
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .archivo_auditoria import leer_archivo_recientes
+from .models import LogAuditoria
+
+TAMANO_PAGINA = 50
+
+
+def _consulta_fts5(texto):
+    """Convierte el texto libre en una consulta FTS5: todos los términos, por prefijo"""
+    terminos = ['"{}"*'.format(t.replace('"', '""')) for t in texto.split()]
+    return ' '.join(terminos)
+
+
+def filtrar_por_texto(qs, texto):
+    texto = (texto or '').strip()
+    if not texto:
+        return qs
+    if connection.vendor == 'sqlite':
+        return qs.filter(id_log__in=RawSQL(
+            'SELECT rowid FROM LOG_AUDITORIA_FTS WHERE LOG_AUDITORIA_FTS MATCH %s', [_consulta_fts5(texto)]
+        ))
+    if connection.vendor == 'postgresql':
+        return qs.filter(id_log__in=RawSQL(
+            'SELECT id_log FROM "LOG_AUDITORIA" WHERE '
+            "to_tsvector('spanish', coalesce(detalle, '')) @@ plainto_tsquery('spanish', %s)", [texto]
+        ))
+    return qs.filter(detalle__icontains=texto)
+
+
+def filtrar_logs(filtros):
+    """QuerySet de LogAuditoria según los datos limpios de FiltroAuditoriaForm"""
+    qs = LogAuditoria.objects.all()
+    if filtros.get('accion'):
+        qs = qs.filter(accion=filtros['accion'])
+    if filtros.get('usuario'):
+        qs = qs.filter(usuario_responsable=filtros['usuario'])
+    if filtros.get('id_calificacion'):
+        qs = qs.filter(id_calificacion_id=filtros['id_calificacion'])
+    if filtros.get('desde'):
+        qs = qs.filter(fecha_hora__gte=filtros['desde'])
+    if filtros.get('hasta'):
+        qs = qs.filter(fecha_hora__lt=filtros['hasta'])
+    return filtrar_por_texto(qs, filtros.get('texto'))
+
+
+def logs_archivados(filtros, cursor=None):
+    """Logs del archivo comprimido que cumplen los mismos filtros (texto por subcadena).
+
+    Salen en el orden de pagina_logs, de a un mes: sin leer los meses posteriores
+    al `cursor` ni, si se deja de iterar, los anteriores a la página.
+    """
+    texto = (filtros.get('texto') or '').strip().lower()
+    usuario = filtros.get('usuario')
+    hasta = filtros.get('hasta')
+    posicion = decodificar_cursor(cursor) if cursor else None
+    if posicion:
+        # El cursor es exclusivo por (fecha_hora, id_log): su propio instante puede tener filas
+        limite = posicion[0] + timedelta(microseconds=1)
+        hasta = min(hasta, limite) if hasta else limite
+    for log in leer_archivo_recientes(
+        desde=filtros.get('desde'),
+        hasta=hasta,
+        accion=filtros.get('accion') or None,
+        usuario_responsable_id=usuario.pk if usuario else None,
+        id_calificacion_id=filtros.get('id_calificacion') or None,
+    ):
+        if texto and not all(t in (log.detalle or '').lower() for t in texto.split()):
+            continue
+        yield log
+
+
+def codificar_cursor(log):
+    crudo = f'{log.fecha_hora.isoformat()}|{log.id_log}'
+    return base64.urlsafe_b64encode(crudo.encode()).decode()
+
+
+def decodificar_cursor(cursor):
+    """Retorna (fecha_hora, id_log) o None si el cursor no es válido"""
+    try:
+        fecha, id_log = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        fecha, id_log = datetime.fromisoformat(fecha), int(id_log)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    # codificar_cursor siempre incluye la zona; una fecha sin ella no se compara con fecha_hora
+    if fecha.tzinfo is None:
+        return None
+    return fecha, id_log
+
+
+def _clave(log):
+    return (log.fecha_hora, log.id_log)
+
+
+def pagina_logs(qs, cursor=None, archivados=None, tamano=TAMANO_PAGINA):
+    """Retorna (logs, cursor_siguiente) ordenados por (fecha_hora, id_log) descendente.
+
+    `archivados` es un iterable opcional de LogArchivado en ese mismo orden (ver
+    logs_archivados) que se mezcla con la tabla; se leen solo los que hacen falta.
+    """
+    posicion = decodificar_cursor(cursor) if cursor else None
+    if posicion:
+        fecha, id_log = posicion
+        qs = qs.filter(Q(fecha_hora__lt=fecha) | Q(fecha_hora=fecha, id_log__lt=id_log))
+    logs = list(qs.order_by('-fecha_hora', '-id_log')[:tamano + 1])
+
+    if archivados is not None:
+        # Un archivado interrumpido deja la fila en la tabla y en el archivo: vale la de la tabla
+        en_tabla = {log.id_log for log in logs}
+        extra = islice((
+            log for log in archivados
+            if (posicion is None or _clave(log) < posicion) and log.id_log not in en_tabla
+        ), tamano + 1)
+        logs = sorted(logs + list(extra), key=_clave, reverse=True)[:tamano + 1]
+
+    siguiente = codificar_cursor(logs[tamano - 1]) if len(logs) > tamano else None
+    return logs[:tamano], siguiente
@@ -0,0 +1,499 @@
+"""
+Creación de calificaciones por lotes desde JSON (API de integración).
+
+La validación trabaja sobre columnas completas con pandas: formatos numéricos
+por expresión regular, decimales como enteros escalados (sin errores de punto
+flotante), opciones con `isin`, las reglas de negocio de reglas.py con
+`validar_columnas` y la clave única contra la base de datos con una sola
+consulta. Los ítems válidos se insertan con bulk_create en una transacción
+y cada ítem recibe su propio resultado; si una clave choca con una inserción
+concurrente, se reintenta fila por fila con un savepoint cada una. Con
+`sobrescribir` las calificaciones existentes se actualizan con bulk_update
+(upsert) en vez de rechazarse; las eliminadas (soft delete) se informan como
+error.
+
+`cargar_ndjson` lee un cuerpo NDJSON línea a línea y lo procesa por lotes de
+NDJSON_TAMANO_LOTE, cada uno en su propia transacción junto con el avance de
+la carga: si un intento falla a mitad del cuerpo, el reintento sigue desde la
+última línea confirmada.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from datetime import date
+from decimal import Decimal
+
+import pandas as pd
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .auditoria import registrar_auditoria_lote
+from .models import ArchivoCarga, CalificacionTributaria, FactorCalificacion
+from .reglas import validar_columnas
+
+CAMPOS_CALIFICACION = [
+    'ejercicio', 'mercado', 'instrumento', 'fecha_pago',
+    'secuencia_evento', 'numero_dividendo', 'descripcion_dividendo',
+    'tipo_sociedad', 'valor_historico', 'acogido_isfut', 'origen',
+]
+CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+CLAVE_UNICA = ['ejercicio', 'mercado', 'instrumento', 'secuencia_evento']
+CAMPOS_ACTUALIZABLES = [campo for campo in CAMPOS_CALIFICACION if campo not in CLAVE_UNICA] + ['fecha_modificacion']
+MAXIMO_ERRORES_DETALLE = 100
+
+OBLIGATORIO = 'Este campo es obligatorio.'
+
+
+def _a_texto(valor):
+    """Normaliza un valor JSON a texto; los números sin notación científica"""
+    if valor is None or isinstance(valor, (dict, list)):
+        return None
+    if isinstance(valor, bool):
+        return 'true' if valor else 'false'
+    if isinstance(valor, float) and valor != valor:
+        return None
+    if isinstance(valor, (int, float, Decimal)):
+        return format(Decimal(str(valor)), 'f')
+    valor = str(valor).strip()
+    return valor or None
+
+
+def _aplanar(item):
+    if not isinstance(item, dict):
+        return dict.fromkeys(CAMPOS_CALIFICACION + CAMPOS_FACTORES)
+    fila = {campo: item.get(campo) for campo in CAMPOS_CALIFICACION}
+    factores = item.get('factores') if isinstance(item.get('factores'), dict) else item
+    fila.update({campo: factores.get(campo) for campo in CAMPOS_FACTORES})
+    return fila
+
+
+def _entero(texto):
+    validos = texto.str.fullmatch(r'-?\d{1,9}', na=False)
+    return pd.to_numeric(texto.where(validos), errors='coerce'), validos
+
+
+def _decimal_escalado(texto, enteros, decimales):
+    """Decimal de `enteros` + `decimales` dígitos como entero en unidades de 10^-decimales"""
+    partes = texto.str.extract(rf'^(-?)(\d{{1,{enteros}}})(?:\.(\d{{1,{decimales}}}))?$')
+    validos = partes[1].notna()
+    fraccion = partes[2].fillna('').str.ljust(decimales, '0').where(validos)
+    magnitud = (pd.to_numeric(partes[1], errors='coerce') * 10 ** decimales
+                + pd.to_numeric(fraccion, errors='coerce'))
+    signo = partes[0].map({'-': -1}).fillna(1)
+    return (magnitud * signo).where(validos), validos
+
+
+class _Errores:
+    def __init__(self, n):
+        self.por_item = [{} for _ in range(n)]
+
+    def marcar(self, mascara, campo, mensaje):
+        for indice in mascara[mascara].index:
+            self.por_item[indice].setdefault(campo, []).append(mensaje)
+
+    def validos(self):
+        return pd.Series([not errores for errores in self.por_item])
+
+
+def validar_lote(items, usuario, sobrescribir=False):
+    """Retorna (DataFrame de texto normalizado, errores por ítem, id existente por ítem)"""
+    df = pd.DataFrame([_aplanar(item) for item in items], columns=CAMPOS_CALIFICACION + CAMPOS_FACTORES, dtype=object)
+    df = df.map(_a_texto).astype(object)
+    df = df.where(df.notna(), None)
+    errores = _Errores(len(df))
+    for indice, item in enumerate(items):
+        if not isinstance(item, dict):
+            errores.por_item[indice]['__all__'] = ['Cada calificación debe ser un objeto JSON.']
+
+    # Corredor solo crea calificaciones de origen Corredor (igual que el asistente)
+    if usuario.rol == 'Corredor':
+        df['origen'] = 'Corredor'
+
+    for campo in ('ejercicio', 'mercado', 'instrumento', 'fecha_pago', 'numero_dividendo', 'origen'):
+        errores.marcar(df[campo].isna(), campo, OBLIGATORIO)
+
+    ejercicio, validos = _entero(df['ejercicio'])
+    errores.marcar(df['ejercicio'].notna() & ~validos, 'ejercicio', 'Introduzca un número entero.')
+    for campo in ('secuencia_evento', 'numero_dividendo'):
+        _, validos = _entero(df[campo])
+        errores.marcar(df[campo].notna() & ~validos, campo, 'Introduzca un número entero.')
+    secuencia, _ = _entero(df['secuencia_evento'])
+
+    for campo, opciones in (('mercado', CalificacionTributaria.MERCADO_OPCIONES),
+                            ('origen', CalificacionTributaria.ORIGEN_OPCIONES),
+                            ('tipo_sociedad', CalificacionTributaria.TIPO_SOCIEDAD_OPCIONES)):
+        errores.marcar(df[campo].notna() & ~df[campo].isin([valor for valor, _ in opciones]),
+                       campo, 'Escoja una opción válida.')
+
+    errores.marcar(df['instrumento'].str.len() > 50, 'instrumento', 'Asegúrese de que tenga como máximo 50 caracteres.')
+    errores.marcar(df['acogido_isfut'].notna() & ~df['acogido_isfut'].isin(['true', 'false']),
+                   'acogido_isfut', 'Debe ser true o false.')
+
+    fechas = pd.to_datetime(df['fecha_pago'].where(df['fecha_pago'].str.fullmatch(r'\d{4}-\d{2}-\d{2}', na=False)),
+                            format='%Y-%m-%d', errors='coerce')
+    errores.marcar(df['fecha_pago'].notna() & fechas.isna(), 'fecha_pago', 'Introduzca una fecha válida (AAAA-MM-DD).')
+
+    _, validos = _decimal_escalado(df['valor_historico'], 13, 2)
+    errores.marcar(df['valor_historico'].notna() & ~validos, 'valor_historico',
+                   'Introduzca un número con hasta 13 enteros y 2 decimales.')
+
+    # Reglas de negocio compartidas (reglas.py) sobre columnas tipadas; factores como enteros
+    # escalados (la suma es exacta mientras quepa en 2^53)
+    tipado = pd.DataFrame({'ejercicio': ejercicio, 'secuencia_evento': secuencia, 'fecha_pago': fechas})
+    for campo in CAMPOS_FACTORES:
+        tipado[campo], validos = _decimal_escalado(df[campo], 1, 8)
+        errores.marcar(df[campo].notna() & ~validos, campo, 'Introduzca un número con hasta 8 decimales.')
+    for regla, mascara in validar_columnas(tipado):
+        errores.marcar(mascara, regla.campo_error, regla.mensaje)
+
+    # Clave única: duplicados dentro del lote y contra la tabla
+    clave = pd.DataFrame({
+        'ejercicio': ejercicio, 'mercado': df['mercado'],
+        'instrumento': df['instrumento'], 'secuencia_evento': secuencia,
+    })
+    completa = clave.notna().all(axis=1) & errores.validos()
+    repetidas = clave[completa].duplicated(keep='first').reindex(clave.index, fill_value=False)
+    errores.marcar(repetidas, '__all__', 'Calificación repetida dentro del lote.')
+    existentes = _existentes(clave, completa & ~repetidas)
+    # Las eliminadas (soft delete) conservan la clave única: ni se actualizan ni se reviven
+    eliminadas = pd.Series([e is not None and not e[2] for e in existentes])
+    errores.marcar(eliminadas, '__all__', 'Existe una calificación eliminada con los mismos datos.')
+    existentes = [e if e is not None and e[2] else None for e in existentes]
+    if not sobrescribir:
+        errores.marcar(pd.Series([e is not None for e in existentes]), '__all__',
+                       'Ya existe una calificación con los mismos datos.')
+    elif usuario.rol == 'Corredor':
+        errores.marcar(pd.Series([e is not None and e[1] != 'Corredor' for e in existentes]), '__all__',
+                       'No tiene permisos para modificar esta calificación.')
+    ids = [e[0] if e is not None else None for e in existentes]
+    return df, errores.por_item, ids
+
+
+def _existentes(clave, filas):
+    """(id, origen, estado) de cada fila de `filas` cuya clave única ya está en CALIFICACION_TRIBUTARIA, o None (una consulta)"""
+    resultado = [None] * len(clave)
+    if not filas.any():
+        return resultado
+    candidatas = clave[filas]
+    existentes = {
+        (ejercicio, mercado, instrumento, secuencia): (pk, origen, estado)
+        for pk, origen, estado, ejercicio, mercado, instrumento, secuencia in CalificacionTributaria.objects.filter(
+            ejercicio__in={int(v) for v in candidatas['ejercicio']},
+            instrumento__in=set(candidatas['instrumento']),
+        ).values_list('pk', 'origen', 'estado', *CLAVE_UNICA)
+    }
+    for indice, (e, m, i, s) in zip(candidatas.index, candidatas.itertuples(index=False)):
+        resultado[indice] = existentes.get((int(e), m, i, int(s)))
+    return resultado
+
+
+def _construir(fila, usuario):
+    """Instancias sin guardar a partir de una fila ya validada"""
+    calificacion = CalificacionTributaria(
+        ejercicio=int(fila['ejercicio']),
+        mercado=fila['mercado'],
+        instrumento=fila['instrumento'],
+        fecha_pago=date.fromisoformat(fila['fecha_pago']),
+        secuencia_evento=int(fila['secuencia_evento']) if fila['secuencia_evento'] else None,
+        numero_dividendo=int(fila['numero_dividendo']),
+        descripcion_dividendo=fila['descripcion_dividendo'],
+        tipo_sociedad=fila['tipo_sociedad'],
+        valor_historico=Decimal(fila['valor_historico']) if fila['valor_historico'] else None,
+        acogido_isfut=fila['acogido_isfut'] == 'true',
+        origen=fila['origen'],
+        usuario_creador=usuario,
+    )
+    factores = {campo: Decimal(fila[campo]) if fila[campo] is not None else None for campo in CAMPOS_FACTORES}
+    return calificacion, factores
+
+
+def crear_lote(items, usuario, ip_origen=None, sobrescribir=False):
+    """Valida e inserta (o con `sobrescribir` actualiza) las calificaciones; retorna un resultado por ítem"""
+    df, errores, ids = validar_lote(items, usuario, sobrescribir)
+    resultados = [
+        {'indice': i, 'estado': 'error', 'errores': e} if e else None
+        for i, e in enumerate(errores)
+    ]
+    validos = [i for i, e in enumerate(errores) if not e]
+    if not validos:
+        return resultados
+
+    nuevos, actualizados = [], []
+    for i, fila in zip(validos, df.iloc[validos].to_dict('records')):
+        calificacion, factores = _construir(fila, usuario)
+        if ids[i] is None:
+            nuevos.append((i, calificacion, factores))
+        else:
+            calificacion.pk = ids[i]
+            actualizados.append((i, calificacion, factores))
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                escritos = _escribir(nuevos, actualizados)
+        except IntegrityError:
+            # Otra petición insertó alguna clave después de la validación: fila por fila, cada una
+            # en su savepoint, para que el conflicto solo haga fallar esa fila
+            escritos = []
+            for fila in nuevos:
+                fila[1].pk = None  # el bulk_create revertido pudo asignarla
+            for filas in [([fila], []) for fila in nuevos] + [([], [fila]) for fila in actualizados]:
+                try:
+                    with transaction.atomic():
+                        escritos += _escribir(*filas)
+                except IntegrityError:
+                    i = (filas[0] or filas[1])[0][0]
+                    resultados[i] = {'indice': i, 'estado': 'error', 'errores': {
+                        '__all__': ['Conflicto con una calificación creada en paralelo; reintente.']}}
+        registrar_auditoria_lote(usuario, [
+            {'accion': 'CREATE', 'id_calificacion': calificacion, 'ip_origen': ip_origen,
+             'detalle': 'Creación de calificación tributaria vía API'}
+            if estado == 'creado' else
+            {'accion': 'UPDATE', 'id_calificacion': calificacion, 'ip_origen': ip_origen,
+             'detalle': 'Actualización de calificación tributaria vía API'}
+            for _, calificacion, estado in escritos
+        ])
+
+    for i, calificacion, estado in escritos:
+        resultados[i] = {'indice': i, 'estado': estado, 'id_calificacion': calificacion.pk}
+    return resultados
+
+
+def _escribir(nuevos, actualizados):
+    """Inserta `nuevos` y actualiza `actualizados`; retorna (índice, calificación, estado) de cada uno"""
+    creadas = _insertar(nuevos)
+    _actualizar(actualizados)
+    return ([(i, calificacion, 'creado') for (i, _, _), calificacion in zip(nuevos, creadas)]
+            + [(i, calificacion, 'actualizado') for i, calificacion, _ in actualizados])
+
+
+def _insertar(nuevos):
+    calificaciones = CalificacionTributaria.objects.bulk_create([c for _, c, _ in nuevos])
+    factores = [
+        FactorCalificacion(id_calificacion=calificacion, **valores)
+        for calificacion, (_, _, valores) in zip(calificaciones, nuevos)
+    ]
+    FactorCalificacion.objects.bulk_create(factores)
+    return calificaciones
+
+
+def _actualizar(actualizados):
+    """bulk_update de calificaciones y factores; crea los factores que falten"""
+    if not actualizados:
+        return
+    ahora = timezone.now()
+    for _, calificacion, _ in actualizados:
+        calificacion.fecha_modificacion = ahora
+    CalificacionTributaria.objects.bulk_update([c for _, c, _ in actualizados], CAMPOS_ACTUALIZABLES)
+
+    id_factores = dict(FactorCalificacion.objects.filter(
+        id_calificacion__in=[c.pk for _, c, _ in actualizados],
+    ).values_list('id_calificacion', 'id_factor'))
+    factores = [
+        FactorCalificacion(id_factor=id_factores.get(calificacion.pk), id_calificacion=calificacion, **valores)
+        for _, calificacion, valores in actualizados
+    ]
+    FactorCalificacion.objects.bulk_update([f for f in factores if f.id_factor], CAMPOS_FACTORES)
+    FactorCalificacion.objects.bulk_create([f for f in factores if not f.id_factor])
+
+
+def _lineas_ndjson(stream, maximo_linea):
+    """Genera (número de línea, ítem o None, error) leyendo `stream` de a una línea"""
+    numero = 0
+    descartando = False
+    while True:
+        linea = stream.readline(maximo_linea + 1)
+        if not linea:
+            return
+        completa = linea.endswith(b'\n')
+        if descartando:
+            # Resto de una línea demasiado larga
+            descartando = not completa
+            continue
+        numero += 1
+        if len(linea) > maximo_linea:
+            descartando = not completa
+            yield numero, None, f'La línea supera {maximo_linea} bytes.'
+            continue
+        if not linea.strip():
+            continue
+        try:
+            yield numero, json.loads(linea, parse_float=Decimal), None
+        except (ValueError, UnicodeDecodeError):
+            yield numero, None, 'JSON inválido.'
+
+
+class LectorConHash:
+    """Envuelve un stream y calcula el SHA-256 de lo leído"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def readline(self, limite=-1):
+        linea = self.stream.readline(limite)
+        self.hash.update(linea)
+        return linea
+
+    def read(self, tamano=-1):
+        datos = self.stream.read(tamano)
+        self.hash.update(datos)
+        return datos
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def hash_cuerpo(stream, tamano_bloque=64 * 1024):
+    """SHA-256 de un stream leído por bloques"""
+    lector = LectorConHash(stream)
+    while lector.read(tamano_bloque):
+        pass
+    return lector.hexdigest()
+
+
+def cargar_ndjson(stream, usuario, ip_origen=None, sobrescribir=False, al_procesar_lote=None, avance=None):
+    """Procesa un cuerpo NDJSON por lotes sin cargarlo completo en memoria.
+
+    Retorna un resumen con los contadores, como máximo MAXIMO_ERRORES_DETALLE
+    errores con su número de línea y el SHA-256 del cuerpo. Cada lote se confirma
+    en su propia transacción junto con `al_procesar_lote(linea, resumen, hash)`,
+    que recibe la última línea del lote y el hash del cuerpo hasta ella (para
+    guardar el avance y renovar la reserva de la carga).
+
+    `avance` (ver avance_archivo) retoma un intento anterior: sus líneas se leen
+    sin procesar y los contadores siguen desde los suyos. Si el cuerpo no
+    coincide con el del intento anterior hasta esa línea, retorna None.
+    """
+    tamano_lote = getattr(settings, 'NDJSON_TAMANO_LOTE', 500)
+    maximo_linea = getattr(settings, 'NDJSON_MAX_LINEA', 1024 * 1024)
+    resumen = {'creados': 0, 'actualizados': 0, 'procesados': 0, 'errores': 0, 'detalle_errores': []}
+    desde = 0
+    if avance is not None:
+        desde = avance['linea']
+        resumen.update(procesados=avance['procesados'], errores=avance['errores'],
+                       detalle_errores=list(avance['detalle_errores']))
+    lector = LectorConHash(stream)
+
+    def error(linea, errores):
+        resumen['errores'] += 1
+        if len(resumen['detalle_errores']) < MAXIMO_ERRORES_DETALLE:
+            resumen['detalle_errores'].append({'linea': linea, 'errores': errores})
+
+    def procesar(lote, hash_hasta):
+        items = [item for _, item, mensaje in lote if not mensaje]
+        with transaction.atomic():
+            resultados = iter(crear_lote(items, usuario, ip_origen, sobrescribir) if items else [])
+            for linea, _, mensaje in lote:
+                resultado = {'estado': 'error', 'errores': {'__all__': [mensaje]}} if mensaje else next(resultados)
+                if resultado['estado'] == 'error':
+                    error(linea, resultado['errores'])
+                else:
+                    resumen['creados' if resultado['estado'] == 'creado' else 'actualizados'] += 1
+                    resumen['procesados'] += 1
+            if al_procesar_lote is not None:
+                al_procesar_lote(lote[-1][0], resumen, hash_hasta.hexdigest())
+
+    # Las líneas inválidas van en el lote con las demás: cada lote confirma todo hasta su última línea
+    lote = []
+    hash_hasta = None
+    retomado = not desde
+    for linea, item, mensaje in _lineas_ndjson(lector, maximo_linea):
+        if linea <= desde:
+            if linea == desde:
+                if lector.hexdigest() != avance['hash']:
+                    return None
+                retomado = True
+            continue
+        lote.append((linea, item, mensaje))
+        hash_hasta = lector.hash.copy()
+        if len(lote) >= tamano_lote:
+            procesar(lote, hash_hasta)
+            lote = []
+    if not retomado:
+        # El cuerpo termina antes de lo ya confirmado
+        return None
+    if lote:
+        procesar(lote, hash_hasta)
+    resumen['hash_cuerpo'] = lector.hexdigest()
+    return resumen
+
+
+def avance_archivo(archivo):
+    """Avance confirmado de una carga interrumpida, para retomarla con cargar_ndjson; None si no hay"""
+    if not archivo.lineas_confirmadas:
+        return None
+    return {
+        'linea': archivo.lineas_confirmadas,
+        'hash': archivo.hash_cuerpo,
+        'procesados': archivo.registros_procesados,
+        'errores': archivo.registros_error,
+        # Sin el error que interrumpió el intento (no tiene línea)
+        'detalle_errores': [e for e in json.loads(archivo.errores_detalle or '[]') if e['linea'] is not None],
+    }
+
+
+def reservar_archivo(usuario, clave_idempotencia, **campos):
+    """Crea el ArchivoCarga PENDIENTE de una carga por API.
+
+    Retorna (archivo, reservado). Si la Idempotency-Key ya se usó, retorna la
+    carga original con reservado=False, salvo que haya terminado en ERROR o
+    siga PENDIENTE con la reserva vencida (el proceso que la tenía murió): en
+    esos casos se vuelve a reservar, conservando el avance confirmado, para que
+    el cliente pueda reintentar.
+    """
+    ahora = timezone.now()
+    try:
+        with transaction.atomic():
+            return ArchivoCarga.objects.create(
+                usuario_carga=usuario, clave_idempotencia=clave_idempotencia, estado_proceso='PENDIENTE',
+                fecha_reserva=ahora, **campos,
+            ), True
+    except IntegrityError:
+        archivo = ArchivoCarga.objects.get(usuario_carga=usuario, clave_idempotencia=clave_idempotencia)
+    vencida = ahora - timedelta(seconds=getattr(settings, 'CARGA_RESERVA_SEGUNDOS', 600))
+    # UPDATE condicional: solo una petición concurrente recupera la carga fallida o abandonada
+    reservado = bool(ArchivoCarga.objects.filter(
+        Q(estado_proceso='ERROR')
+        | Q(estado_proceso='PENDIENTE', fecha_reserva__lt=vencida)
+        | Q(estado_proceso='PENDIENTE', fecha_reserva__isnull=True),
+        pk=archivo.pk,
+    ).update(estado_proceso='PENDIENTE', fecha_reserva=ahora, **campos))
+    if reservado:
+        archivo.refresh_from_db()
+    return archivo, reservado
+
+
+def registrar_avance(archivo, linea, resumen, hash_hasta):
+    """Guarda el avance de la carga (en la transacción del lote) y renueva su reserva"""
+    archivo.lineas_confirmadas = linea
+    archivo.hash_cuerpo = hash_hasta
+    archivo.registros_procesados = resumen['procesados']
+    archivo.registros_error = resumen['errores']
+    archivo.errores_detalle = json.dumps(resumen['detalle_errores'], ensure_ascii=False)
+    ArchivoCarga.objects.filter(pk=archivo.pk, estado_proceso='PENDIENTE').update(
+        fecha_reserva=timezone.now(), lineas_confirmadas=linea, hash_cuerpo=hash_hasta,
+        registros_procesados=archivo.registros_procesados, registros_error=archivo.registros_error,
+        errores_detalle=archivo.errores_detalle,
+    )
+
+
+def finalizar_archivo(archivo, resumen=None, error=None):
+    """Guarda el resultado de la carga en su ArchivoCarga.
+
+    Con `error` se conserva el avance confirmado (ver registrar_avance) y el
+    error se agrega al detalle sin número de línea.
+    """
+    if error is not None:
+        archivo.estado_proceso = 'ERROR'
+        detalle = json.loads(archivo.errores_detalle or '[]')
+        archivo.errores_detalle = json.dumps(detalle + [{'linea': None, 'errores': {'__all__': [error]}}], ensure_ascii=False)
+        archivo.save(update_fields=['estado_proceso', 'errores_detalle'])
+        return
+    archivo.estado_proceso = 'PROCESADO'
+    archivo.hash_cuerpo = resumen['hash_cuerpo']
+    archivo.registros_procesados = resumen['procesados']
+    archivo.registros_error = resumen['errores']
+    archivo.errores_detalle = json.dumps(resumen['detalle_errores'], ensure_ascii=False)
+    archivo.save(update_fields=['estado_proceso', 'registros_procesados', 'registros_error', 'errores_detalle', 'hash_cuerpo'])
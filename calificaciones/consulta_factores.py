@@ -0,0 +1,200 @@
+"""
+Consulta de factores por lotes de claves.
+
+- buscar_factores: por (instrumento, ejercicio[, secuencia_evento]).
+- buscar_vigentes: la calificación aplicable a una fecha (as-of), es decir el
+  último evento con fecha_pago <= fecha por instrumento, resuelto con
+  ROW_NUMBER() sobre el índice (instrumento, fecha_pago DESC, secuencia_evento DESC).
+
+Las claves se envían como una tabla `VALUES` unida a CALIFICACION_TRIBUTARIA y
+FACTOR_CALIFICACION en una sola consulta (en vez de una cadena de OR). Si las
+claves superan el máximo de parámetros del motor (999 en SQLite) se dividen en
+el menor número de consultas posible. Las filas se leen con fetchmany y se
+entregan a medida que llegan, para responder en streaming.
+"""
+from datetime import date
+from decimal import Decimal
+
+from django.db import connection
+
+from .models import CalificacionTributaria, FactorCalificacion
+
+CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+_OCHO_DECIMALES = Decimal('0.00000001')
+
+
+def validar_claves(items):
+    """Lista de (instrumento, ejercicio, secuencia_evento o None), o un mensaje de error"""
+    claves = []
+    for indice, item in enumerate(items):
+        if isinstance(item, (list, tuple)) and 2 <= len(item) <= 3:
+            item = dict(zip(('instrumento', 'ejercicio', 'secuencia_evento'), item))
+        if not isinstance(item, dict):
+            return f'Clave {indice}: se esperaba un objeto o [instrumento, ejercicio, secuencia_evento]'
+        instrumento, ejercicio, secuencia = item.get('instrumento'), item.get('ejercicio'), item.get('secuencia_evento')
+        if not isinstance(instrumento, str) or not 0 < len(instrumento) <= 50:
+            return f'Clave {indice}: instrumento inválido'
+        if isinstance(ejercicio, bool) or not isinstance(ejercicio, int):
+            return f'Clave {indice}: ejercicio debe ser entero'
+        if secuencia is not None and (isinstance(secuencia, bool) or not isinstance(secuencia, int)):
+            return f'Clave {indice}: secuencia_evento debe ser entero'
+        claves.append((instrumento, ejercicio, secuencia))
+    return claves
+
+
+def validar_consultas_vigentes(items):
+    """Lista de (instrumento, fecha ISO), o un mensaje de error"""
+    consultas = []
+    for indice, item in enumerate(items):
+        if isinstance(item, (list, tuple)) and len(item) == 2:
+            item = dict(zip(('instrumento', 'fecha'), item))
+        if not isinstance(item, dict):
+            return f'Consulta {indice}: se esperaba un objeto o [instrumento, fecha]'
+        instrumento, fecha = item.get('instrumento'), item.get('fecha')
+        if not isinstance(instrumento, str) or not 0 < len(instrumento) <= 50:
+            return f'Consulta {indice}: instrumento inválido'
+        try:
+            fecha = date.fromisoformat(fecha).isoformat()
+        except (TypeError, ValueError):
+            return f'Consulta {indice}: fecha debe tener formato AAAA-MM-DD'
+        consultas.append((instrumento, fecha))
+    return consultas
+
+
+def _valores(cantidad, tipos):
+    # Los CAST de la primera fila fijan el tipo de cada columna (PostgreSQL infiere el resto).
+    # SQLite guarda DateField como texto ISO y CAST(... AS DATE) lo volvería numérico
+    if connection.vendor == 'sqlite':
+        tipos = ['TEXT' if tipo == 'DATE' else tipo for tipo in tipos]
+    primera = '(' + ', '.join(f'CAST(%s AS {tipo})' for tipo in tipos) + ')'
+    resto = '(' + ', '.join(['%s'] * len(tipos)) + ')'
+    return ', '.join([primera] + [resto] * (cantidad - 1))
+
+
+def _columnas(alias):
+    q = connection.ops.quote_name
+    return ', '.join(
+        f'{alias}.{q(campo)}' for campo in
+        ('id_calificacion', 'instrumento', 'ejercicio', 'secuencia_evento', 'mercado', 'fecha_pago', 'origen')
+    )
+
+
+def _filtro(alias, solo_corredor):
+    q = connection.ops.quote_name
+    return f"{alias}.{q('estado')} = %s" + (f" AND {alias}.{q('origen')} = %s" if solo_corredor else '')
+
+
+def _join_factores(alias):
+    q = connection.ops.quote_name
+    factor = FactorCalificacion._meta
+    return (f"LEFT JOIN {q(factor.db_table)} f "
+            f"ON f.{q(factor.get_field('id_calificacion').column)} = {alias}.{q('id_calificacion')}")
+
+
+def _factores():
+    q = connection.ops.quote_name
+    return ', '.join(f'f.{q(campo)}' for campo in CAMPOS_FACTORES)
+
+
+def _sql_claves(cantidad, solo_corredor):
+    q = connection.ops.quote_name
+    return f"""
+        WITH claves (indice, instrumento, ejercicio, secuencia) AS (
+            VALUES {_valores(cantidad, ('INTEGER', 'VARCHAR(50)', 'INTEGER', 'INTEGER'))}
+        )
+        SELECT k.indice, {_columnas('c')}, {_factores()}
+        FROM claves k
+        JOIN {q(CalificacionTributaria._meta.db_table)} c
+          ON c.{q('instrumento')} = k.instrumento
+         AND c.{q('ejercicio')} = k.ejercicio
+         AND (k.secuencia IS NULL OR c.{q('secuencia_evento')} = k.secuencia)
+        {_join_factores('c')}
+        WHERE {_filtro('c', solo_corredor)}
+        ORDER BY k.indice, c.{q('id_calificacion')}
+    """
+
+
+def _sql_vigentes(cantidad, solo_corredor):
+    q = connection.ops.quote_name
+    return f"""
+        WITH claves (indice, instrumento, fecha) AS (
+            VALUES {_valores(cantidad, ('INTEGER', 'VARCHAR(50)', 'DATE'))}
+        ),
+        candidatas AS (
+            SELECT k.indice, {_columnas('c')},
+                   ROW_NUMBER() OVER (
+                       PARTITION BY k.indice
+                       ORDER BY c.{q('fecha_pago')} DESC, c.{q('secuencia_evento')} DESC NULLS LAST,
+                                c.{q('id_calificacion')} DESC
+                   ) AS orden
+            FROM claves k
+            JOIN {q(CalificacionTributaria._meta.db_table)} c
+              ON c.{q('instrumento')} = k.instrumento
+             AND c.{q('fecha_pago')} <= k.fecha
+            WHERE {_filtro('c', solo_corredor)}
+        )
+        SELECT v.indice, {_columnas('v')}, {_factores()}
+        FROM candidatas v
+        {_join_factores('v')}
+        WHERE v.orden = 1
+        ORDER BY v.indice
+    """
+
+
+def _decimal(valor):
+    # SQLite devuelve REAL y PostgreSQL Decimal: se normalizan a texto con 8 decimales
+    if valor is None:
+        return None
+    return str(Decimal(str(valor)).quantize(_OCHO_DECIMALES))
+
+
+def _resultado(fila):
+    indice, id_calificacion, instrumento, ejercicio, secuencia, mercado, fecha_pago, origen = fila[:8]
+    return {
+        'indice': indice,
+        'id_calificacion': id_calificacion,
+        'instrumento': instrumento,
+        'ejercicio': ejercicio,
+        'secuencia_evento': secuencia,
+        'mercado': mercado,
+        'fecha_pago': str(fecha_pago),
+        'origen': origen,
+        'factores': {campo: _decimal(valor) for campo, valor in zip(CAMPOS_FACTORES, fila[8:])},
+    }
+
+
+def _ejecutar(generar_sql, claves, usuario, tamano_bloque):
+    """Ejecuta `generar_sql` por bloques de claves y genera un resultado por fila.
+
+    Un Corredor solo ve calificaciones de origen Corredor, como en lista_calificaciones.
+    """
+    solo_corredor = usuario.rol == 'Corredor'
+    por_clave = len(claves[0]) + 1 if claves else 1
+    maximo = connection.features.max_query_params
+    por_consulta = max((maximo - 2) // por_clave, 1) if maximo else max(len(claves), 1)
+    with connection.cursor() as cursor:
+        for inicio in range(0, len(claves), por_consulta):
+            bloque = claves[inicio:inicio + por_consulta]
+            parametros = []
+            for indice, clave in enumerate(bloque, start=inicio):
+                parametros += [indice, *clave]
+            parametros.append(True)
+            if solo_corredor:
+                parametros.append('Corredor')
+            cursor.execute(generar_sql(len(bloque), solo_corredor), parametros)
+            while True:
+                filas = cursor.fetchmany(tamano_bloque)
+                if not filas:
+                    break
+                for fila in filas:
+                    yield _resultado(fila)
+
+
+def buscar_factores(claves, usuario, tamano_bloque=500):
+    """Genera un dict por calificación que coincide con cada clave, en el orden de las claves"""
+    return _ejecutar(_sql_claves, claves, usuario, tamano_bloque)
+
+
+def buscar_vigentes(consultas, usuario, tamano_bloque=500):
+    """Genera, por cada (instrumento, fecha), la calificación vigente a esa fecha si existe"""
+    return _ejecutar(_sql_vigentes, consultas, usuario, tamano_bloque)
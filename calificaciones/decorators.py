@@ -1,7 +1,11 @@
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import redirect
+from django.views.decorators.csrf import csrf_exempt
 from functools import wraps
 
+from .tokens_api import autenticar as autenticar_token
+
 def rol_requerido(roles_permitidos):
     def decorator(view_func):
         @wraps(view_func)
@@ -35,4 +39,42 @@ def editor_required(view_func):
 
 # NUEVO: Decorator para vistas de solo lectura (todos los roles)
 def solo_lectura_required(view_func):
-    return rol_requerido(['Administrador', 'Analista', 'Auditor', 'Corredor'])(view_func)
\ No newline at end of file
+    return rol_requerido(['Administrador', 'Analista', 'Auditor', 'Corredor'])(view_func)
+
+def _rechazo_csrf(request):
+    """Verificación CSRF de la sesión para vistas marcadas csrf_exempt"""
+    verificador = CsrfViewMiddleware(lambda request: None)
+    verificador.process_request(request)
+    return verificador.process_view(request, None, (), {})
+
+# API JSON: mismas reglas de rol, pero responde 401/403 en JSON en vez de redirigir.
+# Acepta "Authorization: Bearer <token>" (sin sesión, MFA ni CSRF) o la sesión del sitio.
+def api_rol_requerido(roles_permitidos):
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            autorizacion = request.headers.get('Authorization', '')
+            if autorizacion.startswith('Bearer '):
+                usuario = autenticar_token(autorizacion[len('Bearer '):].strip())
+                if usuario is None:
+                    return JsonResponse({'error': 'Token inválido'}, status=401)
+                request.user = usuario
+            elif not request.user.is_authenticated:
+                return JsonResponse({'error': 'Autenticación requerida'}, status=401)
+            elif _rechazo_csrf(request) is not None:
+                return JsonResponse({'error': 'Verificación CSRF fallida'}, status=403)
+            
+            if request.user.rol not in roles_permitidos:
+                return JsonResponse({'error': 'No tienes permisos para este recurso'}, status=403)
+            
+            return view_func(request, *args, **kwargs)
+        # La verificación CSRF se hace arriba, solo para la sesión
+        return csrf_exempt(_wrapped_view)
+    return decorator
+
+def api_editor_required(view_func):
+    return api_rol_requerido(['Administrador', 'Analista', 'Corredor'])(view_func)
+
+
+def api_solo_lectura_required(view_func):
+    return api_rol_requerido(['Administrador', 'Analista', 'Auditor', 'Corredor'])(view_func)
@@ -0,0 +1,72 @@
+"""
+Cache del estado MFA: si el usuario tiene un TOTPDevice confirmado y a qué
+dispositivo corresponde el persistent_id de django-otp guardado en la sesión.
+
+Del dispositivo solo se cachea (pk, user_id, confirmed), nunca la clave TOTP;
+el TOTPDevice se carga de la base de datos solo si alguien lo usa. Las entradas
+se invalidan con las señales de TOTPDevice (ver signals.py), que cubren
+mfa_setup, mfa_disable y el borrado de dispositivos o usuarios. Esa
+invalidación solo alcanza a todos los procesos con un cache compartido: con
+LocMemCache el dispositivo verificado se consulta en cada petición, para que
+desactivarlo o borrarlo desde otro worker lo revoque de inmediato.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from .bloqueo import cache_compartido
+
+
+def _segundos():
+    return getattr(settings, 'MFA_CACHE_SEGUNDOS', 300)
+
+
+def _clave_usuario(usuario_id):
+    return f'mfa_habilitado:{usuario_id}'
+
+
+def _clave_dispositivo(persistent_id):
+    return f'mfa_dispositivo:{persistent_id}'
+
+
+def mfa_habilitado(usuario_id):
+    habilitado = cache.get(_clave_usuario(usuario_id))
+    if habilitado is None:
+        habilitado = TOTPDevice.objects.filter(user_id=usuario_id, confirmed=True).exists()
+        cache.set(_clave_usuario(usuario_id), habilitado, _segundos())
+    return habilitado
+
+
+def _datos_dispositivo(persistent_id):
+    """(pk, user_id, confirmed) del TOTPDevice de `persistent_id`, o None si no existe"""
+    etiqueta, _, pk = persistent_id.rpartition('/')
+    if etiqueta != TOTPDevice.model_label() or not pk.isdigit():
+        return None
+    return TOTPDevice.objects.filter(pk=pk).values_list('pk', 'user_id', 'confirmed').first()
+
+
+def dispositivo_verificado(persistent_id, usuario_id):
+    """TOTPDevice confirmado de `usuario_id` al que apunta la sesión, o None.
+
+    El dispositivo es perezoso: solo se consulta completo si se accede a él.
+    """
+    if not cache_compartido():
+        datos = _datos_dispositivo(persistent_id)
+    else:
+        clave = _clave_dispositivo(persistent_id)
+        datos = cache.get(clave)
+        if datos is None:
+            # Los persistent_id inexistentes también se cachean, como tupla vacía
+            datos = _datos_dispositivo(persistent_id) or ()
+            cache.set(clave, datos, _segundos())
+    if not datos:
+        return None
+    pk, dueno_id, confirmado = datos
+    if dueno_id != usuario_id or not confirmado:
+        return None
+    return SimpleLazyObject(lambda: TOTPDevice.objects.get(pk=pk))
+
+
+def invalidar(dispositivo):
+    cache.delete_many([_clave_usuario(dispositivo.user_id), _clave_dispositivo(dispositivo.persistent_id)])
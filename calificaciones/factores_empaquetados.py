@@ -0,0 +1,44 @@
+"""
+Representación empaquetada de factor_8..factor_37.
+
+Los 30 factores se guardan como int64 little-endian en punto fijo (unidades
+de 10^-8, exacto para DecimalField(9, 8)): 240 bytes por fila en una sola
+columna binaria, en vez de 30 columnas decimales. Un factor NULL se guarda
+como NULO (el mínimo de int64, fuera del rango de DecimalField(9, 8)).
+"""
+from decimal import Decimal
+
+import numpy as np
+
+CANTIDAD = 30
+ESCALA = 10 ** 8
+NULO = np.iinfo(np.int64).min
+TIPO = np.dtype('<i8')
+
+
+def empaquetar(valores):
+    """bytes a partir de 30 valores (Decimal, str, número o None)"""
+    enteros = np.array(
+        [NULO if valor is None else int(Decimal(str(valor)).scaleb(8)) for valor in valores],
+        dtype=TIPO,
+    )
+    if len(enteros) != CANTIDAD:
+        raise ValueError(f'Se esperaban {CANTIDAD} factores y llegaron {len(enteros)}')
+    return enteros.tobytes()
+
+
+def desempaquetar(datos):
+    """Vector int64 (NULO donde el factor es NULL) a partir de los bytes guardados"""
+    return np.frombuffer(bytes(datos), dtype=TIPO)
+
+
+def desempaquetar_muchos(lista_datos):
+    """Matriz (n, 30) int64 a partir de una secuencia de bytes, en una sola copia"""
+    if not lista_datos:
+        return np.empty((0, CANTIDAD), dtype=TIPO)
+    return np.frombuffer(b''.join(bytes(datos) for datos in lista_datos), dtype=TIPO).reshape(-1, CANTIDAD)
+
+
+def a_decimales(vector):
+    """Lista de Decimal/None a partir de un vector desempaquetado"""
+    return [None if entero == NULO else Decimal(int(entero)).scaleb(-8) for entero in vector]
@@ -1,23 +1,22 @@
 from django import forms
 from django.core.validators import RegexValidator
 from django_otp.forms import OTPTokenForm
-from django_otp.plugins.otp_totp.models import TOTPDevice
 import re
-try:
-    import pyotp
-except Exception:
-    pyotp = None
-from .models import CalificacionTributaria, Usuario, FactorCalificacion
+from .models import CalificacionTributaria, Usuario, FactorCalificacion, LogAuditoria
 from django.http import QueryDict
 from decimal import Decimal
-from django.contrib.auth.forms import AuthenticationForm, PasswordResetForm
+from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.contrib.sites.shortcuts import get_current_site
 from .models import Usuario
-from datetime import date
+from datetime import date, datetime, time, timedelta
+from .verificacion_mfa import dispositivo_de_usuario, verificar_token
+from .reglas import NO_CAMPO, validar
+from django.utils import timezone
+from django.db.models.functions import Lower
 from django.utils.crypto import get_random_string
 import re
 
@@ -39,8 +38,10 @@ class MfaVerifyForm(forms.Form):
         })
     )
     
-    def __init__(self, user, *args, **kwargs):
+    def __init__(self, user, *args, device=None, **kwargs):
+        """`device` evita volver a consultarlo si la vista ya lo tiene"""
         self.user = user
+        self._device = device
         super().__init__(*args, **kwargs)
     
     def clean_token(self):
@@ -49,66 +50,26 @@ class MfaVerifyForm(forms.Form):
         if not token:
             raise forms.ValidationError('Este campo es obligatorio.')
         
-        if not token.isdigit():
+        # [0-9] y no isdigit(): isdigit acepta dígitos Unicode ('١٢٣٤٥٦')
+        if not re.fullmatch(r'[0-9]+', token):
             raise forms.ValidationError('El código debe contener solo números.')
         
         if len(token) != 6:
             raise forms.ValidationError('El código debe tener exactamente 6 dígitos.')
-        # Look for any TOTP device for the user (confirmed or unconfirmed)
-        try:
-            device_qs = TOTPDevice.objects.filter(user=self.user)
-        except Exception:
-            device_qs = None
 
-        if not device_qs or not device_qs.exists():
+        if self._device is None:
+            self._device = dispositivo_de_usuario(self.user.pk)
+        if self._device is None:
             raise forms.ValidationError('No se encontró un dispositivo MFA configurado para el usuario.')
 
-        # Prefer a confirmed device, otherwise use the most-recent one
-        device = device_qs.filter(confirmed=True).first() or device_qs.first()
-
-        # Try using the device's built-in verification first
-        valid = False
-        try:
-            valid = bool(device.verify_token(token))
-        except Exception:
-            valid = False
-
-        # If built-in verification failed (e.g., device.key isn't hex), try pyotp fallback
-        if not valid and pyotp is not None:
-            try:
-                raw_key = getattr(device, 'key', None)
-                if raw_key:
-                    raw = str(raw_key).strip().upper()
-                    # If it looks like Base32 use directly
-                    if re.fullmatch(r'[A-Z2-7]+=*', raw):
-                        totp = pyotp.TOTP(raw)
-                        valid = bool(totp.verify(token, valid_window=1))
-                    else:
-                        # Otherwise base32-encode the raw bytes/string and try
-                        try:
-                            b32 = pyotp.random_base32() if not raw else pyotp.utils.to_bytes(raw)
-                            # If we got bytes, encode to base32
-                            if isinstance(b32, bytes):
-                                b32 = pyotp.utils.byte_to_base32(b32)
-                        except Exception:
-                            b32 = None
-
-                        if b32:
-                            totp = pyotp.TOTP(b32)
-                            valid = bool(totp.verify(token, valid_window=1))
-            except Exception:
-                valid = False
-
-        if not valid:
+        if not verificar_token(self._device, token):
             raise forms.ValidationError('Código de verificación inválido.')
-
-        # Store device for use in view (otp_login)
-        self._device = device
+        self.verificado = True
         return token
 
     def get_device(self):
         """Devuelve el dispositivo TOTP que verificó el token (o None)."""
-        return getattr(self, '_device', None)
+        return self._device if getattr(self, 'verificado', False) else None
 
 class MfaSetupForm(forms.Form):
     """Formulario para configurar MFA"""
@@ -171,32 +132,12 @@ class CalificacionTributariaForm(forms.ModelForm):
             'descripcion_dividendo': 'Descripción del Dividendo',
         }
 
-    def clean_secuencia_evento(self):
-        """Validar que la secuencia sea mayor a 10000"""
-        secuencia = self.cleaned_data.get('secuencia_evento')
-        if secuencia and secuencia <= 10000:
-            raise forms.ValidationError("La secuencia debe ser superior a 10.000")
-        return secuencia
-
     def clean(self):
-        """Validación adicional: la fecha de pago no puede ser anterior al ejercicio."""
+        """Reglas de negocio compartidas (reglas.py): secuencia y fecha de pago vs ejercicio."""
         cleaned = super().clean()
-        ejercicio = cleaned.get('ejercicio')
-        fecha_pago = cleaned.get('fecha_pago')
-
-        if ejercicio and fecha_pago:
-            try:
-                ejercicio_int = int(ejercicio)
-            except Exception:
-                ejercicio_int = None
-
-            if ejercicio_int is not None:
-                primero_enero = date(ejercicio_int, 1, 1)
-                if fecha_pago < primero_enero:
-                    self.add_error('fecha_pago', forms.ValidationError(
-                        'La fecha de pago no puede ser anterior al inicio del ejercicio.'
-                    ))
-
+        for campo, mensajes in validar({campo: cleaned.get(campo) for campo in self._meta.fields}).items():
+            for mensaje in mensajes:
+                self.add_error(None if campo == NO_CAMPO else campo, mensaje)
         return cleaned
 
 class MontosForm(forms.Form):
@@ -456,38 +397,7 @@ class FactoresForm(forms.ModelForm):
             }),
         }
 
-    def clean(self):
-        cleaned_data = super().clean()
-        # Validate factors 8..16 (inclusive)
-        factores_validar = [f'factor_{i}' for i in range(8, 17)]
-        
-        suma_factores = Decimal('0.00000000')
-        
-        for factor_field in factores_validar:
-            valor = cleaned_data.get(factor_field)
-            if valor is None:
-                valor = Decimal('0.00000000')
-            suma_factores += valor
-
-        # Ensure individual factors are > 0 (no zeros or negatives allowed)
-        for i in range(8, 20):
-            fname = f'factor_{i}'
-            if fname in cleaned_data and cleaned_data[fname] is not None:
-                try:
-                    v = Decimal(cleaned_data[fname])
-                except Exception:
-                    continue
-                if v < Decimal('0'):
-                    self.add_error(fname, forms.ValidationError('El factor no puede ser negativo'))
-
-        if suma_factores > Decimal('1.00000000'):
-            raise forms.ValidationError(
-                f"La suma de los factores del 8 al 16 ({suma_factores:.8f}) "
-                f"no puede ser mayor a 1.00000000"
-            )
-        
-        # NO agregar suma_factores_8_16 a cleaned_data
-        return cleaned_data
+    # Las reglas de factores (reglas.py) las aplica FactorCalificacion.clean durante is_valid()
 
 class FiltroCalificacionesForm(forms.Form):
     """Formulario para filtrar calificaciones en el mantenedor"""
@@ -524,7 +434,58 @@ class FiltroCalificacionesForm(forms.Form):
 
 
 
-class LoginForm(AuthenticationForm):
+class FiltroAuditoriaForm(forms.Form):
+    """Filtros del explorador de auditoría"""
+
+    accion = forms.ChoiceField(
+        required=False,
+        choices=[('', 'Todas')] + LogAuditoria.ACCION_OPCIONES,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    usuario = forms.ModelChoiceField(
+        required=False,
+        queryset=Usuario.objects.order_by('nombre'),
+        empty_label='Todos',
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    id_calificacion = forms.IntegerField(
+        required=False,
+        label="ID Calificación",
+        widget=forms.NumberInput(attrs={'class': 'form-control'})
+    )
+    desde = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+    hasta = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+    texto = forms.CharField(
+        required=False,
+        label="Texto en detalle",
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Buscar en detalle...'})
+    )
+    incluir_archivo = forms.BooleanField(
+        required=False,
+        label="Incluir meses archivados",
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+
+    def clean(self):
+        """Convierte las fechas en un rango [desde, hasta) de datetimes locales"""
+        cleaned = super().clean()
+        tz = timezone.get_current_timezone()
+        if cleaned.get('desde'):
+            cleaned['desde'] = datetime.combine(cleaned['desde'], time.min, tzinfo=tz)
+        if cleaned.get('hasta'):
+            cleaned['hasta'] = datetime.combine(cleaned['hasta'] + timedelta(days=1), time.min, tzinfo=tz)
+        return cleaned
+
+
+class LoginForm(forms.Form):
+    """Credenciales de login. La autenticación la hace login_view (una sola consulta),
+    por eso no hereda de AuthenticationForm, que buscaría al usuario de nuevo."""
     username = forms.EmailField(
         label='Correo Electrónico',
         widget=forms.EmailInput(attrs={
@@ -630,7 +591,11 @@ class CustomPasswordResetForm(PasswordResetForm):
         """Generador de usuarios activos cuyo `correo` coincide (case-insensitive).
         Nuestro modelo usa `estado` en lugar de `is_active`, así que filtramos por ese campo."""
         UserModel = get_user_model()
-        for user in UserModel._default_manager.filter(correo__iexact=email, estado=True):
+        # Lower(correo) coincide con el índice funcional usuario_correo_lower_uniq
+        usuarios = UserModel._default_manager.alias(correo_normalizado=Lower('correo')).filter(
+            correo_normalizado=email.lower(), estado=True
+        )
+        for user in usuarios:
             if user.has_usable_password():
                 yield user
 
@@ -0,0 +1,122 @@
+"""
+Escáner de integridad de calificaciones sobre toda la tabla.
+
+Aplica en bloque las reglas de reglas.py (las mismas de los formularios y la
+carga por API) a las filas que no pasaron por ellos, como las de
+procesar_fila_factores o las editadas directamente en la base.
+
+Las calificaciones se recorren por bloques de INTEGRIDAD_TAMANO_LOTE
+(paginación por id, sin OFFSET) y cada bloque se evalúa con
+`reglas.validar_columnas` sobre los factores empaquetados. Las violaciones de
+cada bloque se reconcilian en una transacción: se agregan las nuevas, se
+borran las corregidas y las vigentes conservan su fecha_deteccion.
+
+El escaneo incremental solo revisa las calificaciones con fecha_modificacion
+desde el inicio del último escaneo terminado, menos INTEGRIDAD_MARGEN_SEGUNDOS:
+fecha_modificacion se asigna antes del COMMIT y una transacción larga puede
+confirmar filas más antiguas que ese inicio. El primero siempre es completo.
+"""
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .matriz_factores import CAMPOS_FACTORES, leer_factores
+from .models import CalificacionTributaria, EscaneoIntegridad, ViolacionIntegridad
+from .reglas import validar_columnas
+
+_COLUMNAS = [
+    'id_calificacion', 'estado', 'ejercicio', 'fecha_pago', 'secuencia_evento',
+    'factorcalificacion__id_factor', 'factorcalificacion__factores_empaquetados',
+]
+
+
+def tabla(filas):
+    """DataFrame para validar_columnas a partir de filas leídas con _COLUMNAS"""
+    valores, presentes = leer_factores([fila[5] for fila in filas], [fila[6] for fila in filas])
+    # float64 con NaN para los nulos: exacto, los factores caben de sobra en 2^53
+    df = pd.DataFrame(np.where(presentes, valores, np.nan), columns=CAMPOS_FACTORES)
+    df['ejercicio'] = pd.Series([fila[2] for fila in filas], dtype='float64')
+    df['fecha_pago'] = pd.to_datetime(pd.Series([fila[3] for fila in filas], dtype=object))
+    df['secuencia_evento'] = pd.Series([fila[4] for fila in filas], dtype='float64')
+    return df
+
+
+def evaluar(df):
+    """Lista de (fila, regla, detalle); las reglas con el mismo código se agrupan en un detalle"""
+    por_codigo = {}
+    for regla, mascara in validar_columnas(df):
+        por_codigo.setdefault(regla.codigo, []).append((regla, mascara.to_numpy()))
+    violaciones = []
+    for codigo, evaluadas in por_codigo.items():
+        for fila in np.flatnonzero(np.logical_or.reduce([mascara for _, mascara in evaluadas])):
+            registro = df.iloc[fila]
+            detalle = ', '.join(regla.describir(registro) for regla, mascara in evaluadas if mascara[fila])
+            violaciones.append((fila, codigo, detalle))
+    return violaciones
+
+
+def _bloques(queryset, tamano):
+    ultimo = 0
+    while True:
+        filas = list(queryset.filter(id_calificacion__gt=ultimo).order_by('id_calificacion').values_list(*_COLUMNAS)[:tamano])
+        if not filas:
+            return
+        yield filas
+        ultimo = filas[-1][0]
+
+
+def _reconciliar(ids, encontradas, escaneo):
+    """Deja en la tabla exactamente las violaciones `encontradas` ({(id, regla): detalle}) de `ids`"""
+    with transaction.atomic():
+        existentes = {
+            (id_calificacion, regla): pk
+            for pk, id_calificacion, regla in ViolacionIntegridad.objects.filter(
+                id_calificacion_id__in=ids,
+            ).values_list('pk', 'id_calificacion_id', 'regla')
+        }
+        corregidas = [pk for clave, pk in existentes.items() if clave not in encontradas]
+        if corregidas:
+            ViolacionIntegridad.objects.filter(pk__in=corregidas).delete()
+        ViolacionIntegridad.objects.bulk_create([
+            ViolacionIntegridad(id_calificacion_id=id_calificacion, regla=regla, detalle=detalle, escaneo=escaneo)
+            for (id_calificacion, regla), detalle in encontradas.items()
+            if (id_calificacion, regla) not in existentes
+        ])
+
+
+def escanear(completo=False, tamano_lote=None):
+    """Ejecuta un escaneo y retorna su EscaneoIntegridad"""
+    tamano_lote = tamano_lote or getattr(settings, 'INTEGRIDAD_TAMANO_LOTE', 5000)
+    anterior = EscaneoIntegridad.objects.filter(fin__isnull=False).order_by('-inicio').first()
+    completo = completo or anterior is None
+    escaneo = EscaneoIntegridad.objects.create(
+        tipo='COMPLETO' if completo else 'INCREMENTAL',
+        desde=None if completo else anterior.inicio - timedelta(seconds=getattr(settings, 'INTEGRIDAD_MARGEN_SEGUNDOS', 300)),
+    )
+
+    if completo:
+        calificaciones = CalificacionTributaria.objects.filter(estado=True)
+        ViolacionIntegridad.objects.filter(id_calificacion__estado=False).delete()
+    else:
+        # Incluye las inactivas modificadas, para borrar sus violaciones
+        calificaciones = CalificacionTributaria.objects.filter(fecha_modificacion__gte=escaneo.desde)
+
+    for filas in _bloques(calificaciones, tamano_lote):
+        ids = [fila[0] for fila in filas]
+        encontradas = {
+            (ids[fila], regla): detalle
+            for fila, regla, detalle in evaluar(tabla(filas))
+            if filas[fila][1]
+        }
+        _reconciliar(ids, encontradas, escaneo)
+        escaneo.filas_revisadas += len(filas)
+        # Calificaciones con alguna violación, no pares (calificación, regla)
+        escaneo.violaciones += len({id_calificacion for id_calificacion, _ in encontradas})
+
+    escaneo.fin = timezone.now()
+    escaneo.save(update_fields=['fin', 'filas_revisadas', 'violaciones'])
+    return escaneo
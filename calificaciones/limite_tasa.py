@@ -0,0 +1,68 @@
+"""
+Limitador de tasa para los endpoints de autenticación.
+
+Cada POST consume un intento del límite de la IP y otro del de la cuenta
+(correo o usuario pendiente de MFA). Se aproxima un token bucket con los
+contadores de ventana deslizante de bloqueo.py: la ventana es lo que tarda el
+bucket en llenarse y admite `capacidad` intentos. `cache.incr` (o el UPDATE
+atómico de CONTADOR_FALLOS_LOGIN cuando el cache es por proceso) hace que el
+límite valga para todos los workers. Los intentos rechazados también cuentan.
+La petición se rechaza con 429 antes de hashear contraseñas o consultar
+usuarios.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .bloqueo import contar_en_ventana
+from .metricas import registro as metricas
+
+# endpoint -> (capacidad del bucket, tokens repuestos por minuto)
+LIMITES_POR_DEFECTO = {
+    'login': (10, 5),
+    'mfa_verify': (5, 3),
+    'password_reset': (3, 1),
+}
+
+
+def _limite(endpoint):
+    return getattr(settings, 'LIMITE_TASA', LIMITES_POR_DEFECTO).get(endpoint, LIMITES_POR_DEFECTO[endpoint])
+
+
+def consumir(endpoint, identificador):
+    """Consume un intento; retorna 0 si se permite o los segundos a esperar si no"""
+    capacidad, por_minuto = _limite(endpoint)
+    tasa = por_minuto / 60.0
+    intentos = contar_en_ventana(f'limite_tasa:{endpoint}:{identificador}', capacidad / tasa)
+    if intentos <= capacidad:
+        return 0
+    return (intentos - capacidad) / tasa
+
+
+def limitar_tasa(endpoint, cuenta=None):
+    """Decorador que limita los POST por IP y, si `cuenta` lo indica, por cuenta.
+
+    `cuenta` recibe el request y retorna el identificador de la cuenta o None.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if request.method != 'POST' or not getattr(settings, 'LIMITE_TASA_ACTIVO', True):
+                return view_func(request, *args, **kwargs)
+
+            claves = [f"ip:{request.META.get('REMOTE_ADDR', '')}"]
+            id_cuenta = cuenta(request) if cuenta else None
+            if id_cuenta:
+                claves.append(f'cuenta:{str(id_cuenta).strip().lower()}')
+
+            espera = max(consumir(endpoint, clave) for clave in claves)
+            if espera:
+                metricas.incrementar('nuam_limite_tasa_peticiones_total', endpoint=endpoint, resultado='rechazada')
+                respuesta = HttpResponse('Demasiadas solicitudes. Intenta más tarde.', status=429)
+                respuesta['Retry-After'] = str(int(espera) + 1)
+                return respuesta
+            metricas.incrementar('nuam_limite_tasa_peticiones_total', endpoint=endpoint, resultado='permitida')
+            return view_func(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
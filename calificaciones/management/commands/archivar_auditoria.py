@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from calificaciones.archivo_auditoria import archivar_auditoria, limite_archivado, meses_archivables
+
+
+class Command(BaseCommand):
+    help = 'Mover los meses antiguos de LOG_AUDITORIA a archivos mensuales comprimidos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=settings.AUDITORIA_HORIZONTE_DIAS,
+                            help='Horizonte en días que se mantiene en la tabla')
+        parser.add_argument('--lote', type=int, default=settings.AUDITORIA_TAMANO_BORRADO,
+                            help='Filas por lote de escritura/borrado')
+        parser.add_argument('--dry-run', action='store_true', help='Solo mostrar los meses a archivar')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            limite = limite_archivado(horizonte_dias=options['dias'])
+            for anio, mes in meses_archivables(limite):
+                self.stdout.write(f'{anio}-{mes:02d} se archivaría')
+            return
+
+        resultado = archivar_auditoria(horizonte_dias=options['dias'], tamano_lote=options['lote'])
+        if not resultado:
+            self.stdout.write(self.style.WARNING('No hay meses para archivar'))
+        for (anio, mes), filas in resultado.items():
+            self.stdout.write(self.style.SUCCESS(f'{anio}-{mes:02d}: {filas} registros archivados'))
@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+
+
+class Command(BaseCommand):
+    help = ('Medir el costo por petición de obtener la conexión a la base de datos: una conexión nueva '
+            'por petición, conexiones persistentes (CONN_MAX_AGE) y pool (si DB_POOL está activo)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--peticiones', type=int, default=500, help='Peticiones simuladas por modo')
+        parser.add_argument('--alias', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        conexion = connections[options['alias']]
+        original = {'CONN_MAX_AGE': conexion.settings_dict['CONN_MAX_AGE'],
+                    'OPTIONS': dict(conexion.settings_dict['OPTIONS'])}
+        pool = original['OPTIONS'].pop('pool', None)
+        modos = [
+            ('nueva conexión por petición', 0, None),
+            (f"persistente (CONN_MAX_AGE={original['CONN_MAX_AGE'] or 600})", original['CONN_MAX_AGE'] or 600, None),
+        ]
+        if pool:
+            modos.append(('pool', 0, pool))
+
+        self.stdout.write(f"{conexion.vendor}, {options['peticiones']} peticiones por modo, "
+                          f"CONN_HEALTH_CHECKS={conexion.settings_dict['CONN_HEALTH_CHECKS']}")
+        try:
+            for nombre, edad, opciones_pool in modos:
+                self._configurar(conexion, edad, opciones_pool, original['OPTIONS'])
+                tiempos, creadas = self._medir(conexion, options['peticiones'])
+                self.stdout.write(
+                    f'  {nombre:<36} media {tiempos.mean() * 1e6:9.1f} µs  p95 {np.percentile(tiempos, 95) * 1e6:9.1f} µs  '
+                    f'{creadas} conexiones abiertas'
+                )
+        finally:
+            self._configurar(conexion, original['CONN_MAX_AGE'], pool, original['OPTIONS'])
+
+    def _configurar(self, conexion, edad, opciones_pool, opciones):
+        conexion.close()
+        if hasattr(conexion, 'close_pool'):
+            conexion.close_pool()
+        conexion.settings_dict['CONN_MAX_AGE'] = edad
+        conexion.settings_dict['OPTIONS'] = dict(opciones, **({'pool': opciones_pool} if opciones_pool else {}))
+
+    def _medir(self, conexion, peticiones):
+        """Ciclo de una petición: request_started, una consulta y request_finished (que cierra
+        o conserva la conexión según CONN_MAX_AGE, igual que en el servidor)"""
+        creadas = []
+
+        def contar(sender, connection, **kwargs):
+            if connection.alias == conexion.alias:
+                creadas.append(connection)
+
+        connection_created.connect(contar, weak=False)
+        tiempos = np.empty(peticiones)
+        try:
+            for i in range(peticiones):
+                inicio = time.perf_counter()
+                request_started.send(sender=self.__class__)
+                with conexion.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                    cursor.fetchone()
+                request_finished.send(sender=self.__class__)
+                tiempos[i] = time.perf_counter() - inicio
+        finally:
+            connection_created.disconnect(contar)
+        return tiempos, len(creadas)
@@ -0,0 +1,122 @@
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from calificaciones import factores_empaquetados
+from calificaciones.models import CalificacionTributaria, FactorCalificacion, Usuario
+
+CAMPOS_FACTORES = FactorCalificacion.CAMPOS_FACTORES
+
+
+class _Revertir(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Comparar lectura, recorrido y tamaño en disco de los factores en columnas anchas '
+            'frente a la columna empaquetada')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filas', type=int, default=0,
+                            help='Crear N filas sintéticas en una transacción que se revierte al terminar '
+                                 '(0 = usar los datos existentes)')
+        parser.add_argument('--repeticiones', type=int, default=3, help='Se informa el mejor tiempo')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                if options['filas']:
+                    self._crear_sinteticas(options['filas'])
+                self._medir(options['repeticiones'])
+                if options['filas']:
+                    raise _Revertir
+        except _Revertir:
+            pass
+
+    def _crear_sinteticas(self, cantidad):
+        usuario = Usuario.objects.filter(estado=True).first()
+        if usuario is None:
+            raise CommandError('Se necesita al menos un usuario activo para crear filas sintéticas')
+        rng = np.random.default_rng(0)
+        calificaciones = CalificacionTributaria.objects.bulk_create([
+            CalificacionTributaria(
+                ejercicio=2024, mercado='ACN', instrumento=f'BENCH{i}', fecha_pago='2024-01-01',
+                secuencia_evento=900000000 + i, origen='Sistema', usuario_creador=usuario,
+            )
+            for i in range(cantidad)
+        ], batch_size=2000)
+        factores = []
+        for calificacion, valores in zip(calificaciones, rng.integers(0, 10 ** 7, size=(cantidad, len(CAMPOS_FACTORES)))):
+            factor = FactorCalificacion(
+                id_calificacion=calificacion,
+                **{campo: Decimal(int(v)).scaleb(-8) for campo, v in zip(CAMPOS_FACTORES, valores)},
+            )
+            factor.empaquetar()
+            factores.append(factor)
+        FactorCalificacion.objects.bulk_create(factores, batch_size=2000)
+
+    def _mejor(self, funcion, repeticiones):
+        tiempos = []
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            funcion()
+            tiempos.append(time.perf_counter() - inicio)
+        return min(tiempos)
+
+    def _medir(self, repeticiones):
+        filas = FactorCalificacion.objects.count()
+        if not filas:
+            raise CommandError('No hay factores para medir; use --filas N')
+
+        pruebas = [
+            ('lectura ancha (modelos, 30 Decimal)',
+             lambda: [f.factor_8 for f in FactorCalificacion.objects.only('id_factor', *CAMPOS_FACTORES).iterator(chunk_size=2000)]),
+            ('lectura empaquetada (modelos, vector())',
+             lambda: [f.vector() for f in FactorCalificacion.objects.only('id_factor', 'factores_empaquetados').iterator(chunk_size=2000)]),
+            ('recorrido ancho (values_list -> ndarray)',
+             lambda: np.array(list(FactorCalificacion.objects.values_list(*CAMPOS_FACTORES).iterator(chunk_size=2000)),
+                              dtype=np.float64)),
+            ('recorrido empaquetado (values_list -> ndarray)',
+             lambda: factores_empaquetados.desempaquetar_muchos(list(
+                 FactorCalificacion.objects.exclude(factores_empaquetados=None)
+                 .values_list('factores_empaquetados', flat=True).iterator(chunk_size=2000)))),
+        ]
+        self.stdout.write(f'{filas} filas, mejor de {repeticiones}')
+        for nombre, funcion in pruebas:
+            segundos = self._mejor(funcion, repeticiones)
+            self.stdout.write(f'  {nombre:<48} {segundos * 1000:9.1f} ms  {filas / segundos:12,.0f} filas/s')
+
+        tamanos = self._tamanos()
+        if tamanos is None:
+            self.stdout.write(self.style.WARNING(f'  tamaño en disco: no disponible en {connection.vendor}'))
+            return
+        for nombre, bytes_totales in tamanos:
+            self.stdout.write(f'  tamaño {nombre:<41} {bytes_totales / 1024:9.1f} KiB  {bytes_totales / filas:8.1f} B/fila')
+
+    def _tamanos(self):
+        """Bytes ocupados por cada representación, copiada a una tabla temporal propia"""
+        tabla = FactorCalificacion._meta.db_table
+        q = connection.ops.quote_name
+        anchas = ', '.join(q(campo) for campo in CAMPOS_FACTORES)
+        copias = [
+            ('columnas anchas', 'bench_factores_anchos', f'SELECT {anchas} FROM {q(tabla)}'),
+            ('columna empaquetada', 'bench_factores_empaquetados',
+             f'SELECT {q("factores_empaquetados")} FROM {q(tabla)}'),
+        ]
+        if connection.vendor == 'sqlite':
+            medir = "SELECT SUM(pgsize) FROM dbstat('temp') WHERE name = %s"
+        elif connection.vendor == 'postgresql':
+            medir = 'SELECT pg_total_relation_size(%s::regclass)'
+        else:
+            return None
+        resultado = []
+        with connection.cursor() as cursor:
+            for nombre, temporal, consulta in copias:
+                cursor.execute(f'CREATE TEMPORARY TABLE {temporal} AS {consulta}')
+                cursor.execute(medir, [temporal])
+                resultado.append((nombre, cursor.fetchone()[0] or 0))
+                cursor.execute(f'DROP TABLE {temporal}')
+        return resultado
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from calificaciones.models import Usuario
+from calificaciones.tokens_api import generar
+
+
+class Command(BaseCommand):
+    help = 'Crear un token de API para un usuario (se muestra una sola vez)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('correo', help='Correo del usuario dueño del token')
+        parser.add_argument('--nombre', default='cliente', help='Nombre descriptivo del token')
+        parser.add_argument('--dias', type=int, default=None, help='Días de vigencia (sin expiración por defecto)')
+
+    def handle(self, *args, **options):
+        try:
+            usuario = Usuario.objects.get(correo__iexact=options['correo'], estado=True)
+        except Usuario.DoesNotExist:
+            raise CommandError(f"No existe un usuario activo con correo {options['correo']}")
+
+        token, registro = generar(usuario, options['nombre'], dias=options['dias'])
+        self.stdout.write(self.style.SUCCESS(f'Token {registro.prefijo} creado para {usuario.correo} ({usuario.rol})'))
+        self.stdout.write(token)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from calificaciones.anomalias import detectar
+
+
+class Command(BaseCommand):
+    help = ('Detectar factores anómalos (z robusto por mercado/ejercicio y distancia al ejercicio anterior) '
+            'y actualizar la cola de revisión. También corre en segundo plano tras cada carga masiva')
+
+    def handle(self, *args, **options):
+        resumen = detectar()
+        estilo = self.style.WARNING if resumen['mad'] or resumen['ejercicio_anterior'] else self.style.SUCCESS
+        self.stdout.write(estilo(
+            f"{resumen['calificaciones']} calificaciones evaluadas: {resumen['mad']} anómalas en su grupo, "
+            f"{resumen['ejercicio_anterior']} alejadas de su ejercicio anterior ({resumen['segundos']:.2f} s)"
+        ))
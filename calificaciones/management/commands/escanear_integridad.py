@@ -0,0 +1,32 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from calificaciones.integridad import escanear
+
+
+class Command(BaseCommand):
+    help = ('Validar las reglas de reglas.py sobre las calificaciones activas. '
+            'Incremental por defecto; pensado para cron o para correr con --intervalo')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--completo', action='store_true', help='Revisar toda la tabla, no solo lo modificado')
+        parser.add_argument('--lote', type=int, default=settings.INTEGRIDAD_TAMANO_LOTE,
+                            help='Calificaciones por bloque')
+        parser.add_argument('--intervalo', type=int, default=0,
+                            help='Repetir un escaneo incremental cada N segundos (0 = una sola vez)')
+
+    def handle(self, *args, **options):
+        completo = options['completo']
+        while True:
+            escaneo = escanear(completo=completo, tamano_lote=options['lote'])
+            estilo = self.style.WARNING if escaneo.violaciones else self.style.SUCCESS
+            self.stdout.write(estilo(
+                f'{escaneo.get_tipo_display()}: {escaneo.filas_revisadas} calificaciones revisadas, '
+                f'{escaneo.violaciones} con violaciones ({escaneo.segundos:.2f} s)'
+            ))
+            if not options['intervalo']:
+                return
+            completo = False
+            time.sleep(options['intervalo'])
@@ -0,0 +1,228 @@
+"""
+Matriz columnar de factores en memoria (por proceso) para analítica.
+
+Los factores 8..37 se guardan como una matriz NumPy int64 en punto fijo
+(unidades de 10^-8, exacto para DecimalField(9, 8)) con una máscara de
+presencia para los NULL, y arreglos paralelos de id_calificacion (ordenado),
+ejercicio, mercado, instrumento y origen. Solo incluye calificaciones activas.
+
+La matriz se construye con `values_list(...).iterator()` sobre la columna
+factores_empaquetados (un bloque de bytes por fila) y luego se refresca
+de forma incremental: cada MATRIZ_FACTORES_REFRESCO_SEGUNDOS se leen solo las
+calificaciones con fecha_modificacion posterior a la última vista, menos
+MATRIZ_FACTORES_MARGEN_SEGUNDOS para no perder transacciones que confirman
+tarde (todas las vías de edición guardan la calificación). Los borrados físicos no dejan marca,
+por eso cada MATRIZ_FACTORES_RECONSTRUIR_SEGUNDOS se reconstruye completa.
+
+Cada refresco publica una instantánea nueva; quien la obtuvo con `obtener()`
+puede seguir leyéndola sin bloqueos.
+"""
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+
+from .metricas import registro as metricas
+from . import factores_empaquetados
+from .models import CalificacionTributaria, FactorCalificacion
+
+CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+ESCALA = 10 ** 8
+_COLUMNAS = [
+    'id_calificacion', 'ejercicio', 'mercado', 'instrumento', 'origen', 'estado', 'fecha_modificacion',
+    'factorcalificacion__id_factor', 'factorcalificacion__factores_empaquetados',
+]
+_SIN_FACTORES = np.full(len(CAMPOS_FACTORES), factores_empaquetados.NULO, dtype=factores_empaquetados.TIPO).tobytes()
+
+
+class MatrizFactores:
+    """Instantánea inmutable de los factores de las calificaciones activas"""
+
+    def __init__(self, ids, ejercicio, mercado, instrumento, origen, valores, presentes, marca):
+        self.ids = ids
+        self.ejercicio = ejercicio
+        self.mercado = mercado
+        self.instrumento = instrumento
+        self.origen = origen
+        self.valores = valores
+        self.presentes = presentes
+        # Mayor fecha_modificacion incorporada: punto de partida del próximo refresco
+        self.marca = marca
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filtrar(self, ejercicio=None, mercado=None, instrumento=None, origen=None):
+        """Máscara booleana de filas que cumplen los filtros dados"""
+        mascara = np.ones(len(self.ids), dtype=bool)
+        for columna, valor in ((self.ejercicio, ejercicio), (self.mercado, mercado),
+                               (self.instrumento, instrumento), (self.origen, origen)):
+            if valor is not None:
+                mascara &= columna == valor
+        return mascara
+
+    def posiciones(self, ids):
+        """Posición de cada id en la matriz, o -1 si no está"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        posiciones = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[posiciones] == ids, posiciones, -1)
+
+
+def leer_factores(id_factores, empaquetados):
+    """(valores, presentes) de filas leídas con factorcalificacion__id_factor y __factores_empaquetados.
+
+    Las filas sin FactorCalificacion quedan sin factores; las que aún no tienen
+    la columna empaquetada se completan desde las columnas anchas con una consulta.
+    """
+    empaquetados = list(empaquetados)
+    pendientes = {}
+    for posicion, (id_factor, datos) in enumerate(zip(id_factores, empaquetados)):
+        if datos is None:
+            empaquetados[posicion] = _SIN_FACTORES
+            if id_factor is not None:
+                pendientes[id_factor] = posicion
+    if pendientes:
+        anchas = FactorCalificacion.objects.filter(id_factor__in=list(pendientes)).values_list('id_factor', *CAMPOS_FACTORES)
+        for id_factor, *valores in anchas.iterator(chunk_size=5000):
+            empaquetados[pendientes[id_factor]] = factores_empaquetados.empaquetar(valores)
+
+    matriz = factores_empaquetados.desempaquetar_muchos(empaquetados)
+    presentes = matriz != factores_empaquetados.NULO
+    return np.where(presentes, matriz, 0), presentes
+
+
+def _leer(queryset):
+    """Arreglos columnares a partir de un queryset, leído en bloques"""
+    ids, ejercicio, mercado, instrumento, origen, estado, id_factores, empaquetados = [], [], [], [], [], [], [], []
+    marca = None
+    for fila in queryset.values_list(*_COLUMNAS).iterator(chunk_size=5000):
+        ids.append(fila[0])
+        ejercicio.append(fila[1])
+        mercado.append(fila[2])
+        instrumento.append(fila[3])
+        origen.append(fila[4])
+        estado.append(fila[5])
+        if marca is None or fila[6] > marca:
+            marca = fila[6]
+        id_factores.append(fila[7])
+        empaquetados.append(fila[8])
+
+    valores, presentes = leer_factores(id_factores, empaquetados)
+    columnas = {
+        'ids': np.array(ids, dtype=np.int64), 'ejercicio': np.array(ejercicio, dtype=np.int32),
+        'mercado': np.array(mercado, dtype=object), 'instrumento': np.array(instrumento, dtype=object),
+        'origen': np.array(origen, dtype=object), 'valores': valores, 'presentes': presentes,
+    }
+    return columnas, np.array(estado, dtype=bool), marca
+
+
+def construir():
+    """Matriz completa de las calificaciones activas"""
+    columnas, _, marca = _leer(CalificacionTributaria.objects.filter(estado=True).order_by('id_calificacion'))
+    return MatrizFactores(marca=marca, **columnas)
+
+
+def refrescar(matriz):
+    """Nueva matriz con los cambios posteriores a `matriz.marca` (la original no se modifica)"""
+    if matriz.marca is None:
+        return construir()
+    # fecha_modificacion se asigna antes del COMMIT: una transacción larga puede
+    # confirmar filas más antiguas que la marca después de leerla. Se relee un
+    # margen hacia atrás; reaplicar filas ya vistas es inocuo
+    margen = timedelta(seconds=getattr(settings, 'MATRIZ_FACTORES_MARGEN_SEGUNDOS', 300))
+    columnas, activos, marca = _leer(
+        CalificacionTributaria.objects.filter(fecha_modificacion__gte=matriz.marca - margen).order_by('id_calificacion')
+    )
+    if not len(columnas['ids']):
+        return matriz
+
+    # Quitar las filas cambiadas y volver a insertar las que siguen activas
+    conservar = np.ones(len(matriz), dtype=bool)
+    posiciones = matriz.posiciones(columnas['ids'])
+    conservar[posiciones[posiciones >= 0]] = False
+    nombres = ('ids', 'ejercicio', 'mercado', 'instrumento', 'origen', 'valores', 'presentes')
+    unidas = {
+        nombre: np.concatenate([getattr(matriz, nombre)[conservar], columnas[nombre][activos]])
+        for nombre in nombres
+    }
+    orden = np.argsort(unidas['ids'], kind='stable')
+    return MatrizFactores(marca=max(marca, matriz.marca), **{nombre: arreglo[orden] for nombre, arreglo in unidas.items()})
+
+
+class _Cache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matriz = None
+        self._refrescada = 0.0
+        self._construida = 0.0
+
+    def obtener(self):
+        """Matriz vigente; la refresca o reconstruye si venció su intervalo"""
+        ahora = time.monotonic()
+        refresco = getattr(settings, 'MATRIZ_FACTORES_REFRESCO_SEGUNDOS', 30)
+        reconstruccion = getattr(settings, 'MATRIZ_FACTORES_RECONSTRUIR_SEGUNDOS', 3600)
+        matriz = self._matriz
+        if matriz is not None and ahora - self._refrescada < refresco:
+            return matriz
+        with self._lock:
+            if self._matriz is not None and ahora - self._refrescada < refresco:
+                return self._matriz
+            inicio = time.perf_counter()
+            if self._matriz is None or ahora - self._construida >= reconstruccion:
+                self._matriz, self._construida, tipo = construir(), ahora, 'completa'
+            else:
+                self._matriz, tipo = refrescar(self._matriz), 'incremental'
+            self._refrescada = ahora
+            metricas.observar('nuam_matriz_factores_refresco_segundos', time.perf_counter() - inicio, tipo=tipo)
+            return self._matriz
+
+    def limpiar(self):
+        with self._lock:
+            self._matriz = None
+
+
+cache_matriz = _Cache()
+
+
+def obtener():
+    return cache_matriz.obtener()
+
+
+def estadisticas(matriz, mascara):
+    """Conteo, suma, mínimo, máximo, media y desviación estándar por factor de las filas en `mascara`.
+
+    Suma, mínimo y máximo se calculan en enteros (exactos); media y desviación en float64.
+    """
+    valores = matriz.valores[mascara]
+    presentes = matriz.presentes[mascara]
+    conteo = presentes.sum(axis=0)
+    suma = np.where(presentes, valores, 0).sum(axis=0)
+    minimo = np.where(presentes, valores, np.iinfo(np.int64).max).min(axis=0, initial=np.iinfo(np.int64).max)
+    maximo = np.where(presentes, valores, np.iinfo(np.int64).min).max(axis=0, initial=np.iinfo(np.int64).min)
+    divisor = np.maximum(conteo, 1)
+    media = suma / ESCALA / divisor
+    desvios = np.where(presentes, valores / ESCALA - media, 0.0)
+    desviacion = np.sqrt((desvios ** 2).sum(axis=0) / divisor)
+
+    def fijo(entero):
+        return str(Decimal(int(entero)).scaleb(-8))
+
+    resultado = {}
+    for j, campo in enumerate(CAMPOS_FACTORES):
+        if not conteo[j]:
+            resultado[campo] = {'conteo': 0, 'suma': None, 'minimo': None, 'maximo': None, 'media': None, 'desviacion': None}
+            continue
+        resultado[campo] = {
+            'conteo': int(conteo[j]),
+            'suma': fijo(suma[j]),
+            'minimo': fijo(minimo[j]),
+            'maximo': fijo(maximo[j]),
+            'media': round(float(media[j]), 8),
+            'desviacion': round(float(desviacion[j]), 8),
+        }
+    return resultado
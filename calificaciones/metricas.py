@@ -0,0 +1,311 @@
+"""
+Registro de métricas estilo Prometheus compartido entre procesos.
+
+Cada proceso acumula sus contadores e histogramas en memoria y los vuelca
+periódicamente a `METRICAS_DIR/metricas_<pid>.json`. El endpoint /metrics
+suma los archivos de todos los workers, así los valores son correctos con
+varios procesos de gunicorn sin un colector externo.
+
+Como en el modo multiproceso de prometheus_client, los archivos de procesos
+terminados se suman a `metricas_totales.json` y se borran: al salir (atexit)
+cada proceso suma su propio estado, y /metrics recoge los de workers muertos
+sin salida limpia. Un proceso que recibe el PID de un worker muerto suma el
+archivo que encuentra antes de pisarlo, así los contadores nunca retroceden.
+"""
+import atexit
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo proceso de desarrollo
+    fcntl = None
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_FILAS_POR_SEGUNDO = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+# nombre -> (tipo, ayuda, buckets)
+DEFINICIONES = {
+    'nuam_vista_latencia_segundos': ('histogram', 'Latencia de las vistas por nombre de URL', BUCKETS_LATENCIA),
+    'nuam_auditoria_acciones_total': ('counter', 'Registros de LogAuditoria por acción', None),
+    'nuam_carga_filas_total': ('counter', 'Filas procesadas por procesar_archivo_carga según resultado', None),
+    'nuam_carga_archivos_total': ('counter', 'Archivos de carga masiva según resultado', None),
+    'nuam_carga_filas_por_segundo': ('histogram', 'Velocidad de procesamiento de cada carga masiva', BUCKETS_FILAS_POR_SEGUNDO),
+    'nuam_db_conexiones_creadas_total': ('counter', 'Conexiones a base de datos abiertas', None),
+    'nuam_db_consultas_total': ('counter', 'Consultas SQL ejecutadas por las vistas', None),
+    'nuam_limite_tasa_peticiones_total': ('counter', 'Peticiones a endpoints limitados según resultado', None),
+    'nuam_matriz_factores_refresco_segundos': ('histogram', 'Duración de la construcción o refresco de la matriz de factores', BUCKETS_LATENCIA),
+    'nuam_anomalias_deteccion_segundos': ('histogram', 'Duración de cada detección de anomalías de factores', BUCKETS_LATENCIA),
+}
+
+
+PATRON_ARCHIVO = re.compile(r'metricas_(\d+)\.json$')
+ARCHIVO_TOTALES = 'metricas_totales.json'
+
+
+def _clave_labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # PermissionError: existe, de otro usuario
+        return True
+    return True
+
+
+def _sumar(estados):
+    """(contadores, histogramas) con la suma de varios estados serializados"""
+    contadores = {}
+    histogramas = {}
+    for estado in estados:
+        for nombre, labels, valor in estado.get('contadores', []):
+            clave = (nombre, tuple(map(tuple, labels)))
+            contadores[clave] = contadores.get(clave, 0) + valor
+        for nombre, labels, hist in estado.get('histogramas', []):
+            clave = (nombre, tuple(map(tuple, labels)))
+            total = histogramas.get(clave)
+            if total is None:
+                histogramas[clave] = {'buckets': list(hist['buckets']), 'suma': hist['suma'], 'cuenta': hist['cuenta']}
+            else:
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+                total['suma'] += hist['suma']
+                total['cuenta'] += hist['cuenta']
+    return contadores, histogramas
+
+
+def _serializar(contadores, histogramas):
+    return {
+        'contadores': [[n, list(map(list, l)), v] for (n, l), v in contadores.items()],
+        'histogramas': [[n, list(map(list, l)), dict(h, buckets=list(h['buckets']))]
+                        for (n, l), h in histogramas.items()],
+    }
+
+
+def _leer(ruta):
+    """Estado guardado en `ruta`, o None si no existe o está corrupto"""
+    try:
+        with open(ruta, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _escribir(ruta, estado):
+    """Escritura atómica (archivo temporal + rename)"""
+    temporal = f'{ruta}.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(estado, f)
+    os.replace(temporal, ruta)
+
+
+class RegistroMetricas:
+    """Contadores e histogramas del proceso actual con volcado a archivo"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._ultimo_volcado = 0.0
+        self._iniciar_proceso()
+
+    def _iniciar_proceso(self):
+        # Identifica esta ejecución: otro proceso con el mismo PID tendrá otra instancia
+        self._instancia = uuid.uuid4().hex
+        self._archivo_revisado = None
+
+    def _al_bifurcar(self):
+        """En el hijo de un fork: lo acumulado es del padre, que lo publica en su archivo"""
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._ultimo_volcado = 0.0
+        self._iniciar_proceso()
+
+    def incrementar(self, nombre, valor=1, **labels):
+        clave = (nombre, _clave_labels(labels))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+        self._volcar_si_corresponde()
+
+    def observar(self, nombre, valor, **labels):
+        buckets = DEFINICIONES[nombre][2]
+        clave = (nombre, _clave_labels(labels))
+        with self._lock:
+            hist = self._histogramas.get(clave)
+            if hist is None:
+                hist = self._histogramas[clave] = {'buckets': [0] * len(buckets), 'suma': 0.0, 'cuenta': 0}
+            for i, limite in enumerate(buckets):
+                if valor <= limite:
+                    hist['buckets'][i] += 1
+            hist['suma'] += valor
+            hist['cuenta'] += 1
+        self._volcar_si_corresponde()
+
+    def limpiar(self):
+        with self._lock:
+            self._contadores.clear()
+            self._histogramas.clear()
+
+    def _directorio(self):
+        return str(getattr(settings, 'METRICAS_DIR', ''))
+
+    def _archivo_propio(self):
+        return os.path.join(self._directorio(), f'metricas_{os.getpid()}.json')
+
+    def _serializar(self):
+        with self._lock:
+            return dict(_serializar(self._contadores, self._histogramas), instancia=self._instancia)
+
+    @contextmanager
+    def _bloqueo(self):
+        """Exclusión entre procesos para leer y modificar los totales"""
+        with open(os.path.join(self._directorio(), 'metricas.lock'), 'a') as archivo:
+            if fcntl is not None:
+                fcntl.flock(archivo, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(archivo, fcntl.LOCK_UN)
+
+    def _sumar_a_totales(self, estados, borrar=()):
+        """Suma `estados` a los totales y luego borra `borrar`; llamar con _bloqueo tomado"""
+        ruta_totales = os.path.join(self._directorio(), ARCHIVO_TOTALES)
+        totales = _leer(ruta_totales) or {}
+        _escribir(ruta_totales, _serializar(*_sumar([totales, *estados])))
+        for ruta in borrar:
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+
+    def _recoger(self, rutas):
+        """Pasa a los totales los archivos de procesos terminados; llamar con _bloqueo tomado"""
+        estados, recogidas = [], []
+        for ruta in rutas:
+            estado = _leer(ruta)
+            # Ya recogido por otro proceso, o escrito por esta misma instancia
+            if estado is None or estado.get('instancia') == self._instancia:
+                continue
+            estados.append(estado)
+            recogidas.append(ruta)
+        if recogidas:
+            self._sumar_a_totales(estados, borrar=recogidas)
+
+    def _volcar_si_corresponde(self):
+        intervalo = getattr(settings, 'METRICAS_INTERVALO_VOLCADO', 1.0)
+        if time.monotonic() - self._ultimo_volcado >= intervalo:
+            self.volcar()
+
+    def volcar(self):
+        """Escribe el estado del proceso de forma atómica (archivo temporal + rename)"""
+        directorio = self._directorio()
+        if not directorio:
+            return
+        self._ultimo_volcado = time.monotonic()
+        try:
+            os.makedirs(directorio, exist_ok=True)
+            destino = self._archivo_propio()
+            if self._archivo_revisado != destino:
+                # Un archivo con nuestro PID antes del primer volcado es de un proceso muerto
+                with self._bloqueo():
+                    self._recoger([destino])
+                self._archivo_revisado = destino
+            _escribir(destino, self._serializar())
+        except OSError:
+            # Las métricas nunca deben romper una petición
+            pass
+
+    def cerrar(self):
+        """Al salir: suma el estado propio a los totales y borra el archivo del proceso"""
+        directorio = self._directorio()
+        if not directorio:
+            return
+        try:
+            os.makedirs(directorio, exist_ok=True)
+            with self._bloqueo():
+                self._sumar_a_totales([self._serializar()], borrar=[self._archivo_propio()])
+            self.limpiar()
+        except OSError:
+            pass
+
+    def _estado_agregado(self):
+        """Suma el estado propio (en memoria), los totales y el de los demás procesos vivos"""
+        estados = [self._serializar()]
+        directorio = self._directorio()
+        if directorio and os.path.isdir(directorio):
+            propio = self._archivo_propio()
+            try:
+                with self._bloqueo():
+                    muertos, vivos = [], []
+                    for ruta in glob.glob(os.path.join(directorio, 'metricas_*.json')):
+                        coincidencia = PATRON_ARCHIVO.search(ruta)
+                        if coincidencia is None or ruta == propio:
+                            continue
+                        (vivos if _proceso_vivo(int(coincidencia.group(1))) else muertos).append(ruta)
+                    self._recoger(muertos)
+                    estados.append(_leer(os.path.join(directorio, ARCHIVO_TOTALES)) or {})
+                    estados.extend(filter(None, map(_leer, vivos)))
+            except OSError:
+                pass
+        return _sumar(estados)
+
+    def exposicion(self):
+        """Texto en formato de exposición de Prometheus (version 0.0.4)"""
+        contadores, histogramas = self._estado_agregado()
+        lineas = []
+        for nombre, (tipo, ayuda, buckets) in DEFINICIONES.items():
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            if tipo == 'counter':
+                for (n, labels), valor in sorted(contadores.items()):
+                    if n == nombre:
+                        lineas.append(f'{nombre}{_formatear_labels(labels)} {_formatear_valor(valor)}')
+            else:
+                for (n, labels), hist in sorted(histogramas.items()):
+                    if n != nombre:
+                        continue
+                    for limite, cuenta in zip(buckets, hist['buckets']):
+                        lineas.append(f'{nombre}_bucket{_formatear_labels(labels, le=limite)} {cuenta}')
+                    lineas.append(f'{nombre}_bucket{_formatear_labels(labels, le="+Inf")} {hist["cuenta"]}')
+                    lineas.append(f'{nombre}_sum{_formatear_labels(labels)} {_formatear_valor(hist["suma"])}')
+                    lineas.append(f'{nombre}_count{_formatear_labels(labels)} {hist["cuenta"]}')
+        return '\n'.join(lineas) + '\n'
+
+
+def _formatear_labels(labels, le=None):
+    pares = list(labels)
+    if le is not None:
+        pares.append(('le', str(le)))
+    if not pares:
+        return ''
+    contenido = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pares
+    )
+    return '{' + contenido + '}'
+
+
+def _formatear_valor(valor):
+    if isinstance(valor, float):
+        return repr(valor)
+    return str(valor)
+
+
+registro = RegistroMetricas()
+atexit.register(registro.cerrar)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registro._al_bifurcar)
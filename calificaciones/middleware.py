@@ -0,0 +1,96 @@
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.functional import SimpleLazyObject
+from django_otp import DEVICE_ID_SESSION_KEY
+from django_otp.middleware import is_verified
+
+from .estado_mfa import dispositivo_verificado
+from .metricas import registro as metricas
+from .perfilamiento import MuestraPeticion, muestra_actual, medir_sql, registro
+
+
+class PerfilamientoMiddleware:
+    """Registra tiempo total, SQL, render de templates y tamaño de respuesta
+    para una fracción de las peticiones (PERFILAMIENTO_TASA_MUESTREO)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        tasa = getattr(settings, 'PERFILAMIENTO_TASA_MUESTREO', 0)
+        if tasa <= 0 or random.random() >= tasa:
+            return self.get_response(request)
+
+        muestra = MuestraPeticion(request.method, request.path)
+        token = muestra_actual.set(muestra)
+        inicio = time.perf_counter()
+        try:
+            with connection.execute_wrapper(medir_sql):
+                response = self.get_response(request)
+        finally:
+            muestra.duracion_ms = (time.perf_counter() - inicio) * 1000
+            muestra_actual.reset(token)
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            muestra.vista = match.view_name
+        muestra.estado = response.status_code
+        if not response.streaming:
+            muestra.bytes_respuesta = len(response.content)
+        registro.agregar(muestra)
+        return response
+
+
+class MetricasMiddleware:
+    """Alimenta el histograma de latencia por vista y el contador de consultas SQL"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        consultas = [0]
+
+        def contar_sql(execute, sql, params, many, context):
+            consultas[0] += 1
+            return execute(sql, params, many, context)
+
+        inicio = time.perf_counter()
+        with connection.execute_wrapper(contar_sql):
+            response = self.get_response(request)
+        duracion = time.perf_counter() - inicio
+
+        match = getattr(request, 'resolver_match', None)
+        vista = match.url_name if match is not None and match.url_name else 'sin_ruta'
+        metricas.observar('nuam_vista_latencia_segundos', duracion, vista=vista)
+        if consultas[0]:
+            metricas.incrementar('nuam_db_consultas_total', consultas[0], vista=vista)
+        return response
+
+
+class VerificacionMFAMiddleware:
+    """Reemplaza a OTPMiddleware: deja en request.user.otp_device el dispositivo
+    verificado de la sesión (o None) tomando su estado de estado_mfa."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        usuario = getattr(request, 'user', None)
+        if usuario is not None:
+            request.user = SimpleLazyObject(functools.partial(self._verificar, request, usuario))
+        return self.get_response(request)
+
+    def _verificar(self, request, usuario):
+        usuario.otp_device = None
+        usuario.is_verified = functools.partial(is_verified, usuario)
+        if usuario.is_authenticated:
+            persistent_id = request.session.get(DEVICE_ID_SESSION_KEY)
+            if persistent_id:
+                usuario.otp_device = dispositivo_verificado(persistent_id, usuario.pk)
+                if usuario.otp_device is None:
+                    del request.session[DEVICE_ID_SESSION_KEY]
+        return usuario
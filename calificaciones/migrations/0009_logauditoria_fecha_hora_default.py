@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0008_alter_logauditoria_accion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='logauditoria',
+            name='fecha_hora',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0009_logauditoria_fecha_hora_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='logauditoria',
+            index=models.Index(fields=['accion', 'fecha_hora'], name='log_accion_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logauditoria',
+            index=models.Index(fields=['usuario_responsable', 'fecha_hora'], name='log_usuario_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logauditoria',
+            index=models.Index(fields=['id_calificacion', 'fecha_hora'], name='log_calif_fecha_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='logauditoria',
+            index=models.Index(fields=['fecha_hora', 'id_log'], name='log_fecha_id_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# Índice de texto completo sobre LOG_AUDITORIA.detalle:
+# - SQLite: tabla virtual FTS5 de contenido externo mantenida por triggers.
+# - PostgreSQL: índice GIN sobre to_tsvector('spanish', detalle).
+# Otros motores usan LIKE (ver calificaciones/busqueda_auditoria.py).
+
+SQLITE_CREAR = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS LOG_AUDITORIA_FTS USING fts5("
+    "detalle, content='LOG_AUDITORIA', content_rowid='id_log', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS LOG_AUDITORIA_FTS_AI AFTER INSERT ON LOG_AUDITORIA BEGIN "
+    "INSERT INTO LOG_AUDITORIA_FTS(rowid, detalle) VALUES (new.id_log, new.detalle); END",
+    "CREATE TRIGGER IF NOT EXISTS LOG_AUDITORIA_FTS_AD AFTER DELETE ON LOG_AUDITORIA BEGIN "
+    "INSERT INTO LOG_AUDITORIA_FTS(LOG_AUDITORIA_FTS, rowid, detalle) VALUES ('delete', old.id_log, old.detalle); END",
+    "CREATE TRIGGER IF NOT EXISTS LOG_AUDITORIA_FTS_AU AFTER UPDATE ON LOG_AUDITORIA BEGIN "
+    "INSERT INTO LOG_AUDITORIA_FTS(LOG_AUDITORIA_FTS, rowid, detalle) VALUES ('delete', old.id_log, old.detalle); "
+    "INSERT INTO LOG_AUDITORIA_FTS(rowid, detalle) VALUES (new.id_log, new.detalle); END",
+    "INSERT INTO LOG_AUDITORIA_FTS(LOG_AUDITORIA_FTS) VALUES ('rebuild')",
+]
+SQLITE_BORRAR = [
+    "DROP TRIGGER IF EXISTS LOG_AUDITORIA_FTS_AI",
+    "DROP TRIGGER IF EXISTS LOG_AUDITORIA_FTS_AD",
+    "DROP TRIGGER IF EXISTS LOG_AUDITORIA_FTS_AU",
+    "DROP TABLE IF EXISTS LOG_AUDITORIA_FTS",
+]
+POSTGRES_CREAR = [
+    'CREATE INDEX IF NOT EXISTS log_detalle_fts_idx ON "LOG_AUDITORIA" '
+    "USING GIN (to_tsvector('spanish', coalesce(detalle, '')))",
+]
+POSTGRES_BORRAR = ['DROP INDEX IF EXISTS log_detalle_fts_idx']
+
+
+def _ejecutar(schema_editor, sentencias):
+    for sql in sentencias:
+        schema_editor.execute(sql)
+
+
+def crear_indice_texto(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _ejecutar(schema_editor, SQLITE_CREAR)
+    elif vendor == 'postgresql':
+        _ejecutar(schema_editor, POSTGRES_CREAR)
+
+
+def borrar_indice_texto(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _ejecutar(schema_editor, SQLITE_BORRAR)
+    elif vendor == 'postgresql':
+        _ejecutar(schema_editor, POSTGRES_BORRAR)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0010_logauditoria_indices'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice_texto, borrar_indice_texto),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:07
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('calificaciones', '0011_logauditoria_busqueda_texto'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='usuario',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('correo'), name='usuario_correo_lower_uniq'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0012_usuario_correo_lower_uniq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BorradorCalificacion',
+            fields=[
+                ('id_borrador', models.AutoField(primary_key=True, serialize=False)),
+                ('clave', models.CharField(max_length=40)),
+                ('datos_basicos', models.JSONField(default=dict)),
+                ('montos', models.JSONField(default=dict)),
+                ('factores', models.JSONField(default=dict)),
+                ('expira', models.DateTimeField()),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Borrador de Calificación',
+                'verbose_name_plural': 'Borradores de Calificación',
+                'db_table': 'BORRADOR_CALIFICACION',
+                'indexes': [models.Index(fields=['expira'], name='borrador_expira_idx')],
+                'constraints': [models.UniqueConstraint(fields=('usuario', 'clave'), name='borrador_usuario_clave_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0013_borradorcalificacion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivocarga',
+            name='clave_idempotencia',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archivocarga',
+            name='tipo_archivo',
+            field=models.CharField(choices=[('DJ1948', 'DJ1948'), ('CSV_FACTORES', 'CSV_FACTORES'), ('NDJSON', 'NDJSON')], max_length=15),
+        ),
+        migrations.AddConstraint(
+            model_name='archivocarga',
+            constraint=models.UniqueConstraint(fields=('usuario_carga', 'clave_idempotencia'), name='archivo_carga_idempotencia_uniq'),
+        ),
+    ]
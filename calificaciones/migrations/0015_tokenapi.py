@@ -0,0 +1,34 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0014_archivocarga_idempotencia'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenApi',
+            fields=[
+                ('id_token', models.AutoField(primary_key=True, serialize=False)),
+                ('nombre', models.CharField(max_length=100)),
+                ('prefijo', models.CharField(max_length=16, unique=True)),
+                ('hash_token', models.CharField(max_length=64)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('ultimo_uso', models.DateTimeField(blank=True, null=True)),
+                ('expira', models.DateTimeField(blank=True, null=True)),
+                ('activo', models.BooleanField(default=True)),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens_api', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Token de API',
+                'verbose_name_plural': 'Tokens de API',
+                'db_table': 'TOKEN_API',
+            },
+        ),
+    ]
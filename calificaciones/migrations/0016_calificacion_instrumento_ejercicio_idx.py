@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0015_tokenapi'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='calificaciontributaria',
+            index=models.Index(fields=['instrumento', 'ejercicio'], name='calif_instrumento_ejer_idx'),
+        ),
+    ]
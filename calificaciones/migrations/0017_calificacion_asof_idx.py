@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0016_calificacion_instrumento_ejercicio_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='calificaciontributaria',
+            index=models.Index(fields=['instrumento', '-fecha_pago', '-secuencia_evento'], name='calif_asof_idx'),
+        ),
+    ]
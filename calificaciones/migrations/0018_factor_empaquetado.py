@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:34
+
+import struct
+from decimal import Decimal
+
+from django.db import migrations, models
+
+CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+TAMANO_LOTE = 2000
+# Copia del formato de calificaciones/factores_empaquetados.py al momento de esta
+# migración: 30 int64 little-endian en unidades de 10^-8, NULL como el mínimo de int64
+NULO = -2 ** 63
+
+
+def empaquetar(valores):
+    return struct.pack('<30q', *[NULO if valor is None else int(Decimal(str(valor)).scaleb(8)) for valor in valores])
+
+
+def empaquetar_existentes(apps, schema_editor):
+    """Llena factores_empaquetados a partir de las columnas anchas, por lotes"""
+    FactorCalificacion = apps.get_model('calificaciones', 'FactorCalificacion')
+    factores = FactorCalificacion.objects.using(schema_editor.connection.alias)
+    lote = []
+    for factor in factores.only('id_factor', *CAMPOS_FACTORES).order_by('id_factor').iterator(chunk_size=TAMANO_LOTE):
+        factor.factores_empaquetados = empaquetar([getattr(factor, campo) for campo in CAMPOS_FACTORES])
+        lote.append(factor)
+        if len(lote) >= TAMANO_LOTE:
+            factores.bulk_update(lote, ['factores_empaquetados'])
+            lote = []
+    if lote:
+        factores.bulk_update(lote, ['factores_empaquetados'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0017_calificacion_asof_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='factorcalificacion',
+            name='factores_empaquetados',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(empaquetar_existentes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0018_factor_empaquetado'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EscaneoIntegridad',
+            fields=[
+                ('id_escaneo', models.AutoField(primary_key=True, serialize=False)),
+                ('tipo', models.CharField(choices=[('COMPLETO', 'Completo'), ('INCREMENTAL', 'Incremental')], max_length=15)),
+                ('inicio', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fin', models.DateTimeField(blank=True, null=True)),
+                ('desde', models.DateTimeField(blank=True, null=True)),
+                ('filas_revisadas', models.IntegerField(default=0)),
+                ('violaciones', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Escaneo de Integridad',
+                'verbose_name_plural': 'Escaneos de Integridad',
+                'db_table': 'ESCANEO_INTEGRIDAD',
+            },
+        ),
+        migrations.CreateModel(
+            name='ViolacionIntegridad',
+            fields=[
+                ('id_violacion', models.AutoField(primary_key=True, serialize=False)),
+                ('regla', models.CharField(choices=[('SUMA_8_16', 'Suma de factores 8 a 16 mayor a 1'), ('FACTOR_NEGATIVO', 'Factor 8 a 19 negativo'), ('FACTOR_MAYOR_A_1', 'Factor 8 a 19 mayor a 1')], max_length=20)),
+                ('detalle', models.TextField()),
+                ('fecha_deteccion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('escaneo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='calificaciones.escaneointegridad')),
+                ('id_calificacion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='violaciones', to='calificaciones.calificaciontributaria')),
+            ],
+            options={
+                'verbose_name': 'Violación de Integridad',
+                'verbose_name_plural': 'Violaciones de Integridad',
+                'db_table': 'VIOLACION_INTEGRIDAD',
+                'indexes': [models.Index(fields=['regla', '-fecha_deteccion'], name='violacion_regla_fecha_idx')],
+                'constraints': [models.UniqueConstraint(fields=('id_calificacion', 'regla'), name='violacion_calificacion_regla_uniq')],
+            },
+        ),
+    ]
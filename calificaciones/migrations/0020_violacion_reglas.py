@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0019_integridad'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='violacionintegridad',
+            name='regla',
+            field=models.CharField(choices=[('SECUENCIA_MINIMA', 'Secuencia de evento menor o igual a 10.000'), ('FECHA_PAGO_ANTERIOR', 'Fecha de pago anterior al ejercicio'), ('SUMA_8_16', 'Suma de factores 8 a 16 mayor a 1'), ('FACTOR_NEGATIVO', 'Factor 8 a 19 negativo'), ('FACTOR_MAYOR_A_1', 'Factor 8 a 19 mayor a 1')], max_length=20),
+        ),
+    ]
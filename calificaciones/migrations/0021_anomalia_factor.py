@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0020_violacion_reglas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnomaliaFactor',
+            fields=[
+                ('id_anomalia', models.AutoField(primary_key=True, serialize=False)),
+                ('metodo', models.CharField(choices=[('MAD', 'Desviación robusta en su mercado y ejercicio'), ('EJERCICIO_ANTERIOR', 'Distancia al ejercicio anterior del instrumento')], max_length=20)),
+                ('puntaje', models.FloatField()),
+                ('detalle', models.TextField()),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('CONFIRMADA', 'Confirmada'), ('DESCARTADA', 'Descartada')], default='PENDIENTE', max_length=10)),
+                ('fecha_deteccion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_revision', models.DateTimeField(blank=True, null=True)),
+                ('id_calificacion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='anomalias', to='calificaciones.calificaciontributaria')),
+                ('revisado_por', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Anomalía de Factores',
+                'verbose_name_plural': 'Anomalías de Factores',
+                'db_table': 'ANOMALIA_FACTOR',
+                'indexes': [models.Index(fields=['estado', '-puntaje'], name='anomalia_estado_puntaje_idx')],
+                'constraints': [models.UniqueConstraint(fields=('id_calificacion', 'metodo'), name='anomalia_calificacion_metodo_uniq')],
+            },
+        ),
+    ]
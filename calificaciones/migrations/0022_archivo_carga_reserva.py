@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-19 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0021_anomalia_factor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivocarga',
+            name='fecha_reserva',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivocarga',
+            name='hash_cuerpo',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# Anula FACTOR_CALIFICACION.factores_empaquetados cuando un UPDATE cambia alguna
+# columna ancha sin reescribir la empaquetada (SQL manual, herramientas externas).
+# Los lectores completan esas filas desde las columnas anchas (ver
+# calificaciones/matriz_factores.py). save() y FactorCalificacionQuerySet
+# reescriben ambas, así que el trigger no las toca.
+
+CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+
+SQLITE_CREAR = [
+    "CREATE TRIGGER IF NOT EXISTS FACTOR_CALIFICACION_EMPAQUETADOS_AU AFTER UPDATE ON FACTOR_CALIFICACION "
+    "WHEN (" + ' OR '.join(f'old.{campo} IS NOT new.{campo}' for campo in CAMPOS_FACTORES) + ") "
+    "AND old.factores_empaquetados IS new.factores_empaquetados BEGIN "
+    "UPDATE FACTOR_CALIFICACION SET factores_empaquetados = NULL WHERE id_factor = new.id_factor; END",
+]
+SQLITE_BORRAR = ['DROP TRIGGER IF EXISTS FACTOR_CALIFICACION_EMPAQUETADOS_AU']
+POSTGRES_CREAR = [
+    "CREATE OR REPLACE FUNCTION factor_calificacion_empaquetados() RETURNS trigger AS $$ BEGIN "
+    "IF (" + ', '.join(f'NEW.{campo}' for campo in CAMPOS_FACTORES) + ") IS DISTINCT FROM ("
+    + ', '.join(f'OLD.{campo}' for campo in CAMPOS_FACTORES) + ") "
+    "AND NEW.factores_empaquetados IS NOT DISTINCT FROM OLD.factores_empaquetados THEN "
+    "NEW.factores_empaquetados := NULL; END IF; RETURN NEW; END $$ LANGUAGE plpgsql",
+    'CREATE TRIGGER factor_calificacion_empaquetados_bu BEFORE UPDATE ON "FACTOR_CALIFICACION" '
+    'FOR EACH ROW EXECUTE FUNCTION factor_calificacion_empaquetados()',
+]
+POSTGRES_BORRAR = [
+    'DROP TRIGGER IF EXISTS factor_calificacion_empaquetados_bu ON "FACTOR_CALIFICACION"',
+    'DROP FUNCTION IF EXISTS factor_calificacion_empaquetados()',
+]
+
+
+def _ejecutar(schema_editor, sentencias):
+    for sql in sentencias:
+        schema_editor.execute(sql)
+
+
+def crear_trigger(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _ejecutar(schema_editor, SQLITE_CREAR)
+    elif vendor == 'postgresql':
+        _ejecutar(schema_editor, POSTGRES_CREAR)
+
+
+def borrar_trigger(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _ejecutar(schema_editor, SQLITE_BORRAR)
+    elif vendor == 'postgresql':
+        _ejecutar(schema_editor, POSTGRES_BORRAR)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0022_archivo_carga_reserva'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_trigger, borrar_trigger),
+    ]
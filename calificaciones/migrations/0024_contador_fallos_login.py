@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-19 20:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0023_factores_empaquetados_trigger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContadorFallosLogin',
+            fields=[
+                ('clave', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('valor', models.IntegerField(default=0)),
+                ('expira', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Contador de Fallos de Login',
+                'verbose_name_plural': 'Contadores de Fallos de Login',
+                'db_table': 'CONTADOR_FALLOS_LOGIN',
+                'indexes': [models.Index(fields=['expira'], name='contador_fallos_expira_idx')],
+            },
+        ),
+    ]
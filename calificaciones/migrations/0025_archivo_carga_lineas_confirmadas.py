@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-19 20:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calificaciones', '0024_contador_fallos_login'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivocarga',
+            name='lineas_confirmadas',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,10 +1,15 @@
 from django.db import models
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Lower
 from django.core.validators import MinValueValidator, MaxValueValidator
 from decimal import Decimal
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.utils import timezone
 from datetime import timedelta
 from django_otp.plugins.otp_totp.models import TOTPDevice
+from .bloqueo import fallos_cuenta_pendientes, limpiar_fallos_cuenta, registrar_fallo_cuenta
+from .estado_mfa import mfa_habilitado
+from . import factores_empaquetados
 import logging
 
 logger = logging.getLogger(__name__)
@@ -20,6 +25,19 @@ class UsuarioManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def para_login(self, correo):
+        """Usuario por correo sin distinguir mayúsculas, con `tiene_mfa` anotado.
+
+        Una sola consulta que usa el índice funcional sobre LOWER(correo). Si los
+        contadores de fallos están en la base, anota también `tiene_fallos_login`.
+        """
+        mfa = TOTPDevice.objects.filter(user=OuterRef('pk'), confirmed=True)
+        consulta = self.alias(correo_normalizado=Lower('correo')).filter(correo_normalizado=correo.lower())
+        fallos = fallos_cuenta_pendientes()
+        if fallos is not None:
+            consulta = consulta.annotate(tiene_fallos_login=fallos)
+        return consulta.annotate(tiene_mfa=Exists(mfa)).first()
+
     def create_superuser(self, correo, password=None, **extra_fields):
         extra_fields.setdefault('is_staff', True)
         extra_fields.setdefault('is_superuser', True)
@@ -66,7 +84,10 @@ class Usuario(AbstractBaseUser, PermissionsMixin):
 
     def has_mfa_enabled(self):
         """Verifica si el usuario tiene MFA configurado"""
-        return TOTPDevice.objects.filter(user=self, confirmed=True).exists()
+        if hasattr(self, 'tiene_mfa'):
+            # Ya anotado por UsuarioManager.para_login
+            return self.tiene_mfa
+        return mfa_habilitado(self.pk)
     
     def get_mfa_device(self):
         """Obtiene el dispositivo MFA del usuario"""
@@ -94,6 +115,10 @@ class Usuario(AbstractBaseUser, PermissionsMixin):
         db_table = 'USUARIO'
         verbose_name = 'Usuario'
         verbose_name_plural = 'Usuarios'
+        constraints = [
+            # Índice funcional para el login sin distinguir mayúsculas
+            models.UniqueConstraint(Lower('correo'), name='usuario_correo_lower_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.nombre} ({self.rol})"
@@ -113,33 +138,39 @@ class Usuario(AbstractBaseUser, PermissionsMixin):
 
     def lock_account(self, lock_minutes=15):
         """Bloquea la cuenta por `lock_minutes` y resetea el contador de intentos."""
-        prev_attempts = self.failed_login_attempts or 0
         self.locked_until = timezone.now() + timedelta(minutes=lock_minutes)
-        # Opcional: resetear intentos después de bloquear para que el contador empiece desde 0
         self.failed_login_attempts = 0
-        self.save()
-        logger.info(f"Usuario {getattr(self, 'correo', self.pk)} bloqueado: prev_attempts={prev_attempts}, locked_until={self.locked_until}")
+        # UPDATE directo: no pisa otros campos si hay intentos concurrentes
+        Usuario.objects.filter(pk=self.pk).update(locked_until=self.locked_until, failed_login_attempts=0)
+        limpiar_fallos_cuenta(self.pk)
+        logger.info(f"Usuario {getattr(self, 'correo', self.pk)} bloqueado: locked_until={self.locked_until}")
 
     def increment_failed_login(self, threshold=3, lock_minutes=15):
         """Incrementa el contador de intentos fallidos y bloquea si alcanza el umbral.
 
+        El contador vive en el cache compartido o en CONTADOR_FALLOS_LOGIN (ver
+        calificaciones/bloqueo.py); solo el bloqueo escribe en USUARIO.
         Retorna True si la cuenta quedó bloqueada tras este incremento, False en caso contrario.
         """
-        prev = self.failed_login_attempts or 0
-        self.failed_login_attempts = prev + 1
-        locked = False
-        if self.failed_login_attempts >= threshold:
+        self.failed_login_attempts = registrar_fallo_cuenta(self.pk)
+        locked = self.failed_login_attempts >= threshold
+        if locked:
             self.lock_account(lock_minutes=lock_minutes)
-            locked = True
-        else:
-            self.save()
-        logger.info(f"Usuario {getattr(self, 'correo', self.pk)} intento fallido incrementado: prev={prev}, now={self.failed_login_attempts}, locked={locked}")
+        logger.info(f"Usuario {getattr(self, 'correo', self.pk)} intento fallido: locked={locked}")
         return locked
 
     def reset_failed_login(self):
+        """Limpia intentos y bloqueo; solo escribe en USUARIO si había un bloqueo.
+
+        Los contadores se borran salvo que `para_login` haya anotado que no hay.
+        """
+        if getattr(self, 'tiene_fallos_login', True):
+            limpiar_fallos_cuenta(self.pk)
+        if not self.failed_login_attempts and self.locked_until is None:
+            return
         self.failed_login_attempts = 0
         self.locked_until = None
-        self.save()
+        self.save(update_fields=['failed_login_attempts', 'locked_until'])
     
     @property
     def esta_activo(self):
@@ -157,6 +188,7 @@ class ArchivoCarga(models.Model):
     TIPO_ARCHIVO_OPCIONES = [
         ('DJ1948', 'DJ1948'),
         ('CSV_FACTORES', 'CSV_FACTORES'),
+        ('NDJSON', 'NDJSON'),
     ]
     
     ESTADO_PROCESO_OPCIONES = [
@@ -175,11 +207,26 @@ class ArchivoCarga(models.Model):
     registros_procesados = models.IntegerField(default=0)
     registros_error = models.IntegerField(default=0)
     errores_detalle = models.TextField(blank=True, null=True)
+    # Idempotency-Key de las cargas por API: un reintento del cliente no reprocesa datos
+    clave_idempotencia = models.CharField(max_length=255, null=True, blank=True)
+    # Reserva de la carga PENDIENTE: vencida (CARGA_RESERVA_SEGUNDOS) otro reintento la retoma
+    fecha_reserva = models.DateTimeField(null=True, blank=True)
+    # SHA-256 del cuerpo procesado: un reintento con la misma clave y otro cuerpo se rechaza.
+    # Mientras la carga no termina, es el hash del cuerpo hasta `lineas_confirmadas`
+    hash_cuerpo = models.CharField(max_length=64, null=True, blank=True)
+    # Última línea NDJSON cuyo lote quedó confirmado: un reintento tras un fallo sigue desde ahí
+    lineas_confirmadas = models.IntegerField(default=0)
 
     class Meta:
         db_table = 'ARCHIVO_CARGA'
         verbose_name = 'Archivo de Carga'
         verbose_name_plural = 'Archivos de Carga'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['usuario_carga', 'clave_idempotencia'],
+                name='archivo_carga_idempotencia_uniq',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.nombre_archivo} ({self.get_tipo_archivo_display()})"
@@ -235,23 +282,52 @@ class CalificacionTributaria(models.Model):
         verbose_name_plural = 'Calificaciones Tributarias'
         unique_together = ['ejercicio', 'mercado', 'instrumento', 'secuencia_evento']
         ordering = ['-ejercicio', 'mercado', 'instrumento']
+        indexes = [
+            # Consulta de factores por (instrumento, ejercicio), ver consulta_factores.py
+            models.Index(fields=['instrumento', 'ejercicio'], name='calif_instrumento_ejer_idx'),
+            # Calificación vigente a una fecha (as-of)
+            models.Index(fields=['instrumento', '-fecha_pago', '-secuencia_evento'], name='calif_asof_idx'),
+        ]
 
     def __str__(self):
         return f"{self.instrumento} - {self.ejercicio} - {self.get_mercado_display()}"
 
     def validar_suma_factores(self):
         """Valida que la suma de los factores del 8 al 16 no supere 1"""
+        from .reglas import REGLAS, validar
+
         try:
             factores = self.factorcalificacion
-            factores_sum = sum([
-                factores.factor_8 or 0, factores.factor_9 or 0, factores.factor_10 or 0,
-                factores.factor_11 or 0, factores.factor_12 or 0, factores.factor_13 or 0,
-                factores.factor_14 or 0, factores.factor_15 or 0, factores.factor_16 or 0
-            ])
-            return factores_sum <= Decimal('1.0')
+            suma = [regla for regla in REGLAS if regla.codigo == 'SUMA_8_16']
+            return not validar({campo: getattr(factores, campo) for campo in FactorCalificacion.CAMPOS_FACTORES}, suma)
         except FactorCalificacion.DoesNotExist:
             return True
 
+class FactorCalificacionQuerySet(models.QuerySet):
+    """Mantiene factores_empaquetados en las escrituras que no pasan por save()"""
+
+    def update(self, **kwargs):
+        # Los valores nuevos pueden ser expresiones (F, Case): la fila queda sin
+        # empaquetar y los lectores la completan desde las columnas anchas
+        if 'factores_empaquetados' not in kwargs and set(kwargs) & set(self.model.CAMPOS_FACTORES):
+            kwargs['factores_empaquetados'] = None
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.empaquetar()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if set(fields) & set(self.model.CAMPOS_FACTORES):
+            objs = list(objs)
+            for obj in objs:
+                obj.empaquetar()
+            fields = list(dict.fromkeys([*fields, 'factores_empaquetados']))
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+
 class FactorCalificacion(models.Model):
     """Modelo FACTOR_CALIFICACION según estructura PostgreSQL"""
     id_factor = models.AutoField(primary_key=True)
@@ -294,27 +370,76 @@ class FactorCalificacion(models.Model):
     factor_37 = models.DecimalField(max_digits=9, decimal_places=8, null=True, blank=True)
     
     fecha_calculo = models.DateTimeField(auto_now_add=True)
+    # Copia empaquetada de factor_8..factor_37 (ver factores_empaquetados.py); la
+    # mantienen save() y FactorCalificacionQuerySet, y un trigger (migración 0023)
+    # la anula si otro UPDATE cambia las columnas anchas, que siguen siendo la fuente
+    factores_empaquetados = models.BinaryField(null=True, blank=True, editable=False)
+
+    CAMPOS_FACTORES = [f'factor_{i}' for i in range(8, 38)]
+
+    objects = FactorCalificacionQuerySet.as_manager()
 
     class Meta:
         db_table = 'FACTOR_CALIFICACION'
         verbose_name = 'Factor de Calificación'
         verbose_name_plural = 'Factores de Calificación'
 
+    def empaquetar(self):
+        self.factores_empaquetados = factores_empaquetados.empaquetar(
+            [getattr(self, campo) for campo in self.CAMPOS_FACTORES]
+        )
+
+    def vector(self):
+        """Factores como vector NumPy int64 en unidades de 1e-8 (NULL = factores_empaquetados.NULO)"""
+        if self.factores_empaquetados is None:
+            self.empaquetar()
+        return factores_empaquetados.desempaquetar(self.factores_empaquetados)
+
+    def save(self, *args, **kwargs):
+        self.empaquetar()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(self.CAMPOS_FACTORES):
+            kwargs['update_fields'] = set(update_fields) | {'factores_empaquetados'}
+        super().save(*args, **kwargs)
+
     def clean(self):
-        """Validación de que la suma de factores 8-16 no supere 1"""
+        """Reglas de factores compartidas (reglas.py): rango de 8..19 y suma de 8..16"""
         from django.core.exceptions import ValidationError
-        
-        factores_sum = sum([
-            self.factor_8 or 0, self.factor_9 or 0, self.factor_10 or 0,
-            self.factor_11 or 0, self.factor_12 or 0, self.factor_13 or 0,
-            self.factor_14 or 0, self.factor_15 or 0, self.factor_16 or 0
-        ])
-        
-        if factores_sum > Decimal('1.0'):
-            raise ValidationError(
-                f"La suma de los factores del 8 al 16 no puede superar 1. "
-                f"Suma actual: {factores_sum:.8f}"
-            )
+        from .reglas import validar
+
+        errores = validar({campo: getattr(self, campo) for campo in self.CAMPOS_FACTORES})
+        if errores:
+            raise ValidationError(errores)
+
+class LogAuditoriaManager(models.Manager):
+    def preparar(self, eventos):
+        """Construye instancias sin guardar con `usuario_nombre` ya resuelto.
+
+        Cada evento es un dict con campos del modelo; el usuario puede venir como
+        `usuario_responsable` (instancia) o `usuario_responsable_id`. Los nombres que
+        falten se obtienen con una sola consulta para todo el lote.
+        """
+        logs = [self.model(**evento) for evento in eventos]
+        faltantes = {
+            log.usuario_responsable_id for log in logs
+            if not log.usuario_nombre and not LogAuditoria.usuario_responsable.is_cached(log)
+        }
+        nombres = dict(Usuario.objects.filter(pk__in=faltantes).values_list('pk', 'nombre')) if faltantes else {}
+        for log in logs:
+            if log.usuario_nombre:
+                continue
+            if LogAuditoria.usuario_responsable.is_cached(log):
+                log.usuario_nombre = log.usuario_responsable.nombre
+            else:
+                log.usuario_nombre = nombres.get(log.usuario_responsable_id)
+        return logs
+
+    def log_many(self, eventos, batch_size=None):
+        """Inserta varios eventos de auditoría con un bulk_create"""
+        logs = self.preparar(eventos)
+        self.bulk_create(logs, batch_size=batch_size)
+        return logs
+
 
 class LogAuditoria(models.Model):
     ACCION_OPCIONES = [
@@ -331,7 +456,8 @@ class LogAuditoria(models.Model):
     ]
     
     id_log = models.AutoField(primary_key=True)
-    fecha_hora = models.DateTimeField(auto_now_add=True)
+    # default en lugar de auto_now_add: los logs encolados conservan la hora del evento
+    fecha_hora = models.DateTimeField(default=timezone.now, editable=False)
     accion = models.CharField(max_length=50, choices=ACCION_OPCIONES)
     usuario_responsable = models.ForeignKey(Usuario, on_delete=models.RESTRICT)
     usuario_nombre = models.CharField(max_length=150, null=True, blank=True, help_text='Nombre del usuario responsable al momento del log')
@@ -344,22 +470,190 @@ class LogAuditoria(models.Model):
     detalle = models.TextField(blank=True, null=True)
     ip_origen = models.GenericIPAddressField(null=True, blank=True)
 
+    objects = LogAuditoriaManager()
+
     class Meta:
         db_table = 'LOG_AUDITORIA'
         verbose_name = 'Log de Auditoría'
         verbose_name_plural = 'Logs de Auditoría'
         ordering = ['-fecha_hora']
+        indexes = [
+            models.Index(fields=['accion', 'fecha_hora'], name='log_accion_fecha_idx'),
+            models.Index(fields=['usuario_responsable', 'fecha_hora'], name='log_usuario_fecha_idx'),
+            models.Index(fields=['id_calificacion', 'fecha_hora'], name='log_calif_fecha_idx'),
+            models.Index(fields=['fecha_hora', 'id_log'], name='log_fecha_id_idx'),
+        ]
 
     def __str__(self):
         user_label = self.usuario_nombre or str(self.usuario_responsable)
         return f"{self.accion} - {user_label} - {self.fecha_hora}"
 
     def save(self, *args, **kwargs):
-        # Auto-populate `usuario_nombre` from the FK if not explicitly provided
-        if self.usuario_responsable and not self.usuario_nombre:
-            try:
-                self.usuario_nombre = str(self.usuario_responsable.nombre)
-            except Exception:
-                # If any issue, leave usuario_nombre as-is (None or existing value)
-                pass
-        super().save(*args, **kwargs)
\ No newline at end of file
+        # Solo se desnormaliza si el usuario ya está cargado, para no disparar un SELECT
+        # por insert. Para logs creados a partir de ids usar LogAuditoria.objects.log_many()
+        if not self.usuario_nombre and LogAuditoria.usuario_responsable.is_cached(self):
+            self.usuario_nombre = self.usuario_responsable.nombre
+        super().save(*args, **kwargs)
+
+
+class BorradorCalificacion(models.Model):
+    """Datos intermedios del asistente de creación/edición (ver calificaciones/borradores.py)"""
+    id_borrador = models.AutoField(primary_key=True)
+    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE)
+    # 'crear' o 'editar:<id_calificacion>'
+    clave = models.CharField(max_length=40)
+    datos_basicos = models.JSONField(default=dict)
+    montos = models.JSONField(default=dict)
+    factores = models.JSONField(default=dict)
+    expira = models.DateTimeField()
+
+    class Meta:
+        db_table = 'BORRADOR_CALIFICACION'
+        verbose_name = 'Borrador de Calificación'
+        verbose_name_plural = 'Borradores de Calificación'
+        constraints = [
+            models.UniqueConstraint(fields=['usuario', 'clave'], name='borrador_usuario_clave_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['expira'], name='borrador_expira_idx'),
+        ]
+
+    def __str__(self):
+        return f"Borrador {self.clave} de {self.usuario_id}"
+
+class ContadorFallosLogin(models.Model):
+    """Contadores de calificaciones/bloqueo.py cuando el cache no se comparte entre procesos"""
+    clave = models.CharField(max_length=255, primary_key=True)
+    valor = models.IntegerField(default=0)
+    expira = models.DateTimeField()
+
+    class Meta:
+        db_table = 'CONTADOR_FALLOS_LOGIN'
+        verbose_name = 'Contador de Fallos de Login'
+        verbose_name_plural = 'Contadores de Fallos de Login'
+        indexes = [
+            models.Index(fields=['expira'], name='contador_fallos_expira_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.clave} = {self.valor}"
+
+class TokenApi(models.Model):
+    """Token de API de un usuario para clientes automatizados (ver calificaciones/tokens_api.py)"""
+    id_token = models.AutoField(primary_key=True)
+    usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, related_name='tokens_api')
+    nombre = models.CharField(max_length=100)
+    # Parte pública del token, indexada para resolverlo con una sola consulta
+    prefijo = models.CharField(max_length=16, unique=True)
+    # HMAC-SHA256 del token completo; el token en claro no se guarda
+    hash_token = models.CharField(max_length=64)
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    ultimo_uso = models.DateTimeField(null=True, blank=True)
+    expira = models.DateTimeField(null=True, blank=True)
+    activo = models.BooleanField(default=True)
+
+    class Meta:
+        db_table = 'TOKEN_API'
+        verbose_name = 'Token de API'
+        verbose_name_plural = 'Tokens de API'
+
+    def __str__(self):
+        return f"{self.nombre} ({self.prefijo}) de {self.usuario_id}"
+
+class EscaneoIntegridad(models.Model):
+    """Ejecución del escáner de integridad de factores (ver calificaciones/integridad.py)"""
+    TIPO_OPCIONES = [
+        ('COMPLETO', 'Completo'),
+        ('INCREMENTAL', 'Incremental'),
+    ]
+
+    id_escaneo = models.AutoField(primary_key=True)
+    tipo = models.CharField(max_length=15, choices=TIPO_OPCIONES)
+    inicio = models.DateTimeField(default=timezone.now)
+    fin = models.DateTimeField(null=True, blank=True)
+    # Calificaciones con fecha_modificacion >= desde (None en los completos)
+    desde = models.DateTimeField(null=True, blank=True)
+    filas_revisadas = models.IntegerField(default=0)
+    violaciones = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'ESCANEO_INTEGRIDAD'
+        verbose_name = 'Escaneo de Integridad'
+        verbose_name_plural = 'Escaneos de Integridad'
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} {self.inicio:%Y-%m-%d %H:%M}"
+
+    @property
+    def segundos(self):
+        return (self.fin - self.inicio).total_seconds() if self.fin else None
+
+
+class ViolacionIntegridad(models.Model):
+    """Regla de reglas.py incumplida por una calificación activa, según el último escaneo que la revisó"""
+    REGLA_OPCIONES = [
+        ('SECUENCIA_MINIMA', 'Secuencia de evento menor o igual a 10.000'),
+        ('FECHA_PAGO_ANTERIOR', 'Fecha de pago anterior al ejercicio'),
+        ('SUMA_8_16', 'Suma de factores 8 a 16 mayor a 1'),
+        ('FACTOR_NEGATIVO', 'Factor 8 a 19 negativo'),
+        ('FACTOR_MAYOR_A_1', 'Factor 8 a 19 mayor a 1'),
+    ]
+
+    id_violacion = models.AutoField(primary_key=True)
+    id_calificacion = models.ForeignKey(CalificacionTributaria, on_delete=models.CASCADE, related_name='violaciones')
+    regla = models.CharField(max_length=20, choices=REGLA_OPCIONES)
+    detalle = models.TextField()
+    escaneo = models.ForeignKey(EscaneoIntegridad, on_delete=models.SET_NULL, null=True, blank=True)
+    fecha_deteccion = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'VIOLACION_INTEGRIDAD'
+        verbose_name = 'Violación de Integridad'
+        verbose_name_plural = 'Violaciones de Integridad'
+        constraints = [
+            models.UniqueConstraint(fields=['id_calificacion', 'regla'], name='violacion_calificacion_regla_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['regla', '-fecha_deteccion'], name='violacion_regla_fecha_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.regla} en {self.id_calificacion_id}"
+
+
+class AnomaliaFactor(models.Model):
+    """Calificación cuyo vector de factores se aparta de su grupo o de su ejercicio anterior
+    (ver calificaciones/anomalias.py), pendiente de revisión"""
+    METODO_OPCIONES = [
+        ('MAD', 'Desviación robusta en su mercado y ejercicio'),
+        ('EJERCICIO_ANTERIOR', 'Distancia al ejercicio anterior del instrumento'),
+    ]
+    ESTADO_OPCIONES = [
+        ('PENDIENTE', 'Pendiente'),
+        ('CONFIRMADA', 'Confirmada'),
+        ('DESCARTADA', 'Descartada'),
+    ]
+
+    id_anomalia = models.AutoField(primary_key=True)
+    id_calificacion = models.ForeignKey(CalificacionTributaria, on_delete=models.CASCADE, related_name='anomalias')
+    metodo = models.CharField(max_length=20, choices=METODO_OPCIONES)
+    puntaje = models.FloatField()
+    detalle = models.TextField()
+    estado = models.CharField(max_length=10, choices=ESTADO_OPCIONES, default='PENDIENTE')
+    fecha_deteccion = models.DateTimeField(default=timezone.now)
+    revisado_por = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    fecha_revision = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'ANOMALIA_FACTOR'
+        verbose_name = 'Anomalía de Factores'
+        verbose_name_plural = 'Anomalías de Factores'
+        constraints = [
+            models.UniqueConstraint(fields=['id_calificacion', 'metodo'], name='anomalia_calificacion_metodo_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['estado', '-puntaje'], name='anomalia_estado_puntaje_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.metodo} en {self.id_calificacion_id} ({self.estado})"
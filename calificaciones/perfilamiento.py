@@ -0,0 +1,148 @@
+"""
+Perfilamiento de peticiones en producción (sin DEBUG).
+
+Las muestras se guardan en un buffer circular acotado en memoria del proceso,
+por lo que cada worker de gunicorn mantiene su propio reporte.
+"""
+import math
+import threading
+import time
+from collections import deque, defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template
+
+# Muestra de la petición en curso (None si la petición no fue muestreada)
+muestra_actual = ContextVar('muestra_actual', default=None)
+
+
+class MuestraPeticion:
+    """Métricas recolectadas para una petición muestreada"""
+    __slots__ = ('vista', 'metodo', 'ruta', 'estado', 'inicio', 'duracion_ms',
+                 'sql_total', 'sql_ms', 'sql_lentos', 'template_ms', 'bytes_respuesta')
+
+    def __init__(self, metodo, ruta):
+        self.vista = None
+        self.metodo = metodo
+        self.ruta = ruta
+        self.estado = None
+        self.inicio = time.time()
+        self.duracion_ms = 0.0
+        self.sql_total = 0
+        self.sql_ms = 0.0
+        self.sql_lentos = []
+        self.template_ms = 0.0
+        self.bytes_respuesta = 0
+
+    def registrar_sql(self, sql, duracion_ms):
+        self.sql_total += 1
+        self.sql_ms += duracion_ms
+        # Conservar solo las N consultas más lentas de la petición
+        max_sql = getattr(settings, 'PERFILAMIENTO_SQL_POR_MUESTRA', 5)
+        self.sql_lentos.append((duracion_ms, sql))
+        if len(self.sql_lentos) > max_sql:
+            self.sql_lentos.sort(key=lambda item: item[0], reverse=True)
+            del self.sql_lentos[max_sql:]
+
+
+def percentil(valores_ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not valores_ordenados:
+        return 0.0
+    k = max(0, min(len(valores_ordenados) - 1, math.ceil(p / 100.0 * len(valores_ordenados)) - 1))
+    return valores_ordenados[k]
+
+
+class RegistroRendimiento:
+    """Buffer circular thread-safe con las últimas muestras"""
+
+    def __init__(self, max_muestras=1000):
+        self._lock = threading.Lock()
+        self._muestras = deque(maxlen=max_muestras)
+
+    def agregar(self, muestra):
+        with self._lock:
+            self._muestras.append(muestra)
+
+    def limpiar(self):
+        with self._lock:
+            self._muestras.clear()
+
+    def muestras(self):
+        with self._lock:
+            return list(self._muestras)
+
+    def resumen_por_vista(self):
+        """Agrupa las muestras por vista y calcula p50/p95/p99"""
+        grupos = defaultdict(list)
+        for m in self.muestras():
+            grupos[m.vista or m.ruta].append(m)
+
+        resumen = []
+        for vista, muestras in grupos.items():
+            tiempos = sorted(m.duracion_ms for m in muestras)
+            n = len(muestras)
+            resumen.append({
+                'vista': vista,
+                'peticiones': n,
+                'p50': percentil(tiempos, 50),
+                'p95': percentil(tiempos, 95),
+                'p99': percentil(tiempos, 99),
+                'max': tiempos[-1],
+                'sql_promedio': sum(m.sql_total for m in muestras) / n,
+                'sql_ms_promedio': sum(m.sql_ms for m in muestras) / n,
+                'template_ms_promedio': sum(m.template_ms for m in muestras) / n,
+                'bytes_promedio': sum(m.bytes_respuesta for m in muestras) / n,
+            })
+        resumen.sort(key=lambda r: r['p95'], reverse=True)
+        return resumen
+
+    def sql_mas_lentos(self, limite=10):
+        """Sentencias SQL más lentas de todas las muestras"""
+        candidatos = []
+        for m in self.muestras():
+            for duracion_ms, sql in m.sql_lentos:
+                candidatos.append({'vista': m.vista or m.ruta, 'duracion_ms': duracion_ms, 'sql': sql})
+        candidatos.sort(key=lambda c: c['duracion_ms'], reverse=True)
+        return candidatos[:limite]
+
+
+registro = RegistroRendimiento(max_muestras=getattr(settings, 'PERFILAMIENTO_MAX_MUESTRAS', 1000))
+
+
+def medir_sql(execute, sql, params, many, context):
+    """Wrapper para connection.execute_wrapper que acumula tiempo SQL en la muestra actual"""
+    muestra = muestra_actual.get()
+    if muestra is None:
+        return execute(sql, params, many, context)
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        muestra.registrar_sql(sql, (time.perf_counter() - inicio) * 1000)
+
+
+class TemplatePerfilado(Template):
+    """Template que suma su tiempo de render a la muestra actual"""
+
+    def render(self, context=None, request=None):
+        muestra = muestra_actual.get()
+        if muestra is None:
+            return super().render(context, request)
+        inicio = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            muestra.template_ms += (time.perf_counter() - inicio) * 1000
+
+
+class DjangoTemplatesPerfilados(DjangoTemplates):
+    """Backend de templates de Django que mide el tiempo de render"""
+
+    def from_string(self, template_code):
+        return TemplatePerfilado(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        original = super().get_template(template_name)
+        return TemplatePerfilado(original.template, self)
@@ -0,0 +1,106 @@
+"""
+Generación del QR de enrolamiento MFA con cache LRU acotado y TTL.
+
+El QR se sirve desde /mfa/qr/ (vista mfa_qr) en vez de incrustarse en base64,
+así recargas y reintentos durante el enrolamiento no vuelven a renderizarlo.
+"""
+import base64
+import hashlib
+import re
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+
+EMISOR = 'NUAM Calificaciones'
+
+
+class LRUConTTL:
+    """Diccionario acotado: descarta lo menos usado y las entradas vencidas"""
+
+    def __init__(self, maximo=256, ttl=600):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            valor, vence = entrada
+            if vence < time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.maximo:
+                self._datos.popitem(last=False)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+
+cache_qr = LRUConTTL()
+
+
+def secreto_base32(device):
+    """Secreto Base32 para apps autenticadoras, tolerando claves no hexadecimales"""
+    try:
+        return base64.b32encode(device.bin_key).decode('utf-8').strip('=').upper()
+    except Exception:
+        raw_key = str(getattr(device, 'key', '') or '').strip()
+        if not raw_key:
+            return ''
+        # Si ya parece Base32 (A-Z2-7) se usa normalizada
+        if re.fullmatch(r'[A-Z2-7]+=*', raw_key.upper()):
+            return raw_key.upper().strip('=')
+        return base64.b32encode(raw_key.encode('utf-8')).decode('utf-8').strip('=').upper()
+
+
+def url_otpauth(secreto, cuenta, emisor=EMISOR):
+    return (
+        f"otpauth://totp/{urllib.parse.quote(emisor)}:{urllib.parse.quote(cuenta)}"
+        f"?secret={secreto}&issuer={urllib.parse.quote(emisor)}&digits=6&algorithm=SHA1&period=30"
+    )
+
+
+def version_qr(otpauth):
+    """Hash del contenido del QR; sirve de clave de cache y de ETag"""
+    return hashlib.sha256(otpauth.encode('utf-8')).hexdigest()[:32]
+
+
+def _renderizar(otpauth):
+    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
+    qr.add_data(otpauth)
+    buffer = BytesIO()
+    try:
+        # PNG vía Pillow si está disponible
+        qr.make_image(fill_color='black', back_color='white').save(buffer, format='PNG')
+        return buffer.getvalue(), 'image/png'
+    except Exception:
+        # Sin Pillow: SVG (sin dependencia de PIL)
+        from qrcode.image.svg import SvgImage
+        buffer = BytesIO()
+        qr.make_image(image_factory=SvgImage).save(buffer)
+        return buffer.getvalue(), 'image/svg+xml'
+
+
+def imagen_qr(otpauth):
+    """Retorna (contenido, content_type, version) usando el cache LRU"""
+    version = version_qr(otpauth)
+    imagen = cache_qr.obtener(version)
+    if imagen is None:
+        imagen = _renderizar(otpauth)
+        cache_qr.guardar(version, imagen)
+    return imagen[0], imagen[1], version
@@ -0,0 +1,173 @@
+"""
+Reglas de validación de calificaciones y factores, declaradas una sola vez.
+
+REGLAS es la única fuente de las reglas de negocio que antes estaban repartidas
+entre CalificacionTributariaForm, FactoresForm, FactorCalificacion.clean y la
+carga por lotes. Cada regla se evalúa de dos formas con la misma semántica:
+
+- `validar(valores)`: un registro (dict de campo a int/Decimal/date/None), para
+  formularios, el modelo y la carga fila a fila.
+- `validar_columnas(df)`: un DataFrame con una fila por registro, para la carga
+  por lotes y el escáner de integridad; cada regla es una operación sobre
+  columnas completas.
+
+Una regla solo se aplica si el registro (o el DataFrame) trae todos sus campos.
+Los decimales se comparan como enteros en punto fijo según ESCALAS: el registro
+se convierte al evaluarlo y el DataFrame debe traerlos ya escalados, así la suma
+de factores es exacta en ambos casos. Los nulos no violan los límites y cuentan
+como 0 en las sumas.
+"""
+from decimal import Decimal
+
+import pandas as pd
+
+NO_CAMPO = '__all__'
+ESCALAS = {f'factor_{i}': 8 for i in range(8, 38)}
+FACTORES_RANGO = [f'factor_{i}' for i in range(8, 20)]
+FACTORES_SUMA = [f'factor_{i}' for i in range(8, 17)]
+
+
+def _unidades(campo, valor):
+    """Valor de un registro en las unidades de comparación del campo"""
+    escala = ESCALAS.get(campo)
+    if valor is None or escala is None:
+        return valor
+    # Redondea como al guardar en el DecimalField (quantize); truncar podría aceptar lo que la BD redondea
+    return int(Decimal(str(valor)).quantize(Decimal(1).scaleb(-escala)).scaleb(escala))
+
+
+def _texto(campo, valor):
+    """Valor en unidades de comparación, para mostrarlo en un detalle"""
+    if valor is None or pd.isna(valor):
+        return 'vacío'
+    escala = ESCALAS.get(campo)
+    if escala is not None:
+        return str(Decimal(int(valor)).scaleb(-escala))
+    if hasattr(valor, 'date'):
+        return valor.date().isoformat()
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+class Regla:
+    """Base de las reglas. `campo_error` es el campo que recibe el mensaje."""
+
+    def __init__(self, codigo, campos, mensaje, campo_error):
+        self.codigo = codigo
+        self.campos = list(campos)
+        self.mensaje = mensaje
+        self.campo_error = campo_error
+
+    def escalar(self, valores):
+        """True si el registro (ya en unidades) viola la regla"""
+        raise NotImplementedError
+
+    def vectorial(self, df):
+        """Serie booleana con las filas que violan la regla"""
+        raise NotImplementedError
+
+    def describir(self, fila):
+        """Texto con los valores que causaron la violación"""
+        return ', '.join(f'{campo} = {_texto(campo, fila[campo])}' for campo in self.campos)
+
+
+class Minimo(Regla):
+    """campo >= limite (o > limite si `estricto`)"""
+
+    def __init__(self, codigo, campo, limite, mensaje, estricto=False):
+        super().__init__(codigo, [campo], mensaje, campo)
+        self.limite = _unidades(campo, limite)
+        self.estricto = estricto
+
+    def escalar(self, valores):
+        valor = valores[self.campo_error]
+        if valor is None:
+            return False
+        return valor <= self.limite if self.estricto else valor < self.limite
+
+    def vectorial(self, df):
+        columna = df[self.campo_error]
+        return columna <= self.limite if self.estricto else columna < self.limite
+
+
+class Maximo(Regla):
+    """campo <= limite"""
+
+    def __init__(self, codigo, campo, limite, mensaje):
+        super().__init__(codigo, [campo], mensaje, campo)
+        self.limite = _unidades(campo, limite)
+
+    def escalar(self, valores):
+        valor = valores[self.campo_error]
+        return valor is not None and valor > self.limite
+
+    def vectorial(self, df):
+        return df[self.campo_error] > self.limite
+
+
+class SumaMaxima(Regla):
+    """La suma de `campos` (nulos como 0) no supera `limite`"""
+
+    def __init__(self, codigo, campos, limite, mensaje, etiqueta):
+        super().__init__(codigo, campos, mensaje, NO_CAMPO)
+        self.limite = _unidades(campos[0], limite)
+        self.etiqueta = etiqueta
+
+    def escalar(self, valores):
+        return sum(valores[campo] or 0 for campo in self.campos) > self.limite
+
+    def vectorial(self, df):
+        return df[self.campos].fillna(0).sum(axis=1) > self.limite
+
+    def describir(self, fila):
+        suma = sum(0 if pd.isna(fila[campo]) else int(fila[campo]) for campo in self.campos)
+        return f'Suma de {self.etiqueta} = {_texto(self.campos[0], suma)}'
+
+
+class FechaDesdeEjercicio(Regla):
+    """La fecha no es anterior al 1 de enero del ejercicio"""
+
+    def __init__(self, codigo, campo_fecha, campo_ejercicio, mensaje):
+        super().__init__(codigo, [campo_fecha, campo_ejercicio], mensaje, campo_fecha)
+        self.campo_ejercicio = campo_ejercicio
+
+    def escalar(self, valores):
+        fecha, ejercicio = valores[self.campo_error], valores[self.campo_ejercicio]
+        return fecha is not None and ejercicio is not None and fecha.year < int(ejercicio)
+
+    def vectorial(self, df):
+        # df[campo_fecha] debe ser datetime64; NaT y NaN no violan
+        return df[self.campo_error].dt.year < df[self.campo_ejercicio]
+
+
+REGLAS = [
+    Minimo('SECUENCIA_MINIMA', 'secuencia_evento', 10000, 'La secuencia debe ser superior a 10.000', estricto=True),
+    FechaDesdeEjercicio('FECHA_PAGO_ANTERIOR', 'fecha_pago', 'ejercicio',
+                        'La fecha de pago no puede ser anterior al inicio del ejercicio.'),
+    *[Minimo('FACTOR_NEGATIVO', campo, 0, 'El factor no puede ser negativo') for campo in FACTORES_RANGO],
+    *[Maximo('FACTOR_MAYOR_A_1', campo, 1, 'El factor no puede ser mayor a 1') for campo in FACTORES_RANGO],
+    SumaMaxima('SUMA_8_16', FACTORES_SUMA, 1, 'La suma de los factores del 8 al 16 no puede ser mayor a 1.00000000',
+               etiqueta='factores 8 a 16'),
+]
+
+
+def validar(valores, reglas=REGLAS):
+    """Errores {campo: [mensajes]} de un registro; NO_CAMPO para los que no son de un campo"""
+    presentes = set(valores)
+    unidades = {campo: _unidades(campo, valor) for campo, valor in valores.items()}
+    errores = {}
+    for regla in reglas:
+        if presentes.issuperset(regla.campos) and regla.escalar(unidades):
+            errores.setdefault(regla.campo_error, []).append(regla.mensaje)
+    return errores
+
+
+def validar_columnas(df, reglas=REGLAS):
+    """Lista de (regla, Serie booleana de filas que la violan) para las reglas aplicables a `df`"""
+    columnas = set(df.columns)
+    return [
+        (regla, regla.vectorial(df).fillna(False).astype(bool))
+        for regla in reglas
+        if columnas.issuperset(regla.campos)
+    ]
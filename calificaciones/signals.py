@@ -0,0 +1,26 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+from .estado_mfa import invalidar as invalidar_estado_mfa
+from .metricas import registro as metricas
+from .models import TokenApi
+from .tokens_api import invalidar as invalidar_token_api
+
+
+@receiver(connection_created)
+def contar_conexion_db(sender, connection, **kwargs):
+    metricas.incrementar('nuam_db_conexiones_creadas_total', alias=connection.alias, vendor=connection.vendor)
+
+
+@receiver(post_save, sender=TOTPDevice)
+@receiver(post_delete, sender=TOTPDevice)
+def invalidar_cache_mfa(sender, instance, **kwargs):
+    invalidar_estado_mfa(instance)
+
+
+@receiver(post_save, sender=TokenApi)
+@receiver(post_delete, sender=TokenApi)
+def invalidar_cache_token_api(sender, instance, **kwargs):
+    invalidar_token_api(instance)
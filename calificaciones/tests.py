@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from .forms import CalificacionTributariaForm
 from django.urls import reverse
 from .models import Usuario
@@ -90,9 +90,1113 @@ class CalificacionFormTests(TestCase):
 		self.assertEqual(resp.status_code, 302)
 		self.assertFalse(TOTPDevice.objects.filter(user=user, confirmed=True).exists())
 
+	def test_estado_mfa_en_cache_e_invalidado_al_desactivar(self):
+		from django.core.cache import cache
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		cache.clear()
+		user = Usuario.objects.create_user(correo='mfacache@example.com', password='testpass', nombre='MFA Cache')
+		TOTPDevice.objects.create(user=user, name='default', confirmed=True)
+		self.client.login(correo='mfacache@example.com', password='testpass')
+		self.client.get('/perfil/')
+		with CaptureQueriesContext(connection) as ctx:
+			resp = self.client.get('/perfil/')
+		self.assertTrue(resp.context['mfa_enabled'])
+		self.assertFalse([q for q in ctx.captured_queries if 'otp_totp_totpdevice' in q['sql']])
+		self.client.post(reverse('mfa_disable'))
+		resp = self.client.get('/perfil/')
+		self.assertFalse(resp.context['mfa_enabled'])
+
+	def test_borrar_dispositivo_revoca_verificacion_sin_cache_compartido(self):
+		from unittest import mock
+		from django.core.cache import cache
+		from django_otp import DEVICE_ID_SESSION_KEY
+		cache.clear()
+		user = Usuario.objects.create_user(correo='mfarevoca@example.com', password='testpass', nombre='MFA Revoca')
+		device = TOTPDevice.objects.create(user=user, name='default', confirmed=True)
+		self.client.login(correo='mfarevoca@example.com', password='testpass')
+		session = self.client.session
+		session[DEVICE_ID_SESSION_KEY] = device.persistent_id
+		session.save()
+		resp = self.client.get('/perfil/')
+		self.assertTrue(resp.wsgi_request.user.is_verified())
+		# Borrado desde otro worker: las señales de este proceso no se enteran
+		with mock.patch('calificaciones.signals.invalidar_estado_mfa'):
+			device.delete()
+		resp = self.client.get('/perfil/')
+		self.assertFalse(resp.wsgi_request.user.is_verified())
+		self.assertNotIn(DEVICE_ID_SESSION_KEY, self.client.session)
+
+	def test_qr_mfa_se_sirve_aparte_y_se_cachea(self):
+		from unittest import mock
+		from . import qr_mfa
+		qr_mfa.cache_qr.limpiar()
+		Usuario.objects.create_user(correo='qr@example.com', password='testpass', nombre='QR User')
+		self.client.login(correo='qr@example.com', password='testpass')
+		resp = self.client.get(reverse('mfa_setup'))
+		self.assertNotContains(resp, 'base64,')
+		with mock.patch.object(qr_mfa, '_renderizar', wraps=qr_mfa._renderizar) as renderizar:
+			imagen = self.client.get(reverse('mfa_qr'))
+			self.client.get(reverse('mfa_setup'))
+			repetida = self.client.get(reverse('mfa_qr'), HTTP_IF_NONE_MATCH=imagen['ETag'])
+		self.assertEqual(imagen.status_code, 200)
+		self.assertTrue(imagen['Content-Type'].startswith('image/'))
+		self.assertEqual(repetida.status_code, 304)
+		self.assertEqual(renderizar.call_count, 1)
+
 	def test_perfil_page_renders_for_logged_in_user(self):
 		user = Usuario.objects.create_user(correo='perfil@example.com', password='testpass', nombre='Perfil User')
 		logged = self.client.login(correo='perfil@example.com', password='testpass')
 		self.assertTrue(logged)
 		resp = self.client.get('/perfil/')
 		self.assertEqual(resp.status_code, 200)
+
+
+class PerfilamientoTests(TestCase):
+	def setUp(self):
+		from .perfilamiento import registro
+		registro.limpiar()
+		self.admin = Usuario.objects.create_user(correo='admin@example.com', password='testpass', nombre='Admin', rol='Administrador')
+
+	def test_peticion_muestreada_registra_sql_y_template(self):
+		from django.test import override_settings
+		from .perfilamiento import registro
+		self.client.login(correo='admin@example.com', password='testpass')
+		with override_settings(PERFILAMIENTO_TASA_MUESTREO=1):
+			resp = self.client.get(reverse('dashboard'))
+		self.assertEqual(resp.status_code, 200)
+		muestras = registro.muestras()
+		self.assertEqual(len(muestras), 1)
+		self.assertEqual(muestras[0].vista, 'dashboard')
+		self.assertGreater(muestras[0].sql_total, 0)
+		self.assertGreater(muestras[0].template_ms, 0)
+		self.assertEqual(muestras[0].bytes_respuesta, len(resp.content))
+
+	def test_reporte_solo_administrador(self):
+		Usuario.objects.create_user(correo='analista@example.com', password='testpass', nombre='Analista', rol='Analista')
+		self.client.login(correo='analista@example.com', password='testpass')
+		self.assertEqual(self.client.get(reverse('reporte_rendimiento')).status_code, 403)
+		self.client.login(correo='admin@example.com', password='testpass')
+		self.assertEqual(self.client.get(reverse('reporte_rendimiento')).status_code, 200)
+
+
+class MetricasTests(TestCase):
+	def setUp(self):
+		import tempfile
+		from django.test import override_settings
+		from .metricas import registro
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+		ajustes = override_settings(METRICAS_DIR=self.tmp.name)
+		ajustes.enable()
+		self.addCleanup(ajustes.disable)
+		registro.limpiar()
+
+	def test_metrics_expone_latencia_y_acciones_de_auditoria(self):
+		from .auditoria import registrar_auditoria
+		user = Usuario.objects.create_user(correo='m@example.com', password='testpass', nombre='M')
+		registrar_auditoria(accion='LOGIN_FAIL', usuario_responsable=user)
+		self.client.get(reverse('login'))
+		with self.settings(METRICAS_TOKEN='secreto'):
+			self.assertEqual(self.client.get('/metrics').status_code, 403)
+			resp = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secreto')
+		self.assertEqual(resp.status_code, 200)
+		texto = resp.content.decode()
+		self.assertIn('nuam_auditoria_acciones_total{accion="LOGIN_FAIL"} 1', texto)
+		self.assertIn('nuam_vista_latencia_segundos_count{vista="login"} 1', texto)
+
+	def test_contadores_se_suman_entre_procesos(self):
+		import json, os
+		from .metricas import registro
+		registro.incrementar('nuam_carga_filas_total', 5, resultado='procesado')
+		otro = {'contadores': [['nuam_carga_filas_total', [['resultado', 'procesado']], 7]], 'histogramas': []}
+		with open(os.path.join(self.tmp.name, 'metricas_999999.json'), 'w') as f:
+			json.dump(otro, f)
+		self.assertIn('nuam_carga_filas_total{resultado="procesado"} 12', registro.exposicion())
+
+	def test_procesos_terminados_pasan_a_los_totales(self):
+		import json, os, subprocess, sys
+		from .metricas import registro
+		# Un worker muerto sin salida limpia
+		muerto = subprocess.Popen([sys.executable, '-c', 'pass'])
+		muerto.wait()
+		estado = {'contadores': [['nuam_carga_filas_total', [['resultado', 'procesado']], 7]], 'histogramas': []}
+		with open(os.path.join(self.tmp.name, f'metricas_{muerto.pid}.json'), 'w') as f:
+			json.dump(estado, f)
+		# Un proceso anterior con nuestro mismo PID
+		with open(os.path.join(self.tmp.name, f'metricas_{os.getpid()}.json'), 'w') as f:
+			json.dump(dict(estado, instancia='anterior'), f)
+		registro.incrementar('nuam_carga_filas_total', 5, resultado='procesado')
+		registro.volcar()
+		for _ in range(2):
+			self.assertIn('nuam_carga_filas_total{resultado="procesado"} 19', registro.exposicion())
+		self.assertFalse(os.path.exists(os.path.join(self.tmp.name, f'metricas_{muerto.pid}.json')))
+
+		# Salida limpia: el estado propio pasa a los totales y el archivo se borra
+		registro.cerrar()
+		self.assertEqual(sorted(n for n in os.listdir(self.tmp.name) if n.endswith('.json')), ['metricas_totales.json'])
+		self.assertIn('nuam_carga_filas_total{resultado="procesado"} 19', registro.exposicion())
+
+	def test_metrics_sin_token_solo_para_staff(self):
+		self.assertEqual(self.client.get('/metrics').status_code, 403)
+		staff = Usuario.objects.create_user(correo='staff@example.com', password='testpass', nombre='Staff', is_staff=True)
+		self.client.force_login(staff)
+		self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class EscritorAuditoriaTests(TestCase):
+	def setUp(self):
+		self.user = Usuario.objects.create_user(correo='audit@example.com', password='testpass', nombre='Audit User')
+
+	def test_lote_encolado_se_inserta_con_un_solo_insert(self):
+		from .auditoria import EscritorAuditoria
+		from .models import LogAuditoria
+		escritor = EscritorAuditoria()
+		escritor._asegurar_hilo = lambda: None  # sin hilo: se vacía manualmente
+		for i in range(3):
+			self.assertTrue(escritor.encolar(LogAuditoria(accion='LOGIN', usuario_responsable=self.user, usuario_nombre='Audit User', detalle=str(i))))
+		self.assertEqual(LogAuditoria.objects.count(), 0)
+		with self.assertNumQueries(1):
+			self.assertEqual(escritor.vaciar(), 3)
+		self.assertEqual(LogAuditoria.objects.filter(usuario_nombre='Audit User').count(), 3)
+
+	def test_dentro_de_transaccion_escribe_sincrono(self):
+		from .auditoria import registrar_auditoria
+		from .models import LogAuditoria
+		log = registrar_auditoria(accion='LOGOUT', usuario_responsable=self.user, detalle='x')
+		self.assertTrue(LogAuditoria.objects.filter(accion='LOGOUT', usuario_nombre='Audit User').exists())
+		self.assertIsNotNone(log.fecha_hora)
+
+
+
+class EscritorAuditoriaHiloTests(TransactionTestCase):
+	"""Sin la transacción envolvente de TestCase: registrar_auditoria encola y el hilo vuelca"""
+
+	def test_eventos_fuera_de_transaccion_se_vuelcan_en_lote_desde_el_hilo(self):
+		import threading
+		import time
+		from unittest import mock
+		from django.test import override_settings
+		from .auditoria import escritor, registrar_auditoria
+		from .models import LogAuditoria
+		user = Usuario.objects.create_user(correo='hilo@example.com', password='testpass', nombre='Hilo')
+		hilos = []
+		original = LogAuditoria.objects.bulk_create
+
+		def bulk_create(logs, *args, **kwargs):
+			hilos.append((threading.current_thread().name, len(logs)))
+			return original(logs, *args, **kwargs)
+
+		with override_settings(AUDITORIA_ASINCRONA=True), \
+				mock.patch.object(LogAuditoria.objects, 'bulk_create', side_effect=bulk_create):
+			logs = [registrar_auditoria(accion='LOGIN', usuario_responsable=user, detalle=str(i)) for i in range(5)]
+			# Encolados: la petición no esperó al INSERT
+			self.assertTrue(all(log.id_log is None for log in logs))
+			limite = time.monotonic() + 5
+			while LogAuditoria.objects.count() < 5 and time.monotonic() < limite:
+				time.sleep(0.05)
+
+		self.assertEqual(sorted(LogAuditoria.objects.values_list('detalle', flat=True)), [str(i) for i in range(5)])
+		self.assertEqual(escritor.pendientes(), 0)
+		# Los cinco eventos, registrados juntos, salen del hilo de fondo en un solo bulk_create
+		self.assertEqual(hilos, [('escritor-auditoria', 5)])
+
+class LogManyTests(TestCase):
+	def test_log_many_resuelve_nombres_en_una_consulta(self):
+		from .models import LogAuditoria
+		a = Usuario.objects.create_user(correo='a@example.com', password='x', nombre='Ana')
+		b = Usuario.objects.create_user(correo='b@example.com', password='x', nombre='Beto')
+		eventos = [
+			{'accion': 'LOGIN', 'usuario_responsable_id': a.pk},
+			{'accion': 'LOGIN_FAIL', 'usuario_responsable_id': b.pk},
+			{'accion': 'LOGOUT', 'usuario_responsable': a},
+		]
+		# 1 SELECT de nombres para los ids + 1 INSERT para todo el lote
+		with self.assertNumQueries(2):
+			LogAuditoria.objects.log_many(eventos)
+		nombres = sorted(LogAuditoria.objects.values_list('usuario_nombre', flat=True))
+		self.assertEqual(nombres, ['Ana', 'Ana', 'Beto'])
+
+	def test_save_con_solo_id_no_consulta_usuario(self):
+		from .models import LogAuditoria
+		a = Usuario.objects.create_user(correo='c@example.com', password='x', nombre='Caro')
+		with self.assertNumQueries(1):
+			LogAuditoria.objects.create(accion='LOGIN', usuario_responsable_id=a.pk)
+
+
+class ArchivoAuditoriaTests(TestCase):
+	def setUp(self):
+		import tempfile
+		from django.test import override_settings
+		self.tmp = tempfile.TemporaryDirectory()
+		self.addCleanup(self.tmp.cleanup)
+		ajustes = override_settings(AUDITORIA_ARCHIVO_DIR=self.tmp.name)
+		ajustes.enable()
+		self.addCleanup(ajustes.disable)
+		self.user = Usuario.objects.create_user(correo='arch@example.com', password='x', nombre='Arch')
+
+	def test_archiva_meses_frios_y_los_lee_de_vuelta(self):
+		from datetime import datetime, timezone as tz
+		from .models import LogAuditoria
+		from .archivo_auditoria import archivar_auditoria, buscar_logs
+		fechas = [datetime(2024, 1, 10, tzinfo=tz.utc), datetime(2024, 1, 20, tzinfo=tz.utc),
+				  datetime(2024, 2, 5, tzinfo=tz.utc), datetime(2024, 6, 1, tzinfo=tz.utc)]
+		LogAuditoria.objects.log_many([
+			{'accion': 'LOGIN', 'usuario_responsable': self.user, 'fecha_hora': f, 'detalle': f.isoformat()} for f in fechas
+		])
+		ahora = datetime(2024, 6, 15, tzinfo=tz.utc)
+		resultado = archivar_auditoria(horizonte_dias=30, tamano_lote=1, ahora=ahora)
+		self.assertEqual(resultado, {(2024, 1): 2, (2024, 2): 1, (2024, 3): 0, (2024, 4): 0})
+		self.assertEqual(LogAuditoria.objects.count(), 1)
+
+		logs = buscar_logs(desde=datetime(2024, 1, 15, tzinfo=tz.utc))
+		self.assertEqual([l.fecha_hora for l in logs], fechas[:0:-1])
+		self.assertTrue(getattr(logs[-1], 'archivado', False))
+		self.assertEqual(logs[-1].usuario_nombre, 'Arch')
+
+	def test_archivado_interrumpido_no_duplica_y_se_lee_en_las_vistas(self):
+		from datetime import datetime, timezone as tz
+		from .models import CalificacionTributaria, LogAuditoria
+		from .archivo_auditoria import _escribir_lote, buscar_logs, ruta_mes, CAMPOS_ARCHIVO
+		from .busqueda_auditoria import filtrar_logs, logs_archivados, pagina_logs
+		calificacion = CalificacionTributaria.objects.create(
+			ejercicio=2024, mercado='ACN', instrumento='ARCH', fecha_pago='2024-06-01',
+			secuencia_evento=10001, origen='Sistema', usuario_creador=self.user,
+		)
+		CalificacionTributaria.objects.filter(pk=calificacion.pk).update(fecha_creacion=datetime(2024, 1, 2, tzinfo=tz.utc))
+		fecha = datetime(2024, 1, 10, tzinfo=tz.utc)
+		LogAuditoria.objects.log_many([
+			{'accion': 'CREATE', 'usuario_responsable': self.user, 'fecha_hora': fecha, 'id_calificacion': calificacion,
+			 'detalle': 'archivado a medias'},
+			{'accion': 'UPDATE', 'usuario_responsable': self.user, 'fecha_hora': datetime(2024, 1, 11, tzinfo=tz.utc),
+			 'id_calificacion': calificacion, 'detalle': 'solo en el archivo'},
+		])
+		# El proceso escribió el lote y murió antes de borrar: ambas filas siguen en la tabla
+		_escribir_lote(ruta_mes(2024, 1), list(LogAuditoria.objects.order_by('id_log').values(*CAMPOS_ARCHIVO)))
+		LogAuditoria.objects.filter(accion='UPDATE').delete()
+
+		self.assertEqual([log.detalle for log in buscar_logs()], ['solo en el archivo', 'archivado a medias'])
+		logs, _ = pagina_logs(filtrar_logs({}), archivados=logs_archivados({}))
+		self.assertEqual([log.detalle for log in logs], ['solo en el archivo', 'archivado a medias'])
+		self.assertFalse(getattr(logs[1], 'archivado', False))
+
+		self.user.rol = 'Administrador'
+		self.user.is_staff = self.user.is_superuser = True
+		self.user.save()
+		self.client.force_login(self.user)
+		resp = self.client.get(reverse('detalle_calificacion', args=[calificacion.pk]))
+		self.assertEqual([log.detalle for log in resp.context['logs']], ['solo en el archivo', 'archivado a medias'])
+		resp = self.client.get(reverse('admin:calificaciones_logauditoria_archivados'))
+		self.assertEqual(resp.context['mes'], (2024, 1))
+		self.assertContains(resp, 'solo en el archivo')
+
+	def test_paginacion_del_archivo_lee_solo_los_meses_necesarios(self):
+		import base64
+		import gzip
+		from datetime import datetime, timezone as tz
+		from unittest import mock
+		from .models import LogAuditoria
+		from .archivo_auditoria import archivar_auditoria
+		from .busqueda_auditoria import filtrar_logs, logs_archivados, pagina_logs
+		LogAuditoria.objects.log_many([
+			{'accion': 'LOGIN', 'usuario_responsable': self.user, 'fecha_hora': datetime(2024, mes, dia, tzinfo=tz.utc)}
+			for mes in (1, 2, 3) for dia in (20, 5, 12)
+		])
+		archivar_auditoria(horizonte_dias=0, ahora=datetime(2024, 4, 2, tzinfo=tz.utc))
+		qs = filtrar_logs({})
+		with mock.patch('gzip.open', wraps=gzip.open) as abrir:
+			pagina, cursor = pagina_logs(qs, archivados=logs_archivados({}), tamano=2)
+		self.assertEqual([log.fecha_hora.day for log in pagina], [20, 12])
+		self.assertEqual(abrir.call_count, 1)
+		with mock.patch('gzip.open', wraps=gzip.open) as abrir:
+			pagina, cursor = pagina_logs(qs, cursor, logs_archivados({}, cursor), tamano=2)
+		# Marzo (5) y febrero (20): no se lee enero
+		self.assertEqual([(log.fecha_hora.month, log.fecha_hora.day) for log in pagina], [(3, 5), (2, 20)])
+		self.assertEqual(abrir.call_count, 2)
+
+		# Un cursor con fecha sin zona no se compara con fechas con zona: se ignora
+		ingenuo = base64.urlsafe_b64encode(b'2024-02-01T00:00:00|5').decode()
+		pagina, _ = pagina_logs(qs, ingenuo, logs_archivados({}, ingenuo), tamano=2)
+		self.assertEqual([log.fecha_hora.day for log in pagina], [20, 12])
+
+
+class ExploradorAuditoriaTests(TestCase):
+	def setUp(self):
+		from .models import LogAuditoria
+		self.auditor = Usuario.objects.create_user(correo='auditor@example.com', password='testpass', nombre='Auditor', rol='Auditor')
+		LogAuditoria.objects.log_many([
+			{'accion': 'LOGIN_FAIL', 'usuario_responsable': self.auditor, 'detalle': f'Intento de login fallido desde 10.0.0.{i}'}
+			for i in range(3)
+		] + [{'accion': 'CARGA_MASIVA', 'usuario_responsable': self.auditor, 'detalle': 'Carga masiva: 10 procesados'}])
+		self.client.login(correo='auditor@example.com', password='testpass')
+
+	def test_busqueda_texto_completo_y_paginacion_por_cursor(self):
+		from .busqueda_auditoria import filtrar_logs, pagina_logs
+		qs = filtrar_logs({'texto': 'fallido'})
+		pagina1, cursor = pagina_logs(qs, tamano=2)
+		self.assertEqual(len(pagina1), 2)
+		self.assertIsNotNone(cursor)
+		pagina2, cursor2 = pagina_logs(qs, cursor, tamano=2)
+		self.assertEqual(len(pagina2), 1)
+		self.assertIsNone(cursor2)
+		ids = {l.id_log for l in pagina1 + pagina2}
+		self.assertEqual(len(ids), 3)
+
+	def test_vista_y_exportacion_csv(self):
+		resp = self.client.get(reverse('explorador_auditoria'), {'texto': 'carga'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(len(resp.context['logs']), 1)
+		resp = self.client.get(reverse('exportar_auditoria'), {'accion': 'LOGIN_FAIL'})
+		contenido = b''.join(resp.streaming_content).decode()
+		self.assertEqual(len(contenido.strip().splitlines()), 4)
+
+
+class LoginTests(TestCase):
+	def setUp(self):
+		from django.core.cache import cache
+		cache.clear()
+		self.user = Usuario.objects.create_user(correo='login@example.com', password='testpass', nombre='Login User')
+
+	def test_login_exitoso_sin_distinguir_mayusculas_en_pocas_consultas(self):
+		from unittest import mock
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		with mock.patch('calificaciones.bloqueo.PROBABILIDAD_PURGA', 0), CaptureQueriesContext(connection) as ctx:
+			resp = self.client.post(reverse('login'), {'username': 'LOGIN@example.com', 'password': 'testpass'})
+		self.assertEqual(resp.status_code, 302)
+		usuario_sql = [q['sql'] for q in ctx.captured_queries if '"USUARIO"' in q['sql']]
+		# Un SELECT (con el EXISTS de MFA) y el UPDATE de last_login
+		self.assertEqual(len(usuario_sql), 2)
+		self.assertIn('EXISTS', usuario_sql[0])
+		# Sin fallos previos no se borran contadores. Total: 4 por cada límite de tasa
+		# (IP y cuenta), ip_bloqueada, el SELECT del usuario, su UPDATE y 7 de la sesión
+		self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('DELETE')])
+		self.assertEqual(len(ctx.captured_queries), 18)
+
+	def test_login_pasa_por_authenticate(self):
+		from django.contrib.auth.signals import user_login_failed
+		fallidos = []
+		receptor = lambda sender, credentials, request, **kwargs: fallidos.append(credentials['username'])
+		user_login_failed.connect(receptor)
+		self.addCleanup(user_login_failed.disconnect, receptor)
+		self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'mala'})
+		self.assertEqual(fallidos, ['login@example.com'])
+		# user_can_authenticate: un usuario inactivo no entra aunque la contraseña sea correcta
+		Usuario.objects.filter(pk=self.user.pk).update(estado=False)
+		resp = self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertNotIn('_auth_user_id', self.client.session)
+		self.assertEqual(len(fallidos), 2)
+
+	def test_login_fallido_incrementa_contador_y_bloquea(self):
+		from .models import LogAuditoria
+		for _ in range(3):
+			self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'mala'})
+		self.user.refresh_from_db()
+		self.assertTrue(self.user.is_locked())
+		self.assertEqual(LogAuditoria.objects.filter(accion='LOGIN_FAIL').count(), 3)
+		self.assertTrue(LogAuditoria.objects.filter(accion='LOCK_ACCOUNT').exists())
+		resp = self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		self.assertEqual(resp.status_code, 200)
+
+	def test_fallos_no_escriben_usuario_y_spraying_bloquea_ip(self):
+		from django.db import connection
+		from django.test import override_settings
+		from django.test.utils import CaptureQueriesContext
+		ajuste = override_settings(LOGIN_MAX_INTENTOS_IP=3)
+		ajuste.enable()
+		self.addCleanup(ajuste.disable)
+		with CaptureQueriesContext(connection) as ctx:
+			self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'mala'})
+			self.client.post(reverse('login'), {'username': 'otro@example.com', 'password': 'mala'})
+		self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "USUARIO"')])
+		self.client.post(reverse('login'), {'username': 'tercero@example.com', 'password': 'mala'})
+		# IP bloqueada: ni siquiera la contraseña correcta consulta USUARIO
+		with CaptureQueriesContext(connection) as ctx:
+			resp = self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertFalse([q for q in ctx.captured_queries if '"USUARIO"' in q['sql']])
+
+	def test_contadores_en_la_base_con_cache_por_proceso(self):
+		from django.core.cache import cache
+		from django.test import override_settings
+		from . import bloqueo
+		from .models import ContadorFallosLogin
+		# LocMemCache no se comparte entre workers: los contadores van a CONTADOR_FALLOS_LOGIN
+		self.assertFalse(bloqueo.cache_compartido())
+		with override_settings(LOGIN_MAX_INTENTOS_IP=3):
+			self.assertEqual(bloqueo.registrar_fallo_cuenta(self.user.pk), 1)
+			self.assertEqual(bloqueo.registrar_fallo_cuenta(self.user.pk), 2)
+			self.assertFalse(bloqueo.registrar_fallo_ip('10.0.0.1'))
+			self.assertFalse(bloqueo.registrar_fallo_ip('10.0.0.1'))
+			# Otro proceso no ve el cache local de este
+			cache.clear()
+			self.assertTrue(bloqueo.registrar_fallo_ip('10.0.0.1'))
+		self.assertTrue(bloqueo.ip_bloqueada('10.0.0.1'))
+		self.assertFalse(bloqueo.ip_bloqueada('10.0.0.2'))
+		self.assertTrue(ContadorFallosLogin.objects.filter(clave__startswith='login_fallos:cuenta:').exists())
+		bloqueo.limpiar_fallos_cuenta(self.user.pk)
+		self.assertEqual(bloqueo.registrar_fallo_cuenta(self.user.pk), 1)
+		# Con fallos pendientes, el login exitoso sí los borra
+		self.assertTrue(Usuario.objects.para_login(self.user.correo).tiene_fallos_login)
+		self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		self.assertFalse(Usuario.objects.para_login(self.user.correo).tiene_fallos_login)
+
+	def test_verificacion_mfa_una_consulta_y_sin_repeticion(self):
+		import time
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		from django_otp.oath import hotp
+		device = TOTPDevice.objects.create(user=self.user, name='default', confirmed=True)
+		token = str(hotp(device.bin_key, int(time.time()) // 30)).zfill(6)
+		datos = {'username': 'login@example.com', 'password': 'testpass'}
+		self.assertRedirects(self.client.post(reverse('login'), datos), reverse('mfa_verify'), fetch_redirect_response=False)
+		with CaptureQueriesContext(connection) as ctx:
+			resp = self.client.post(reverse('mfa_verify'), {'token': token})
+		self.assertEqual(resp.status_code, 302)
+		consultas = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'otp_totp_totpdevice' in q['sql']]
+		self.assertEqual(len(consultas), 1)
+		# El mismo código no se acepta dos veces
+		self.client.logout()
+		self.client.post(reverse('login'), datos)
+		resp = self.client.post(reverse('mfa_verify'), {'token': token})
+		self.assertEqual(resp.status_code, 200)
+
+	def test_codigo_mfa_con_digitos_unicode_se_rechaza(self):
+		from .verificacion_mfa import verificar_token
+		device = TOTPDevice.objects.create(user=self.user, name='default', confirmed=True)
+		self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		resp = self.client.post(reverse('mfa_verify'), {'token': '١٢٣٤٥٦'})
+		self.assertEqual(resp.status_code, 200)
+		from .forms import MfaVerifyForm
+		form = MfaVerifyForm(self.user, {'token': '١٢٣٤٥٦'}, device=device)
+		self.assertEqual(form.errors['token'], ['El código debe contener solo números.'])
+		self.assertFalse(verificar_token(device, '١٢٣٤٥٦'))
+
+	def test_limite_de_tasa_rechaza_antes_de_consultar(self):
+		from django.db import connection
+		from django.test import override_settings
+		from django.test.utils import CaptureQueriesContext
+		ajuste = override_settings(LIMITE_TASA={'login': (2, 1)})
+		ajuste.enable()
+		self.addCleanup(ajuste.disable)
+		for _ in range(2):
+			self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'mala'})
+		with CaptureQueriesContext(connection) as ctx:
+			resp = self.client.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+		self.assertEqual(resp.status_code, 429)
+		self.assertIn('Retry-After', resp)
+		self.assertFalse([q for q in ctx.captured_queries if 'USUARIO' in q['sql']])
+
+	def test_limite_de_tasa_mfa_por_usuario_entre_sesiones(self):
+		from django.test import Client, override_settings
+		TOTPDevice.objects.create(user=self.user, name='default', confirmed=True)
+		ajuste = override_settings(LIMITE_TASA={'login': (10, 5), 'mfa_verify': (2, 1)})
+		ajuste.enable()
+		self.addCleanup(ajuste.disable)
+		respuestas = []
+		for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+			# Una sesión nueva desde otra IP no reinicia el límite de la cuenta
+			cliente = Client(REMOTE_ADDR=ip)
+			cliente.post(reverse('login'), {'username': 'login@example.com', 'password': 'testpass'})
+			respuestas.append(cliente.post(reverse('mfa_verify'), {'token': '000000'}).status_code)
+		self.assertEqual(respuestas, [200, 200, 429])
+
+
+class AsistenteCalificacionTests(TestCase):
+	def setUp(self):
+		self.user = Usuario.objects.create_user(correo='asistente@example.com', password='testpass', nombre='Asistente', rol='Administrador')
+		self.client.login(correo='asistente@example.com', password='testpass')
+		self.paso1 = {
+			'ejercicio': 2024, 'mercado': 'ACN', 'instrumento': 'NUAM', 'fecha_pago': '2024-05-02',
+			'secuencia_evento': 10001, 'numero_dividendo': 1, 'valor_historico': '10.50', 'origen': 'Sistema',
+		}
+
+	def test_pasos_usan_borrador_sin_escribir_sesion(self):
+		from datetime import date
+		from decimal import Decimal
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		from .models import BorradorCalificacion
+		with CaptureQueriesContext(connection) as ctx:
+			self.client.post(reverse('crear_calificacion_paso1'), self.paso1)
+			self.client.post(reverse('crear_calificacion_paso2'), {'monto_8': '30', 'monto_9': '70', 'monto_10': '0', 'monto_11': '0', 'monto_12': '0'})
+		self.assertFalse([q for q in ctx.captured_queries if 'django_session' in q['sql'] and not q['sql'].startswith('SELECT')])
+		borrador = BorradorCalificacion.objects.get(usuario=self.user, clave='crear')
+		self.assertEqual(borrador.factores['factor_9'], '0.70000000')
+		resp = self.client.get(reverse('crear_calificacion_paso3'))
+		self.assertEqual(resp.context['datos_paso1']['fecha_pago'], date(2024, 5, 2))
+		self.assertEqual(resp.context['datos_paso1']['valor_historico'], Decimal('10.50'))
+
+
+	def test_paso3_crea_en_una_transaccion_y_detecta_duplicado_por_restriccion(self):
+		from .models import CalificacionTributaria, FactorCalificacion, LogAuditoria
+		factores = {f'factor_{i}': '0' for i in range(8, 38)}
+		factores['factor_8'] = '0.5'
+		for _ in range(2):
+			self.client.post(reverse('crear_calificacion_paso1'), self.paso1)
+			resp = self.client.post(reverse('crear_calificacion_paso3'), factores)
+		# El segundo intento choca con el unique_together y no deja filas a medias
+		self.assertRedirects(resp, reverse('crear_calificacion_paso1'), fetch_redirect_response=False)
+		self.assertEqual(CalificacionTributaria.objects.count(), 1)
+		self.assertEqual(FactorCalificacion.objects.count(), 1)
+		self.assertEqual(LogAuditoria.objects.filter(accion='CREATE').count(), 1)
+
+
+class ApiCalificacionesTests(TestCase):
+	def setUp(self):
+		self.user = Usuario.objects.create_user(correo='api@example.com', password='testpass', nombre='API', rol='Analista')
+		self.client.login(correo='api@example.com', password='testpass')
+
+	def item(self, instrumento, **extra):
+		datos = {
+			'ejercicio': 2024, 'mercado': 'ACN', 'instrumento': instrumento, 'fecha_pago': '2024-03-01',
+			'secuencia_evento': 10001, 'numero_dividendo': 1, 'origen': 'Sistema',
+			'factores': {'factor_8': 0.25, 'factor_9': '0.75000000'},
+		}
+		datos.update(extra)
+		return datos
+
+	def test_crea_lote_con_resultado_por_item(self):
+		import json
+		from .models import CalificacionTributaria, FactorCalificacion, LogAuditoria
+		items = [
+			self.item('AAA'),
+			self.item('BBB', factores={'factor_8': '0.6', 'factor_9': '0.4', 'factor_10': '0.00000001'}),
+			self.item('CCC', fecha_pago='2023-12-31'),
+			self.item('AAA'),
+		]
+		resp = self.client.post(reverse('api_crear_calificaciones'), json.dumps(items), content_type='application/json')
+		self.assertEqual(resp.status_code, 200)
+		datos = resp.json()
+		self.assertEqual(datos['creados'], 1)
+		estados = [r['estado'] for r in datos['resultados']]
+		self.assertEqual(estados, ['creado', 'error', 'error', 'error'])
+		self.assertIn('fecha_pago', datos['resultados'][2]['errores'])
+		calificacion = CalificacionTributaria.objects.get()
+		from decimal import Decimal
+		self.assertEqual(calificacion.factorcalificacion.factor_9, Decimal('0.75'))
+		self.assertEqual(LogAuditoria.objects.filter(accion='CREATE', id_calificacion=calificacion).count(), 1)
+		# Reenviar el mismo ítem choca con la clave única existente
+		resp = self.client.post(reverse('api_crear_calificaciones'), json.dumps(items[:1]), content_type='application/json')
+		self.assertEqual(resp.json()['creados'], 0)
+		self.assertEqual(FactorCalificacion.objects.count(), 1)
+
+	def test_lote_no_revive_eliminadas_y_aisla_conflictos_por_fila(self):
+		from unittest import mock
+		from . import carga_lotes
+		from .models import CalificacionTributaria
+		carga_lotes.crear_lote([self.item('DEL'), self.item('DUP')], self.user)
+		CalificacionTributaria.objects.filter(instrumento='DEL').update(estado=False)
+		resultados = carga_lotes.crear_lote([self.item('DEL')], self.user, sobrescribir=True)
+		self.assertEqual(resultados[0]['errores'], {'__all__': ['Existe una calificación eliminada con los mismos datos.']})
+		self.assertFalse(CalificacionTributaria.objects.get(instrumento='DEL').estado)
+
+		# DUP se "insertó en paralelo" después de validar: solo esa fila falla
+		with mock.patch.object(carga_lotes, '_existentes', lambda clave, filas: [None] * len(clave)):
+			resultados = carga_lotes.crear_lote([self.item('NUEVA'), self.item('DUP'), self.item('OTRA')], self.user)
+		self.assertEqual([r['estado'] for r in resultados], ['creado', 'error', 'creado'])
+		self.assertIn('paralelo', resultados[1]['errores']['__all__'][0])
+		self.assertEqual(CalificacionTributaria.objects.filter(instrumento__in=['NUEVA', 'OTRA']).count(), 2)
+
+	def test_requiere_autenticacion(self):
+		self.client.logout()
+		resp = self.client.post(reverse('api_crear_calificaciones'), '[]', content_type='application/json')
+		self.assertEqual(resp.status_code, 401)
+
+	def test_token_api_sin_sesion_ni_csrf_con_cache(self):
+		import json
+		from django.core.cache import cache
+		from django.test import Client
+		from .tokens_api import autenticar, generar, revocar
+		cache.clear()
+		token, registro = generar(self.user, 'integracion')
+		cliente = Client(enforce_csrf_checks=True)
+		url = reverse('api_crear_calificaciones')
+		resp = cliente.post(url, json.dumps([self.item('TOK')]), content_type='application/json',
+							HTTP_AUTHORIZATION=f'Bearer {token}')
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp.json()['creados'], 1)
+		self.assertNotIn('sessionid', resp.cookies)
+		# Resuelto desde el cache: sin consultas
+		with self.assertNumQueries(0):
+			self.assertEqual(autenticar(token), self.user)
+		self.assertIsNone(autenticar(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+		# La sesión sigue exigiendo CSRF
+		cliente.login(correo='api@example.com', password='testpass')
+		self.assertEqual(cliente.post(url, '[]', content_type='application/json').status_code, 403)
+		revocar(registro)
+		resp = cliente.post(url, '[]', content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}')
+		self.assertEqual(resp.status_code, 401)
+
+	def test_token_api_con_cache_por_proceso_vence_pronto(self):
+		from unittest import mock
+		from django.core.cache import cache
+		from django.test import override_settings
+		from . import tokens_api
+		cache.clear()
+		token, _ = tokens_api.generar(self.user, 'integracion')
+		# LocMemCache: otro worker no ve la invalidación, la entrada dura TOKEN_API_CACHE_SEGUNDOS_LOCAL
+		with override_settings(TOKEN_API_CACHE_SEGUNDOS=600, TOKEN_API_CACHE_SEGUNDOS_LOCAL=5), \
+				mock.patch.object(cache, 'set', wraps=cache.set) as guardar:
+			tokens_api.autenticar(token)
+			self.assertEqual(guardar.call_args.args[2], 5)
+			with mock.patch.object(tokens_api, 'cache_compartido', return_value=True):
+				cache.clear()
+				tokens_api.autenticar(token)
+			self.assertEqual(guardar.call_args.args[2], 600)
+
+	def test_consulta_factores_por_lote_con_alcance_corredor(self):
+		import json
+		from unittest import mock
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		items = [self.item('AAA'), self.item('AAA', secuencia_evento=10002, factores={'factor_8': '0.12345678'}),
+				 self.item('BBB', origen='Corredor')]
+		self.client.post(reverse('api_crear_calificaciones'), json.dumps(items), content_type='application/json')
+		url = reverse('api_consultar_factores')
+		claves = [{'instrumento': 'AAA', 'ejercicio': 2024}, ['BBB', 2024, 10001], ['ZZZ', 2024],
+				  {'instrumento': 'AAA', 'ejercicio': 2024, 'secuencia_evento': 10002}]
+		with CaptureQueriesContext(connection) as consultas:
+			resp = self.client.post(url, json.dumps(claves), content_type='application/json')
+			datos = json.loads(b''.join(resp.streaming_content))
+		self.assertEqual(len([q for q in consultas if 'VALUES' in q['sql']]), 1)
+		self.assertEqual([r['indice'] for r in datos['resultados']], [0, 0, 1, 3])
+		self.assertEqual(datos['resultados'][3]['factores']['factor_8'], '0.12345678')
+		self.assertIsNone(datos['resultados'][3]['factores']['factor_9'])
+		self.assertEqual(datos['sin_resultados'], [2])
+
+		# Con pocas claves por consulta el resultado es el mismo
+		with mock.patch.object(connection.features, 'max_query_params', 6):
+			resp = self.client.post(url, json.dumps(claves), content_type='application/json')
+			self.assertEqual(json.loads(b''.join(resp.streaming_content)), datos)
+
+		corredor = Usuario.objects.create_user(correo='corr@example.com', password='testpass', nombre='C', rol='Corredor')
+		self.client.force_login(corredor)
+		resp = self.client.post(url, json.dumps(claves), content_type='application/json')
+		datos = json.loads(b''.join(resp.streaming_content))
+		self.assertEqual([r['instrumento'] for r in datos['resultados']], ['BBB'])
+		resp = self.client.post(url, json.dumps([{'instrumento': 'AAA'}]), content_type='application/json')
+		self.assertEqual(resp.status_code, 400)
+
+	def test_factores_vigentes_a_una_fecha(self):
+		import json
+		items = [
+			self.item('AAA', fecha_pago='2024-03-01', secuencia_evento=10001),
+			self.item('AAA', fecha_pago='2024-06-01', secuencia_evento=10002),
+			self.item('AAA', fecha_pago='2024-06-01', secuencia_evento=10003, factores={'factor_8': '0.1'}),
+			self.item('BBB', fecha_pago='2024-05-01'),
+		]
+		self.client.post(reverse('api_crear_calificaciones'), json.dumps(items), content_type='application/json')
+		url = reverse('api_factores_vigentes')
+		consultas = [['AAA', '2024-05-31'], ['AAA', '2024-12-31'], ['AAA', '2024-02-29'], ['BBB', '2024-05-01']]
+		resp = self.client.post(url, json.dumps(consultas), content_type='application/json')
+		datos = json.loads(b''.join(resp.streaming_content))
+		self.assertEqual([(r['indice'], r['secuencia_evento']) for r in datos['resultados']],
+						 [(0, 10001), (1, 10003), (3, 10001)])
+		self.assertEqual(datos['resultados'][1]['factores']['factor_8'], '0.10000000')
+		self.assertEqual(datos['sin_resultados'], [2])
+
+		resp = self.client.get(url, {'instrumento': 'AAA', 'fecha': '2024-06-01'})
+		datos = json.loads(b''.join(resp.streaming_content))
+		self.assertEqual(datos['resultados'][0]['secuencia_evento'], 10003)
+		self.assertEqual(self.client.get(url, {'instrumento': 'AAA', 'fecha': '01/06/2024'}).status_code, 400)
+
+	def test_matriz_factores_estadisticas_y_refresco_incremental(self):
+		import json
+		from datetime import timedelta
+		from django.utils import timezone
+		from . import matriz_factores
+		from .models import CalificacionTributaria, FactorCalificacion
+		items = [self.item('AAA', factores={'factor_8': '0.1', 'factor_9': '0.3'}),
+				 self.item('BBB', factores={'factor_8': '0.3'}),
+				 self.item('CCC', mercado='CFI', factores={'factor_8': '0.00000001'})]
+		self.client.post(reverse('api_crear_calificaciones'), json.dumps(items), content_type='application/json')
+		matriz_factores.cache_matriz.limpiar()
+		datos = self.client.get(reverse('api_estadisticas_factores'), {'mercado': 'ACN'}).json()
+		self.assertEqual(datos['calificaciones'], 2)
+		self.assertEqual(datos['factores']['factor_8']['suma'], '0.40000000')
+		self.assertEqual(datos['factores']['factor_8']['media'], 0.2)
+		self.assertEqual(datos['factores']['factor_9']['conteo'], 1)
+		self.assertEqual(datos['factores']['factor_20']['conteo'], 0)
+
+		matriz = matriz_factores.construir()
+		# Cambio de factores (la edición guarda la calificación) y eliminación lógica
+		aaa = CalificacionTributaria.objects.get(instrumento='AAA')
+		FactorCalificacion.objects.filter(id_calificacion=aaa).update(factor_8='0.5')
+		aaa.save()
+		CalificacionTributaria.objects.filter(instrumento='BBB').update(estado=False, fecha_modificacion=timezone.now())
+		# update() deja la fila sin empaquetar: una consulta más a las columnas anchas
+		with self.assertNumQueries(2):
+			nueva = matriz_factores.refrescar(matriz)
+		self.assertEqual(len(matriz), 3)
+		self.assertEqual(list(nueva.instrumento), ['AAA', 'CCC'])
+		self.assertEqual(nueva.valores[nueva.posiciones([aaa.pk])[0], 0], 50000000)
+		self.assertEqual(nueva.valores[1, 0], 1)
+
+		# Una transacción que confirma después del refresco con una fecha anterior a la marca
+		ccc = CalificacionTributaria.objects.get(instrumento='CCC')
+		FactorCalificacion.objects.filter(id_calificacion=ccc).update(factor_8='0.7')
+		CalificacionTributaria.objects.filter(pk=ccc.pk).update(fecha_modificacion=nueva.marca - timedelta(seconds=5))
+		ultima = matriz_factores.refrescar(nueva)
+		self.assertEqual(ultima.valores[ultima.posiciones([ccc.pk])[0], 0], 70000000)
+		self.assertEqual(ultima.marca, nueva.marca)
+
+	def test_factores_empaquetados_y_respaldo_desde_columnas_anchas(self):
+		import json
+		from decimal import Decimal
+		from django.db import connection
+		from . import factores_empaquetados, matriz_factores
+		from .models import FactorCalificacion
+		self.client.post(reverse('api_crear_calificaciones'), json.dumps([self.item('AAA')]), content_type='application/json')
+		factor = FactorCalificacion.objects.get()
+		vector = factor.vector()
+		self.assertEqual(vector[:2].tolist(), [25000000, 75000000])
+		self.assertEqual(vector[2], factores_empaquetados.NULO)
+		self.assertEqual(factores_empaquetados.a_decimales(vector)[:3], [Decimal('0.25'), Decimal('0.75'), None])
+		factor.factor_10 = Decimal('0.00000003')
+		factor.save(update_fields=['factor_10'])
+		factor.refresh_from_db()
+		self.assertEqual(factor.vector()[2], 3)
+
+		# Filas sin empaquetar (p. ej. escritas con update()) se leen de las columnas anchas
+		FactorCalificacion.objects.update(factores_empaquetados=None)
+		with self.assertNumQueries(2):
+			matriz = matriz_factores.construir()
+		self.assertEqual(matriz.valores[0, :3].tolist(), [25000000, 75000000, 3])
+
+		# update() y SQL directo sobre las columnas anchas no dejan una copia empaquetada vieja
+		factor.save()
+		FactorCalificacion.objects.update(factor_8=Decimal('0.1'))
+		factor.refresh_from_db()
+		self.assertIsNone(factor.factores_empaquetados)
+		self.assertEqual(factor.vector()[0], 10000000)
+		factor.save()
+		with connection.cursor() as cursor:
+			cursor.execute('UPDATE FACTOR_CALIFICACION SET factor_9 = 0.2')
+		factor.refresh_from_db()
+		self.assertIsNone(factor.factores_empaquetados)
+		self.assertEqual(matriz_factores.construir().valores[0, :2].tolist(), [10000000, 20000000])
+
+		factor.factor_11 = Decimal('0.4')
+		FactorCalificacion.objects.bulk_update([factor], ['factor_11'])
+		factor.refresh_from_db()
+		self.assertIsNotNone(factor.factores_empaquetados)
+		self.assertEqual(factor.vector()[3], 40000000)
+		factor.factor_12 = Decimal('0.1')
+		factor.save()
+		factor.refresh_from_db()
+		self.assertEqual(factores_empaquetados.desempaquetar(factor.factores_empaquetados)[4], 10000000)
+
+	def test_ndjson_por_lotes_con_upsert_e_idempotencia(self):
+		import json
+		from decimal import Decimal
+		from django.test import override_settings
+		from .models import ArchivoCarga, CalificacionTributaria
+		lineas = [json.dumps(self.item(f'I{i}')) for i in range(5)] + ['{no es json', '']
+		cuerpo = '\n'.join(lineas)
+		url = reverse('api_cargar_ndjson')
+		with override_settings(NDJSON_TAMANO_LOTE=2):
+			resp = self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-1')
+		self.assertEqual(resp.status_code, 200)
+		datos = resp.json()
+		self.assertEqual((datos['procesados'], datos['errores']), (5, 1))
+		self.assertEqual(datos['detalle_errores'][0]['linea'], 6)
+		archivo = ArchivoCarga.objects.get(pk=datos['archivo'])
+		self.assertEqual((archivo.tipo_archivo, archivo.estado_proceso), ('NDJSON', 'PROCESADO'))
+
+		# Reintento con la misma clave: misma respuesta, sin reprocesar
+		resp = self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-1')
+		self.assertEqual(resp['Idempotent-Replayed'], 'true')
+		self.assertEqual(resp.json(), datos)
+		self.assertEqual(ArchivoCarga.objects.count(), 1)
+		# Misma clave con otro cuerpo: se rechaza
+		resp = self.client.post(url, lineas[0], content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-1')
+		self.assertEqual(resp.status_code, 422)
+
+		# sobrescribir actualiza las existentes en vez de rechazarlas
+		cambio = json.dumps(self.item('I0', factores={'factor_8': '0.5'}, valor_historico='10.50'))
+		resp = self.client.post(url + '?sobrescribir=1', cambio, content_type='application/x-ndjson')
+		self.assertEqual((resp.json()['procesados'], resp.json()['errores']), (1, 0))
+		calificacion = CalificacionTributaria.objects.get(instrumento='I0')
+		self.assertEqual(calificacion.valor_historico, Decimal('10.50'))
+		self.assertEqual(calificacion.factorcalificacion.factor_8, Decimal('0.5'))
+		self.assertIsNone(calificacion.factorcalificacion.factor_9)
+		self.assertEqual(CalificacionTributaria.objects.count(), 5)
+
+	def test_ndjson_retoma_una_carga_abandonada(self):
+		import json
+		from datetime import timedelta
+		from django.utils import timezone
+		from .carga_lotes import reservar_archivo
+		from .models import ArchivoCarga
+		# Un proceso que murió a mitad de la carga dejó la reserva PENDIENTE
+		archivo, reservado = reservar_archivo(self.user, 'carga-2', nombre_archivo='carga.ndjson', tipo_archivo='NDJSON')
+		self.assertTrue(reservado)
+		url = reverse('api_cargar_ndjson')
+		cuerpo = json.dumps(self.item('AAA'))
+		resp = self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-2')
+		self.assertEqual(resp.status_code, 409)
+
+		ArchivoCarga.objects.filter(pk=archivo.pk).update(fecha_reserva=timezone.now() - timedelta(hours=1))
+		resp = self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-2')
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual((resp.json()['archivo'], resp.json()['estado'], resp.json()['procesados']), (archivo.pk, 'PROCESADO', 1))
+
+
+	def test_ndjson_reintento_sigue_desde_el_ultimo_lote_confirmado(self):
+		import json
+		from unittest import mock
+		from django.test import override_settings
+		from . import carga_lotes
+		from .models import ArchivoCarga, CalificacionTributaria
+		lineas = [json.dumps(self.item(f'R{i}')) for i in range(2)] + ['{no es json'] + [json.dumps(self.item(f'R{i}')) for i in range(2, 5)]
+		cuerpo = '\n'.join(lineas)
+		url = reverse('api_cargar_ndjson')
+		original = carga_lotes.crear_lote
+		llamadas = []
+
+		def falla_en_el_segundo_lote(*args, **kwargs):
+			llamadas.append(1)
+			if len(llamadas) == 2:
+				raise RuntimeError('conexión perdida')
+			return original(*args, **kwargs)
+
+		with override_settings(NDJSON_TAMANO_LOTE=3), mock.patch.object(carga_lotes, 'crear_lote', falla_en_el_segundo_lote):
+			with self.assertRaises(RuntimeError):
+				self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-3')
+		archivo = ArchivoCarga.objects.get(clave_idempotencia='carga-3')
+		self.assertEqual((archivo.estado_proceso, archivo.lineas_confirmadas, archivo.registros_procesados), ('ERROR', 3, 2))
+		self.assertEqual(CalificacionTributaria.objects.filter(instrumento__startswith='R').count(), 2)
+
+		# Otro cuerpo con la misma clave no retoma la carga
+		otro = '\n'.join([json.dumps(self.item('X0'))] + lineas[1:])
+		with override_settings(NDJSON_TAMANO_LOTE=3):
+			resp = self.client.post(url, otro, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-3')
+		self.assertEqual(resp.status_code, 422)
+		with override_settings(NDJSON_TAMANO_LOTE=3):
+			resp = self.client.post(url, cuerpo, content_type='application/x-ndjson', HTTP_IDEMPOTENCY_KEY='carga-3')
+		datos = resp.json()
+		self.assertEqual((datos['estado'], datos['procesados'], datos['errores']), ('PROCESADO', 5, 1))
+		self.assertEqual([e['linea'] for e in datos['detalle_errores']], [3])
+		self.assertEqual(CalificacionTributaria.objects.filter(instrumento__startswith='R').count(), 5)
+		self.assertFalse(CalificacionTributaria.objects.filter(instrumento='X0').exists())
+
+class IntegridadTests(TestCase):
+	def setUp(self):
+		self.user = Usuario.objects.create_user(correo='int@example.com', password='testpass', nombre='Int', rol='Administrador')
+
+	def calificacion(self, instrumento, **factores):
+		from .models import CalificacionTributaria, FactorCalificacion
+		calificacion = CalificacionTributaria.objects.create(
+			ejercicio=2024, mercado='ACN', instrumento=instrumento, fecha_pago='2024-01-01',
+			secuencia_evento=10001, origen='Carga_Masiva', usuario_creador=self.user,
+		)
+		FactorCalificacion.objects.create(id_calificacion=calificacion, **factores)
+		return calificacion
+
+	def test_escaneo_completo_e_incremental_reconcilia_violaciones(self):
+		from datetime import timedelta
+		from decimal import Decimal
+		from django.utils import timezone
+		from .integridad import escanear
+		from .models import CalificacionTributaria, FactorCalificacion, ViolacionIntegridad
+		self.calificacion('OK', factor_8=Decimal('0.5'), factor_16=Decimal('0.5'), factor_30=Decimal('3'))
+		suma = self.calificacion('SUMA', factor_8=Decimal('0.6'), factor_9=Decimal('0.5'))
+		rango = self.calificacion('RANGO', factor_10=Decimal('-0.1'), factor_19=Decimal('1.5'))
+
+		escaneo = escanear(tamano_lote=2)
+		self.assertEqual((escaneo.tipo, escaneo.filas_revisadas, escaneo.violaciones), ('COMPLETO', 3, 2))
+		self.assertEqual(
+			set(ViolacionIntegridad.objects.values_list('id_calificacion__instrumento', 'regla')),
+			{('SUMA', 'SUMA_8_16'), ('RANGO', 'FACTOR_NEGATIVO'), ('RANGO', 'FACTOR_MAYOR_A_1')},
+		)
+		self.assertEqual(ViolacionIntegridad.objects.get(regla='SUMA_8_16').detalle, 'Suma de factores 8 a 16 = 1.10000000')
+		detectada = ViolacionIntegridad.objects.get(regla='FACTOR_NEGATIVO').fecha_deteccion
+
+		# Incremental: solo lo modificado; las corregidas desaparecen y las vigentes conservan su fecha
+		CalificacionTributaria.objects.filter(instrumento='OK').update(fecha_modificacion=timezone.now() - timedelta(hours=1))
+		factores = suma.factorcalificacion
+		factores.factor_9 = Decimal('0.4')
+		factores.save()
+		suma.save()
+		rango.save()
+		escaneo = escanear()
+		self.assertEqual((escaneo.tipo, escaneo.filas_revisadas), ('INCREMENTAL', 2))
+		self.assertFalse(ViolacionIntegridad.objects.filter(regla='SUMA_8_16').exists())
+		self.assertEqual(ViolacionIntegridad.objects.get(regla='FACTOR_NEGATIVO').fecha_deteccion, detectada)
+
+		rango.estado = False
+		rango.save()
+		escaneo = escanear()
+		self.assertFalse(ViolacionIntegridad.objects.exists())
+
+		# Confirmada después de que empezó el escaneo, con una fecha anterior a su inicio
+		CalificacionTributaria.objects.filter(instrumento='OK').update(fecha_modificacion=escaneo.inicio - timedelta(seconds=5))
+		FactorCalificacion.objects.filter(id_calificacion__instrumento='OK').update(factor_19=Decimal('2'))
+		escanear()
+		self.assertEqual(list(ViolacionIntegridad.objects.values_list('id_calificacion__instrumento', 'regla')),
+						 [('OK', 'FACTOR_MAYOR_A_1')])
+
+	def test_reporte_integridad(self):
+		from decimal import Decimal
+		from .integridad import escanear
+		self.calificacion('SUMA', factor_8=Decimal('0.6'), factor_9=Decimal('0.5'))
+		escanear()
+		self.client.login(correo='int@example.com', password='testpass')
+		resp = self.client.get(reverse('reporte_integridad'), {'regla': 'SUMA_8_16'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertContains(resp, '1.10000000')
+
+
+class ReglasTests(TestCase):
+	def test_evaluacion_escalar_y_vectorial_coinciden(self):
+		from datetime import date
+		from decimal import Decimal
+		import pandas as pd
+		from .reglas import REGLAS, ESCALAS, FACTORES_SUMA, validar, validar_columnas
+		registros = [{**dict.fromkeys(FACTORES_SUMA), **registro} for registro in [
+			{'ejercicio': 2024, 'fecha_pago': date(2024, 1, 1), 'secuencia_evento': 10001, 'factor_8': Decimal('0.5'), 'factor_16': Decimal('0.5')},
+			{'ejercicio': 2024, 'fecha_pago': date(2023, 12, 31), 'secuencia_evento': 10000, 'factor_8': None, 'factor_16': None},
+			{'ejercicio': None, 'fecha_pago': None, 'secuencia_evento': None, 'factor_8': Decimal('0.50000001'), 'factor_16': Decimal('0.5')},
+			{'ejercicio': 2024, 'fecha_pago': date(2024, 5, 1), 'secuencia_evento': 20000, 'factor_8': Decimal('-0.00000001'), 'factor_16': Decimal('1.5')},
+		]]
+		escalares = [validar(registro) for registro in registros]
+		self.assertEqual(escalares[0], {})
+		self.assertEqual(set(escalares[1]), {'secuencia_evento', 'fecha_pago'})
+		self.assertEqual(list(escalares[2]), ['__all__'])
+		self.assertEqual(set(escalares[3]), {'factor_8', 'factor_16', '__all__'})
+
+		df = pd.DataFrame(registros)
+		df['fecha_pago'] = pd.to_datetime(df['fecha_pago'])
+		for campo in ['ejercicio', 'secuencia_evento'] + FACTORES_SUMA:
+			escala = ESCALAS.get(campo, 0)
+			df[campo] = [None if v is None else float(Decimal(v).scaleb(escala)) for v in df[campo]]
+		vectoriales = [{} for _ in registros]
+		for regla, mascara in validar_columnas(df):
+			for fila in mascara[mascara].index:
+				vectoriales[fila].setdefault(regla.campo_error, []).append(regla.mensaje)
+		self.assertEqual(vectoriales, escalares)
+		self.assertTrue(all(regla.campos for regla in REGLAS))
+
+	def test_formularios_y_modelo_usan_las_reglas(self):
+		from .forms import FactoresForm
+		form = FactoresForm(data={'factor_8': '0.6', 'factor_9': '0.5', 'factor_17': '1.2'})
+		self.assertFalse(form.is_valid())
+		self.assertEqual(form.non_field_errors(), ['La suma de los factores del 8 al 16 no puede ser mayor a 1.00000000'])
+		self.assertEqual(form.errors['factor_17'], ['El factor no puede ser mayor a 1'])
+
+		form = CalificacionTributariaForm({
+			'ejercicio': 2024, 'mercado': 'ACN', 'instrumento': 'TEST', 'fecha_pago': '2024-01-01',
+			'secuencia_evento': 10000, 'numero_dividendo': 1, 'origen': 'Sistema',
+		})
+		self.assertFalse(form.is_valid())
+		self.assertEqual(form.errors['secuencia_evento'], ['La secuencia debe ser superior a 10.000'])
+
+	def test_redondea_a_ocho_decimales_como_la_base_de_datos(self):
+		from decimal import Decimal
+		from .reglas import FACTORES_SUMA, validar
+		vacios = dict.fromkeys(FACTORES_SUMA)
+		# 0.500000006 + 0.5 se guarda como 0.50000001 + 0.5: truncando pasaría la suma
+		self.assertEqual(list(validar({**vacios, 'factor_8': Decimal('0.500000006'), 'factor_9': Decimal('0.5')})), ['__all__'])
+		self.assertEqual(validar({**vacios, 'factor_8': Decimal('0.500000004'), 'factor_9': Decimal('0.5')}), {})
+
+	def test_carga_con_sobrescribir_valida_los_factores_combinados(self):
+		from decimal import Decimal
+		import pandas as pd
+		from .models import CalificacionTributaria, FactorCalificacion
+		from .views import procesar_fila_factores
+		user = Usuario.objects.create_user(correo='reglas@example.com', password='testpass', nombre='Reglas', rol='Analista')
+		calificacion = CalificacionTributaria.objects.create(
+			ejercicio=2024, mercado='ACN', instrumento='UPSERT', fecha_pago='2024-06-01',
+			secuencia_evento=10001, origen='Carga_Masiva', usuario_creador=user,
+		)
+		FactorCalificacion.objects.create(id_calificacion=calificacion, factor_8=Decimal('0.6'))
+		fila = pd.Series({'ejercicio': '2024', 'mercado': 'ACN', 'instrumento': 'UPSERT', 'fecha': '2024-06-01',
+						  'secuencia': '10001', 'factor_9': '0.5'})
+		with self.assertRaisesMessage(ValueError, 'La suma de los factores del 8 al 16'):
+			procesar_fila_factores(fila, True, user)
+		self.assertIsNone(FactorCalificacion.objects.get(id_calificacion=calificacion).factor_9)
+		# Sin sobrescribir la fila existente se omite antes de validar las reglas
+		self.assertFalse(procesar_fila_factores(fila, False, user))
+
+		fila['factor_9'] = '0.4'
+		self.assertTrue(procesar_fila_factores(fila, True, user))
+		factores = FactorCalificacion.objects.get(id_calificacion=calificacion)
+		self.assertEqual((factores.factor_8, factores.factor_9), (Decimal('0.6'), Decimal('0.4')))
+
+
+class AnomaliasTests(TestCase):
+	def setUp(self):
+		self.user = Usuario.objects.create_user(correo='anom@example.com', password='testpass', nombre='Anom', rol='Analista')
+
+	def calificacion(self, instrumento, ejercicio=2024, **factores):
+		from .models import CalificacionTributaria, FactorCalificacion
+		calificacion = CalificacionTributaria.objects.create(
+			ejercicio=ejercicio, mercado='ACN', instrumento=instrumento, fecha_pago=f'{ejercicio}-06-01',
+			secuencia_evento=10001, origen='Carga_Masiva', usuario_creador=self.user,
+		)
+		FactorCalificacion.objects.create(id_calificacion=calificacion, **factores)
+		return calificacion
+
+	def test_detecta_y_reconcilia_la_cola_de_revision(self):
+		from decimal import Decimal
+		from .anomalias import detectar
+		from .models import AnomaliaFactor
+		for i in range(24):
+			self.calificacion(f'I{i}', factor_8=Decimal('0.30') + Decimal(i) / 1000, factor_9=Decimal('0.2'))
+		corrida = self.calificacion('CORRIDA', factor_8=Decimal('0.032'), factor_9=Decimal('0.2'))
+		self.calificacion('CAMBIO', ejercicio=2023, factor_8=Decimal('0.9'), factor_20=Decimal('0.9'))
+		cambio = self.calificacion('CAMBIO', factor_8=Decimal('0.31'), factor_9=Decimal('0.2'), factor_21=Decimal('0.9'))
+
+		resumen = detectar()
+		self.assertEqual((resumen['calificaciones'], resumen['mad'], resumen['ejercicio_anterior']), (27, 1, 1))
+		mad = AnomaliaFactor.objects.get(metodo='MAD')
+		self.assertEqual((mad.id_calificacion, mad.estado), (corrida, 'PENDIENTE'))
+		self.assertTrue(mad.detalle.startswith('factor_8 = 0.03200000'))
+		self.assertEqual(AnomaliaFactor.objects.get(metodo='EJERCICIO_ANTERIOR').id_calificacion, cambio)
+
+		# Descartada por un analista: conserva su estado aunque se vuelva a detectar
+		self.client.login(correo='anom@example.com', password='testpass')
+		anterior = AnomaliaFactor.objects.get(metodo='EJERCICIO_ANTERIOR')
+		resp = self.client.post(reverse('cola_anomalias'), {'id_anomalia': anterior.pk, 'estado': 'DESCARTADA'})
+		self.assertEqual(resp.status_code, 302)
+		# Corregida: la pendiente sale de la cola
+		factores = corrida.factorcalificacion
+		factores.factor_8 = Decimal('0.32')
+		factores.save()
+		detectar()
+		self.assertEqual(list(AnomaliaFactor.objects.values_list('metodo', 'estado', 'revisado_por')),
+						 [('EJERCICIO_ANTERIOR', 'DESCARTADA', self.user.pk)])
+
+		resp = self.client.get(reverse('cola_anomalias'), {'estado': 'DESCARTADA'})
+		self.assertContains(resp, 'Distancia L1 = 2.59000000')
+
+	def test_reconciliacion_acotada_y_tolerante_a_otro_detector(self):
+		from unittest import mock
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		from .anomalias import _reconciliar
+		from .models import AnomaliaFactor
+		historial = [self.calificacion(f'H{i}') for i in range(3)]
+		AnomaliaFactor.objects.bulk_create([
+			AnomaliaFactor(id_calificacion=calificacion, metodo='MAD', puntaje=9, detalle='revisada', estado='DESCARTADA')
+			for calificacion in historial
+		])
+		nueva = self.calificacion('NUEVA')
+
+		# Otro detector inserta la misma anomalía mientras esta corrida reconcilia
+		original = AnomaliaFactor.objects.bulk_update
+		def concurrente(*args, **kwargs):
+			AnomaliaFactor.objects.create(id_calificacion=nueva, metodo='MAD', puntaje=5, detalle='otro proceso')
+			return original(*args, **kwargs)
+		encontradas = {(nueva.pk, 'MAD'): (6.0, 'esta corrida'), (historial[0].pk, 'MAD'): (9.0, 'revisada')}
+		with mock.patch.object(AnomaliaFactor.objects, 'bulk_update', side_effect=concurrente), \
+				CaptureQueriesContext(connection) as ctx:
+			_reconciliar(encontradas)
+		# Nunca se lee la tabla completa: la cola pendiente y las revisadas de las calificaciones encontradas
+		lecturas = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'ANOMALIA_FACTOR' in q['sql']]
+		self.assertTrue(lecturas)
+		self.assertTrue(all('WHERE' in sql for sql in lecturas))
+		self.assertEqual(AnomaliaFactor.objects.get(id_calificacion=nueva).detalle, 'otro proceso')
+		self.assertEqual(AnomaliaFactor.objects.filter(estado='DESCARTADA').count(), 3)
@@ -0,0 +1,92 @@
+"""
+Tokens de API para clientes automatizados.
+
+Formato: nuam_<prefijo>_<secreto>. El prefijo es público y está indexado
+(TOKEN_API.prefijo), así autenticar es una sola consulta por clave única; el
+token completo se guarda como HMAC-SHA256 con SECRET_KEY, un hash rápido que
+basta porque el secreto es aleatorio de 256 bits (no una contraseña).
+
+El resultado de la consulta se cachea TOKEN_API_CACHE_SEGUNDOS por prefijo.
+Revocar o borrar un token invalida su entrada (ver signals.py); los cambios de
+rol o estado del usuario se aplican al vencer el TTL. La invalidación solo
+llega a todos los procesos con un cache compartido: con LocMemCache cada worker
+tiene su copia y la entrada vive como máximo TOKEN_API_CACHE_SEGUNDOS_LOCAL, lo
+que tarda una revocación en aplicarse en los demás.
+"""
+import hmac
+import re
+import secrets
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from .bloqueo import cache_compartido
+from .models import TokenApi
+
+FORMATO_TOKEN = re.compile(r'nuam_([0-9a-f]{12})_([A-Za-z0-9_-]{43})')
+
+
+def _hash(token):
+    return salted_hmac('calificaciones.tokens_api', token, algorithm='sha256').hexdigest()
+
+
+def _clave_cache(prefijo):
+    return f'token_api:{prefijo}'
+
+
+def _segundos():
+    segundos = getattr(settings, 'TOKEN_API_CACHE_SEGUNDOS', 60)
+    if not cache_compartido():
+        return min(segundos, getattr(settings, 'TOKEN_API_CACHE_SEGUNDOS_LOCAL', 5))
+    return segundos
+
+
+def generar(usuario, nombre, dias=None):
+    """Crea un token; retorna (token en claro, TokenApi). El token solo se muestra esta vez"""
+    prefijo = secrets.token_hex(6)
+    token = f'nuam_{prefijo}_{secrets.token_urlsafe(32)}'
+    registro = TokenApi.objects.create(
+        usuario=usuario, nombre=nombre, prefijo=prefijo, hash_token=_hash(token),
+        expira=timezone.now() + timedelta(days=dias) if dias else None,
+    )
+    return token, registro
+
+
+def autenticar(token):
+    """Usuario dueño de `token` si es válido, vigente y el usuario está activo; si no, None"""
+    coincidencia = FORMATO_TOKEN.fullmatch(token or '')
+    if coincidencia is None:
+        return None
+    prefijo = coincidencia.group(1)
+
+    entrada = cache.get(_clave_cache(prefijo))
+    if entrada is None:
+        registro = (TokenApi.objects.select_related('usuario')
+                    .filter(prefijo=prefijo, activo=True, usuario__estado=True)
+                    .first())
+        # También se cachean los prefijos inexistentes, para no consultar por tokens basura
+        entrada = (registro.hash_token, registro.expira, registro.usuario) if registro else ()
+        cache.set(_clave_cache(prefijo), entrada, _segundos())
+        if registro:
+            TokenApi.objects.filter(pk=registro.pk).update(ultimo_uso=timezone.now())
+    if not entrada:
+        return None
+
+    hash_token, expira, usuario = entrada
+    if not hmac.compare_digest(hash_token, _hash(token)):
+        return None
+    if expira is not None and expira <= timezone.now():
+        return None
+    return usuario
+
+
+def revocar(registro):
+    registro.activo = False
+    registro.save(update_fields=['activo'])
+
+
+def invalidar(registro):
+    cache.delete(_clave_cache(registro.prefijo))
@@ -3,6 +3,7 @@ from django.contrib.auth import views as auth_views
 from . import views
 from .decorators import editor_required
 from .forms import CustomPasswordResetForm
+from .limite_tasa import limitar_tasa
 
 urlpatterns = [
     # Autenticación
@@ -11,13 +12,16 @@ urlpatterns = [
     path('perfil/', views.perfil_usuario, name='perfil_usuario'),
 
     # Password reset (Django built-ins)
-    path('password_reset/', auth_views.PasswordResetView.as_view(template_name='calificaciones/password_reset_form.html', form_class=CustomPasswordResetForm), name='password_reset'),
+    path('password_reset/', limitar_tasa('password_reset', cuenta=lambda request: request.POST.get('email'))(
+        auth_views.PasswordResetView.as_view(template_name='calificaciones/password_reset_form.html', form_class=CustomPasswordResetForm)
+    ), name='password_reset'),
     path('password_reset/done/', auth_views.PasswordResetDoneView.as_view(template_name='calificaciones/password_reset_done.html'), name='password_reset_done'),
     path('reset/<uidb64>/<token>/', auth_views.PasswordResetConfirmView.as_view(template_name='calificaciones/password_reset_confirm.html'), name='password_reset_confirm'),
     path('reset/done/', auth_views.PasswordResetCompleteView.as_view(template_name='calificaciones/password_reset_complete.html'), name='password_reset_complete'),
     
     # MFA URLs
     path('mfa/setup/', views.mfa_setup, name='mfa_setup'),
+    path('mfa/qr/', views.mfa_qr, name='mfa_qr'),
     path('mfa/verify/', views.mfa_verify, name='mfa_verify'),
     path('mfa/disable/', views.mfa_disable, name='mfa_disable'),
     
@@ -26,6 +30,23 @@ urlpatterns = [
     path('usuarios/crear/', views.crear_usuario, name='crear_usuario'),
     path('usuarios/editar/<int:user_id>/', views.editar_usuario, name='editar_usuario'),
     path('usuarios/eliminar/<int:usuario_id>/', views.eliminar_usuario, name='eliminar_usuario'),
+
+    # Rendimiento (solo admin)
+    path('rendimiento/', views.reporte_rendimiento, name='reporte_rendimiento'),
+    path('metrics', views.metricas_prometheus, name='metricas'),
+
+    # Auditoría (Admin, Auditor)
+    path('auditoria/', views.explorador_auditoria, name='explorador_auditoria'),
+    path('integridad/', views.reporte_integridad, name='reporte_integridad'),
+    path('anomalias/', views.cola_anomalias, name='cola_anomalias'),
+    path('auditoria/exportar/', views.exportar_auditoria, name='exportar_auditoria'),
+    
+    # API JSON para integraciones
+    path('api/calificaciones/', views.api_crear_calificaciones, name='api_crear_calificaciones'),
+    path('api/calificaciones/ndjson/', views.api_cargar_ndjson, name='api_cargar_ndjson'),
+    path('api/factores/consulta/', views.api_consultar_factores, name='api_consultar_factores'),
+    path('api/factores/vigentes/', views.api_factores_vigentes, name='api_factores_vigentes'),
+    path('api/factores/estadisticas/', views.api_estadisticas_factores, name='api_estadisticas_factores'),
     
     # Calificaciones - Vistas accesibles para todos (solo lectura)
     path('', views.lista_calificaciones, name='lista_calificaciones'),
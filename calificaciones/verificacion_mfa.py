@@ -0,0 +1,87 @@
+"""
+Verificación TOTP compartida por MfaVerifyForm, mfa_verify y mfa_setup.
+
+El dispositivo se obtiene con una sola consulta (con su usuario), la clave
+binaria decodificada se memoiza y el token se compara en tiempo constante
+contra toda la ventana de tolerancia. El `last_t` se avanza con un UPDATE
+condicional, así un mismo código no se acepta dos veces aunque lleguen
+peticiones concurrentes.
+"""
+import base64
+import hmac
+import re
+import time
+from binascii import unhexlify
+from functools import lru_cache
+
+from django.utils import timezone
+from django_otp.oath import hotp
+from django_otp.plugins.otp_totp.models import TOTPDevice
+
+
+def dispositivo_de_usuario(usuario_id):
+    """TOTPDevice del usuario (confirmado primero) con el usuario activo ya cargado"""
+    return (TOTPDevice.objects.select_related('user')
+            .filter(user_id=usuario_id, user__estado=True)
+            .order_by('-confirmed', 'id')
+            .first())
+
+
+@lru_cache(maxsize=1024)
+def _decodificar_clave(clave):
+    clave = clave.strip()
+    try:
+        return unhexlify(clave.encode())
+    except ValueError:
+        pass
+    # Claves heredadas: Base32 o texto plano (mismos criterios que qr_mfa.secreto_base32)
+    normalizada = clave.upper().rstrip('=')
+    if re.fullmatch(r'[A-Z2-7]+', normalizada):
+        return base64.b32decode(normalizada + '=' * (-len(normalizada) % 8))
+    return clave.encode('utf-8')
+
+
+def clave_binaria(device):
+    return _decodificar_clave(device.key or '')
+
+
+def verificar_token(device, token, ahora=None):
+    """True si `token` es válido y no fue usado antes; actualiza el dispositivo en memoria"""
+    permitido, _ = device.verify_is_allowed()
+    if not permitido or not device.key:
+        return False
+
+    ahora = time.time() if ahora is None else ahora
+    clave = clave_binaria(device)
+    t_nominal = (int(ahora) - device.t0) // device.step
+    # Bytes: compare_digest rechaza (TypeError) cadenas con caracteres no ASCII
+    token = str(token).strip().encode()
+
+    coincidencia = None
+    for offset in range(-device.tolerance, device.tolerance + 1):
+        t = t_nominal + device.drift + offset
+        esperado = str(hotp(clave, t, device.digits)).zfill(device.digits).encode()
+        # Sin salida anticipada: se comparan todos los candidatos
+        if hmac.compare_digest(esperado, token) and t > device.last_t and coincidencia is None:
+            coincidencia = (t, device.drift + offset)
+
+    if coincidencia is None:
+        device.throttle_increment(commit=False)
+        TOTPDevice.objects.filter(pk=device.pk).update(
+            throttling_failure_timestamp=device.throttling_failure_timestamp,
+            throttling_failure_count=device.throttling_failure_count,
+        )
+        return False
+
+    t, drift = coincidencia
+    usado = timezone.now()
+    actualizados = TOTPDevice.objects.filter(pk=device.pk, last_t__lt=t).update(
+        last_t=t, drift=drift, last_used_at=usado,
+        throttling_failure_timestamp=None, throttling_failure_count=0,
+    )
+    if not actualizados:
+        # Otra petición ya aceptó este código
+        return False
+    device.last_t, device.drift, device.last_used_at = t, drift, usado
+    device.throttle_reset(commit=False)
+    return True
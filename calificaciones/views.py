@@ -1,22 +1,45 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.conf import settings
 from django.contrib import messages
-from django.http import HttpResponseForbidden
-from .models import CalificacionTributaria, Usuario, FactorCalificacion, LogAuditoria, ArchivoCarga
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods, require_POST
+from .models import CalificacionTributaria, Usuario, FactorCalificacion, LogAuditoria, ArchivoCarga, EscaneoIntegridad, ViolacionIntegridad, AnomaliaFactor
 from .forms import (
     CalificacionTributariaForm, MontosForm, FactoresForm, FiltroCalificacionesForm,
     LoginForm, UsuarioForm, MfaVerifyForm, MfaSetupForm  # AÑADIR LOS NUEVOS FORMULARIOS
 )
 from decimal import Decimal
 from django.contrib.auth.hashers import make_password
+import csv
+import hmac
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from django.utils import timezone
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth import update_session_auth_hash
-from .decorators import administrador_required, analista_required, auditor_required, corredor_required, solo_lectura_required, editor_required
+from .decorators import administrador_required, analista_required, auditor_required, corredor_required, solo_lectura_required, editor_required, api_editor_required, api_solo_lectura_required
 from django.db.models import Count
+from django.core.paginator import Paginator
 from django.views.decorators.csrf import csrf_protect
+from .perfilamiento import registro as registro_rendimiento
+from .metricas import registro as metricas
+from .auditoria import registrar_auditoria
+from .bloqueo import ip_bloqueada, registrar_fallo_ip
+from .limite_tasa import limitar_tasa
+from django.db import IntegrityError, transaction
+from .verificacion_mfa import dispositivo_de_usuario
+from . import borradores
+from .carga_lotes import (
+    avance_archivo, cargar_ndjson, crear_lote, finalizar_archivo, hash_cuerpo, registrar_avance, reservar_archivo,
+)
+from . import anomalias, matriz_factores
+from .reglas import validar as validar_reglas
+from .consulta_factores import buscar_factores, buscar_vigentes, validar_claves, validar_consultas_vigentes
+from .qr_mfa import EMISOR, imagen_qr, secreto_base32, url_otpauth, version_qr
+from .archivo_auditoria import buscar_logs
+from .busqueda_auditoria import filtrar_logs, logs_archivados, pagina_logs
 
 # MFA IMPORTS
 from django_otp.plugins.otp_totp.models import TOTPDevice
@@ -24,21 +47,20 @@ from django_otp import login as otp_login
 from django.contrib.auth import login as auth_login
 import base64
 import pyotp
-import qrcode
-from io import BytesIO
-import urllib.parse
 
 import pandas as pd
 import chardet
 from datetime import datetime
 from django.core.files.storage import FileSystemStorage
 import os
+import time
 from decimal import Decimal
 
 # Asegúrate de que esta importación esté presente:
 from .forms import (
     CalificacionTributariaForm, MontosForm, FactoresForm, FiltroCalificacionesForm,
-    LoginForm, UsuarioForm, MfaVerifyForm, MfaSetupForm, CargaMasivaForm  # ← AÑADIR CargaMasivaForm aquí
+    LoginForm, UsuarioForm, MfaVerifyForm, MfaSetupForm, CargaMasivaForm,  # ← AÑADIR CargaMasivaForm aquí
+    FiltroAuditoriaForm
 )
 
 # ... el resto de tu código de views.py ...
@@ -55,6 +77,8 @@ def carga_masiva(request):
             
             try:
                 resultados = procesar_archivo_carga(archivo, tipo_carga, sobrescribir, request.user)
+                if resultados['procesados']:
+                    anomalias.programar()
                 
                 # Crear registro en ArchivoCarga
                 archivo_carga = ArchivoCarga.objects.create(
@@ -68,7 +92,7 @@ def carga_masiva(request):
                 )
                 
                 # Log de auditoría
-                LogAuditoria.objects.create(
+                registrar_auditoria(
                     accion='CARGA_MASIVA',
                     usuario_responsable=request.user,
                     detalle=f'Carga masiva: {resultados["procesados"]} procesados, {resultados["errores"]} errores',
@@ -140,6 +164,7 @@ def procesar_archivo_carga(archivo, tipo_carga, sobrescribir, usuario):
         'errores': 0,
         'errores_detalle': []
     }
+    inicio = time.perf_counter()
     
     try:
         # Detectar encoding y leer archivo
@@ -210,8 +235,18 @@ def procesar_archivo_carga(archivo, tipo_carga, sobrescribir, usuario):
         
     except Exception as e:
         print(f"Error general al procesar archivo: {e}")
+        metricas.incrementar('nuam_carga_archivos_total', resultado='error')
         raise Exception(f"Error al leer archivo: {str(e)}")
     
+    # Métricas de la carga
+    duracion = time.perf_counter() - inicio
+    metricas.incrementar('nuam_carga_archivos_total', resultado='procesado')
+    metricas.incrementar('nuam_carga_filas_total', resultados['procesados'], resultado='procesado')
+    metricas.incrementar('nuam_carga_filas_total', resultados['errores'], resultado='error')
+    if duracion > 0:
+        filas = resultados['procesados'] + resultados['errores']
+        metricas.observar('nuam_carga_filas_por_segundo', filas / duracion, tipo=tipo_carga)
+    
     return resultados
 
 def procesar_fila_factores(fila, sobrescribir, usuario):
@@ -287,6 +322,17 @@ def procesar_fila_factores(fila, sobrescribir, usuario):
     except ValueError as e:
         raise ValueError(f"Error en tipos de datos: {str(e)}")
     
+    # Convertir factores del 8 al 37 (comas como separadores decimales)
+    valores_factores = {}
+    for i in range(8, 38):
+        factor_key = f'factor_{i}'
+        if factor_key in fila_normalizada and fila_normalizada[factor_key]:
+            try:
+                valores_factores[factor_key] = Decimal(str(fila_normalizada[factor_key]).replace(',', '.'))
+            except Exception as e:
+                print(f"Error convirtiendo {factor_key}: {fila_normalizada[factor_key]} - {e}")
+                valores_factores[factor_key] = None
+    
     # Buscar calificación existente
     calificacion = CalificacionTributaria.objects.filter(
         ejercicio=ejercicio,
@@ -300,6 +346,20 @@ def procesar_fila_factores(fila, sobrescribir, usuario):
         print(f"Registro existente omitido: {instrumento} - {ejercicio} - {secuencia}")
         return False  # Omitir registro existente
     
+    # Reglas de negocio compartidas con los formularios (reglas.py), antes de guardar nada.
+    # Al sobrescribir se validan los factores que quedarán guardados: los existentes con los de la fila encima
+    factores_resultantes = dict.fromkeys(FactorCalificacion.CAMPOS_FACTORES)
+    if calificacion:
+        existentes = FactorCalificacion.objects.filter(id_calificacion=calificacion).values(*FactorCalificacion.CAMPOS_FACTORES).first()
+        factores_resultantes.update(existentes or {})
+    factores_resultantes.update(valores_factores)
+    errores = validar_reglas({
+        'ejercicio': ejercicio, 'fecha_pago': fecha_pago, 'secuencia_evento': secuencia,
+        **factores_resultantes,
+    })
+    if errores:
+        raise ValueError('; '.join(mensaje for mensajes in errores.values() for mensaje in mensajes))
+    
     # Preparar datos para crear/actualizar calificación
     datos_calificacion = {
         'ejercicio': ejercicio,
@@ -346,18 +406,10 @@ def procesar_fila_factores(fila, sobrescribir, usuario):
     
     # Actualizar factores del 8 al 37
     factores_actualizados = 0
-    for i in range(8, 38):
-        factor_key = f'factor_{i}'
-        if factor_key in fila_normalizada and fila_normalizada[factor_key]:
-            try:
-                # Convertir a Decimal, manejando comas como separadores decimales
-                valor_str = str(fila_normalizada[factor_key]).replace(',', '.')
-                valor_decimal = Decimal(valor_str)
-                setattr(factores, factor_key, valor_decimal)
-                factores_actualizados += 1
-            except Exception as e:
-                print(f"Error convirtiendo {factor_key}: {fila_normalizada[factor_key]} - {e}")
-                setattr(factores, factor_key, None)
+    for factor_key, valor_decimal in valores_factores.items():
+        setattr(factores, factor_key, valor_decimal)
+        if valor_decimal is not None:
+            factores_actualizados += 1
     
     if factores_actualizados > 0:
         factores.save()
@@ -376,8 +428,14 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+@limitar_tasa('login', cuenta=lambda request: request.POST.get('username'))
 def login_view(request):
-    """Vista de login personalizada con soporte MFA"""
+    """Vista de login personalizada con bloqueo por intentos fallidos y soporte MFA.
+
+    authenticate() usa CorreoBackend: el usuario se obtiene en una sola consulta
+    (índice sobre LOWER(correo)) junto con la existencia de su dispositivo MFA, y
+    la contraseña se verifica una vez.
+    """
     if request.user.is_authenticated:
         return redirect('lista_calificaciones')
     
@@ -385,93 +443,80 @@ def login_view(request):
     remaining_attempts = None
 
     if request.method == 'POST':
-        form = LoginForm(request, data=request.POST)
+        form = LoginForm(request.POST)
         if form.is_valid():
-            correo = form.cleaned_data.get('username')
-            password = form.cleaned_data.get('password')
-
             # Normalizar correo para evitar issues con espacios o mayúsculas
-            if correo:
-                correo = correo.strip()
-
-            # Intentar localizar usuario por correo para manejar bloqueo
-            usuario_obj = Usuario.objects.filter(correo__iexact=correo).first()
-
+            correo = form.cleaned_data['username'].strip()
+            password = form.cleaned_data['password']
+
+            ip = request.META.get('REMOTE_ADDR')
+            if ip_bloqueada(ip):
+                # Demasiados fallos desde esta IP: no se consulta USUARIO ni se calcula hash
+                messages.error(request, 'Demasiados intentos fallidos desde tu conexión. Intenta más tarde.')
+                return render(request, 'calificaciones/login.html', {'form': form})
+
+            # CorreoBackend deja en request.usuario_login el usuario consultado
+            user = authenticate(request, username=correo, password=password)
+            usuario_obj = getattr(request, 'usuario_login', None)
             logger.debug(f"Login intento para '{correo}' - usuario encontrado: {bool(usuario_obj)}")
-            if usuario_obj:
-                logger.debug(f"Estado: {usuario_obj.estado}, failed_attempts: {usuario_obj.failed_login_attempts}, locked_until: {usuario_obj.locked_until}")
 
             if usuario_obj and usuario_obj.is_locked():
                 locked_until = usuario_obj.locked_until
                 messages.error(request, f'Cuenta bloqueada hasta {locked_until.strftime("%Y-%m-%d %H:%M:%S")}. Intenta más tarde o contacta a un administrador.')
-            else:
-                user = authenticate(request, username=correo, password=password)
-                if user is not None and getattr(user, 'estado', True):
-                    # Reset de intentos fallidos en login exitoso
+            elif user is not None:
+                # Reset de intentos fallidos en login exitoso (solo escribe si hay algo que limpiar)
+                user.reset_failed_login()
+
+                # Si el usuario tiene MFA configurado, redirigir a verificación
+                if user.has_mfa_enabled():
+                    request.session['mfa_user_id'] = user.id
+                    request.session['mfa_backend'] = user.backend
+                    return redirect('mfa_verify')
+                else:
+                    # Login normal sin MFA
+                    auth_login(request, user)
+                    messages.success(request, f'¡Bienvenido {user.nombre}!')
+                    # Redirección según rol
+                    next_url = request.GET.get('next', 'lista_calificaciones')
+                    return redirect(next_url)
+            elif usuario_obj:
+                # Credenciales inválidas: aumentar contador (umbral y minutos coherentes con el modelo)
+                THRESHOLD = 3
+                LOCK_MINUTES = 15
+
+                registrar_fallo_ip(ip)
+                locked = usuario_obj.increment_failed_login(threshold=THRESHOLD, lock_minutes=LOCK_MINUTES)
+                logger.info(f"Después incremento: usuario={usuario_obj.correo}, failed_attempts: {usuario_obj.failed_login_attempts}, locked: {locked}, locked_until: {usuario_obj.locked_until}")
+
+                # Registrar intento fallido en auditoría
+                try:
+                    registrar_auditoria(
+                        accion='LOGIN_FAIL',
+                        usuario_responsable=usuario_obj,
+                        detalle=f'Intento de login fallido desde {request.META.get("REMOTE_ADDR", "-")}'
+                    )
+                except Exception:
+                    pass
+
+                if locked:
+                    # Registrar bloqueo en auditoría
                     try:
-                        if usuario_obj:
-                            usuario_obj.reset_failed_login()
+                        registrar_auditoria(
+                            accion='LOCK_ACCOUNT',
+                            usuario_responsable=usuario_obj,
+                            detalle='Cuenta bloqueada automáticamente por superar intentos fallidos'
+                        )
                     except Exception:
                         pass
-
-                    # Si el usuario tiene MFA configurado, redirigir a verificación
-                    if user.has_mfa_enabled():
-                        request.session['mfa_user_id'] = user.id
-                        request.session['mfa_backend'] = user.backend
-                        return redirect('mfa_verify')
-                    else:
-                        # Login normal sin MFA
-                        auth_login(request, user)
-                        messages.success(request, f'¡Bienvenido {user.nombre}!')
-                        # Redirección según rol
-                        next_url = request.GET.get('next', 'lista_calificaciones')
-                        return redirect(next_url)
+                    messages.error(request, f'Has excedido los intentos permitidos. La cuenta ha sido bloqueada hasta {usuario_obj.locked_until.strftime("%Y-%m-%d %H:%M:%S")}.')
+                    remaining_attempts = 0
                 else:
-                    # Credenciales inválidas: aumentar contador si existe usuario
-                    if usuario_obj:
-                        # Umbral y minutos de bloqueo (coherente con el modelo)
-                        THRESHOLD = 3
-                        LOCK_MINUTES = 15
-
-                        locked = usuario_obj.increment_failed_login(threshold=THRESHOLD, lock_minutes=LOCK_MINUTES)
-                        logger.info(f"Después incremento: usuario={usuario_obj.correo}, failed_attempts: {usuario_obj.failed_login_attempts}, locked: {locked}, locked_until: {usuario_obj.locked_until}")
-
-                        # Registrar intento fallido en auditoría
-                        try:
-                            LogAuditoria.objects.create(
-                                accion='LOGIN_FAIL',
-                                usuario_responsable=usuario_obj,
-                                detalle=f'Intento de login fallido desde {request.META.get("REMOTE_ADDR", "-")}'
-                            )
-                        except Exception:
-                            pass
-
-                        if locked:
-                            # Registrar bloqueo en auditoría
-                            try:
-                                LogAuditoria.objects.create(
-                                    accion='LOCK_ACCOUNT',
-                                    usuario_responsable=usuario_obj,
-                                    detalle='Cuenta bloqueada automáticamente por superar intentos fallidos'
-                                )
-                            except Exception:
-                                pass
-                            messages.error(request, f'Has excedido los intentos permitidos. La cuenta ha sido bloqueada hasta {usuario_obj.locked_until.strftime("%Y-%m-%d %H:%M:%S")}.')
-                            remaining_attempts = 0
-                        else:
-                            remaining_attempts = max(0, THRESHOLD - (usuario_obj.failed_login_attempts or 0))
-                            messages.error(request, f'Credenciales inválidas. Te quedan {remaining_attempts} intentos antes del bloqueo.')
-                    else:
-                        # Intentamos buscar por otras variantes (por si el usuario ingresó un correo con espacios)
-                        alt_correo = correo.strip() if correo else correo
-                        usuario_alt = Usuario.objects.filter(correo__iexact=alt_correo).first() if alt_correo else None
-                        logger.debug(f"Usuario alternativo encontrado: {bool(usuario_alt)}")
-                        if usuario_alt:
-                            usuario_alt.increment_failed_login()
-                            remaining_attempts = None
-                            messages.error(request, 'Credenciales inválidas.')
-                        else:
-                            messages.error(request, 'Credenciales inválidas')
+                    remaining_attempts = max(0, THRESHOLD - (usuario_obj.failed_login_attempts or 0))
+                    messages.error(request, f'Credenciales inválidas. Te quedan {remaining_attempts} intentos antes del bloqueo.')
+            else:
+                # Correo inexistente (CorreoBackend ya calculó un hash igual)
+                registrar_fallo_ip(ip)
+                messages.error(request, 'Credenciales inválidas')
     else:
         form = LoginForm()
 
@@ -510,116 +555,62 @@ def mfa_setup(request):
     
     if request.method == 'POST':
         print("=== MÉTODO POST DETECTADO ===")
-        form = MfaVerifyForm(request.user, request.POST)
-        print(f"Formulario válido: {form.is_valid()}")
-        print(f"Errores del formulario: {form.errors}")
+        # El formulario verifica el token contra este mismo dispositivo
+        form = MfaVerifyForm(request.user, request.POST, device=device)
         
         if form.is_valid():
             print("=== FORMULARIO VÁLIDO ===")
-            # Verificar manualmente el token
-            token = form.cleaned_data['token']
-            print(f"Token recibido: {token}")
+            device.confirmed = True
+            device.save()
+            messages.success(request, '✅ MFA configurado exitosamente!')
             
-            is_valid = device.verify_token(token)
-            print(f"Token válido: {is_valid}")
+            registrar_auditoria(
+                accion='MFA_SETUP',
+                usuario_responsable=request.user,
+                detalle='Configuración de MFA/2FA',
+                ip_origen=request.META.get('REMOTE_ADDR', '127.0.0.1')
+            )
             
-            if is_valid:
-                device.confirmed = True
-                device.save()
-                messages.success(request, '✅ MFA configurado exitosamente!')
-                
-                LogAuditoria.objects.create(
-                    accion='MFA_SETUP',
-                    usuario_responsable=request.user,
-                    detalle='Configuración de MFA/2FA',
-                    ip_origen=request.META.get('REMOTE_ADDR', '127.0.0.1')
-                )
-                
-                return redirect('perfil_usuario')
-            else:
-                messages.error(request, '❌ Código de verificación inválido.')
-                print("Token inválido según verify_token")
+            return redirect('perfil_usuario')
         else:
-            print("=== FORMULARIO INVÁLIDO ===")
-            messages.error(request, '❌ Por favor corrige los errores en el formulario.')
+            print(f"Errores del formulario: {form.errors}")
+            messages.error(request, '❌ Código de verificación inválido.')
     else:
         print("=== MÉTODO GET ===")
-        form = MfaVerifyForm(request.user)
+        form = MfaVerifyForm(request.user, device=device)
     
-    # Generar QR code
-    issuer = "NUAM Calificaciones"
+    # El QR se sirve aparte (mfa_qr); `qr_version` cambia si cambia el secreto
     account_name = f"{request.user.correo}"
-    
-    # TOTP secret should be provided as Base32 for authenticator apps.
-    # The device `key` can be stored in different formats (hex, base32, raw); handle robustly.
-    import re
+    secret_b32 = secreto_base32(device)
 
-    secret_b32 = None
-    try:
-        # Preferred: device.bin_key returns binary bytes when key is hex
-        secret_b32 = base64.b32encode(device.bin_key).decode('utf-8').strip('=').upper()
-    except Exception:
-        # If bin_key failed (non-hex key), try to derive Base32 from various formats
-        raw_key = getattr(device, 'key', None)
-        if raw_key:
-            raw_key_str = str(raw_key).strip()
-            # If it already looks like Base32 (A-Z2-7) use it (normalize)
-            if re.fullmatch(r'[A-Z2-7]+=*', raw_key_str.upper()):
-                secret_b32 = raw_key_str.upper().strip('=')
-            else:
-                # Fallback: base32-encode the bytes of the stored key string
-                try:
-                    secret_b32 = base64.b32encode(raw_key_str.encode('utf-8')).decode('utf-8').strip('=').upper()
-                except Exception:
-                    # Last ditch fallback: use hex representation of bin_key if available
-                    try:
-                        secret_b32 = base64.b32encode(device.bin_key).decode('utf-8').strip('=').upper()
-                    except Exception:
-                        secret_b32 = raw_key_str.upper()
-        else:
-            secret_b32 = ''
-
-    otpauth_url = (
-        f"otpauth://totp/{urllib.parse.quote(issuer)}:{urllib.parse.quote(account_name)}"
-        f"?secret={secret_b32}&issuer={urllib.parse.quote(issuer)}&digits=6&algorithm=SHA1&period=30"
-    )
-    
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-    qr.add_data(otpauth_url)
-
-    qr_is_svg = False
-    try:
-        # Prefer PNG via Pillow when available
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        qr_code = base64.b64encode(buffer.getvalue()).decode()
-        qr_is_svg = False
-    except Exception:
-        # Pillow not available or failed — fallback to SVG (no PIL dependency)
-        try:
-            from qrcode.image.svg import SvgImage
-            buffer = BytesIO()
-            img = qr.make_image(image_factory=SvgImage)
-            img.save(buffer)
-            svg = buffer.getvalue().decode('utf-8')
-            qr_code = svg
-            qr_is_svg = True
-        except Exception:
-            # As a last resort, set empty QR (template will show only secret)
-            qr_code = ''
-            qr_is_svg = False
-    
     context = {
         'form': form,
-        'qr_code': qr_code,
-        'qr_is_svg': qr_is_svg,
+        'qr_version': version_qr(url_otpauth(secret_b32, account_name)),
         'secret_key': secret_b32,
         'account_name': account_name,
-        'issuer': issuer,
+        'issuer': EMISOR,
     }
     return render(request, 'calificaciones/mfa_setup.html', context)
 
+@login_required
+def mfa_qr(request):
+    """Imagen QR del dispositivo MFA pendiente de confirmar (cacheable por el navegador)"""
+    device = TOTPDevice.objects.filter(user=request.user, name='default', confirmed=False).first()
+    if device is None:
+        # Con MFA ya confirmado el secreto no se vuelve a exponer
+        return HttpResponse(status=404)
+
+    contenido, content_type, version = imagen_qr(url_otpauth(secreto_base32(device), request.user.correo))
+    etag = f'"{version}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(contenido, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=600'
+    return response
+
+@limitar_tasa('mfa_verify', cuenta=lambda request: request.session.get('mfa_user_id'))
 def mfa_verify(request):
     """Vista para verificar token MFA después del login"""
     user_id = request.session.get('mfa_user_id')
@@ -629,15 +620,15 @@ def mfa_verify(request):
         messages.error(request, 'Sesión inválida.')
         return redirect('login')
     
-    try:
-        user = Usuario.objects.get(id=user_id, estado=True)
-    except Usuario.DoesNotExist:
+    # Una consulta: dispositivo + usuario activo; el formulario lo reutiliza
+    device = dispositivo_de_usuario(user_id)
+    if device is None:
         messages.error(request, 'Usuario no encontrado.')
         return redirect('login')
+    user = device.user
     
     if request.method == 'POST':
-        # CORREGIDO: Pasar el usuario como primer argumento
-        form = MfaVerifyForm(user, request.POST)
+        form = MfaVerifyForm(user, request.POST, device=device)
         if form.is_valid():
             # Login exitoso con MFA
             user.backend = backend
@@ -651,7 +642,7 @@ def mfa_verify(request):
             messages.success(request, f'¡Bienvenido {user.nombre}!')
             
             # Log de auditoría
-            LogAuditoria.objects.create(
+            registrar_auditoria(
                 accion='LOGIN',
                 usuario_responsable=user,
                 detalle='Inicio de sesión con MFA/2FA',
@@ -663,8 +654,7 @@ def mfa_verify(request):
         else:
             messages.error(request, 'Código de verificación inválido.')
     else:
-        # CORREGIDO: Pasar el usuario como primer argumento
-        form = MfaVerifyForm(user)
+        form = MfaVerifyForm(user, device=device)
     
     context = {
         'form': form,
@@ -681,7 +671,7 @@ def mfa_disable(request):
             messages.success(request, 'MFA desactivado exitosamente.')
             
             # Log de auditoría
-            LogAuditoria.objects.create(
+            registrar_auditoria(
                 accion='MFA_DISABLE',
                 usuario_responsable=request.user,
                 detalle='Desactivación de MFA/2FA',
@@ -728,36 +718,6 @@ class DateTimeEncoder(json.JSONEncoder):
             return obj.isoformat()
         return super().default(obj)
 
-def convertir_fechas_para_sesion(datos):
-    """Convierte objetos date/datetime a strings para la sesión"""
-    datos_serializables = {}
-    for key, value in datos.items():
-        if isinstance(value, (date, datetime)):
-            datos_serializables[key] = value.isoformat()
-        elif isinstance(value, Decimal):
-            datos_serializables[key] = str(value)
-        else:
-            datos_serializables[key] = value
-    return datos_serializables
-
-def convertir_fechas_desde_sesion(datos):
-    """Convierte strings de fecha de vuelta a objetos date"""
-    datos_convertidos = {}
-    for key, value in datos.items():
-        if key in ['fecha_pago', 'fecha_emision', 'fecha_vencimiento'] and isinstance(value, str):
-            try:
-                datos_convertidos[key] = date.fromisoformat(value)
-            except ValueError:
-                datos_convertidos[key] = value
-        elif isinstance(value, str) and value.replace('.', '').replace('-', '').isdigit():
-            try:
-                datos_convertidos[key] = Decimal(value)
-            except:
-                datos_convertidos[key] = value
-        else:
-            datos_convertidos[key] = value
-    return datos_convertidos
-
 # 🔐 AQUÍ FALTABAN LOS DECORADORES - AHORA CORREGIDO:
 
 
@@ -852,11 +812,8 @@ def crear_calificacion_paso1(request):
     if request.method == 'POST':
         form = CalificacionTributariaForm(request.POST)
         if form.is_valid():
-            # Convertir datos para la sesión (fechas a strings)
-            datos_serializables = convertir_fechas_para_sesion(form.cleaned_data)
-            
-            # Guardar en sesión para el siguiente paso
-            request.session['calificacion_paso1'] = datos_serializables
+            # Guardar en el borrador para el siguiente paso
+            borradores.iniciar(request.user, borradores.CREAR, form.cleaned_data)
             return redirect('crear_calificacion_paso2')
     else:
         form = CalificacionTributariaForm()
@@ -869,20 +826,16 @@ def crear_calificacion_paso1(request):
 def crear_calificacion_paso2(request):
     """Segundo paso: Ingreso de montos - ACCESIBLE PARA EDITORES"""
     # Verificar que vengamos del paso 1
-    datos_paso1_serializados = request.session.get('calificacion_paso1')
-    if not datos_paso1_serializados:
+    borrador = borradores.obtener(request.user, borradores.CREAR)
+    if borrador is None:
         messages.warning(request, 'Por favor complete primero los datos básicos.')
         return redirect('crear_calificacion_paso1')
+    datos_paso1 = borrador.datos_basicos
     
     # Si es Corredor, verificar que el origen sea Corredor
-    if request.user.rol == 'Corredor':
-        datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
-        if datos_paso1.get('origen') != 'Corredor':
-            messages.error(request, 'No tienes permisos para crear calificaciones de este origen.')
-            return redirect('lista_calificaciones')
-    
-    # Resto del código igual...
-    datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
+    if request.user.rol == 'Corredor' and datos_paso1.get('origen') != 'Corredor':
+        messages.error(request, 'No tienes permisos para crear calificaciones de este origen.')
+        return redirect('lista_calificaciones')
     
     if request.method == 'POST':
         form = MontosForm(request.POST)
@@ -901,17 +854,7 @@ def crear_calificacion_paso2(request):
                             factor_key = f'factor{key[5:]}'
                             factores[factor_key] = value / base_value
             
-            factores_serializables = {}
-            for key, value in factores.items():
-                if isinstance(value, Decimal):
-                    factores_serializables[key] = str(value)
-                else:
-                    factores_serializables[key] = value
-            
-            montos_serializables = convertir_fechas_para_sesion(form.cleaned_data)
-            
-            request.session['montos_paso2'] = montos_serializables
-            request.session['factores_calculados'] = factores_serializables
+            borradores.guardar_montos(request.user, borradores.CREAR, form.cleaned_data, factores)
             return redirect('crear_calificacion_paso3')
     else:
         form = MontosForm()
@@ -927,42 +870,48 @@ def crear_calificacion_paso2(request):
 @editor_required
 def crear_calificacion_paso3(request):
     """Tercer paso: Factores - ACCESIBLE PARA EDITORES"""
-    # Verificar permisos para Corredor
-    if request.user.rol == 'Corredor':
-        datos_paso1_serializados = request.session.get('calificacion_paso1')
-        if datos_paso1_serializados:
-            datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
-            if datos_paso1.get('origen') != 'Corredor':
-                messages.error(request, 'No tienes permisos para crear calificaciones de este origen.')
-                return redirect('lista_calificaciones')
-    
-    # Resto del código igual...
-    datos_paso1_serializados = request.session.get('calificacion_paso1')
-    montos_paso2_serializados = request.session.get('montos_paso2', {})
-    factores_calculados_serializados = request.session.get('factores_calculados', {})
-    
-    if not datos_paso1_serializados:
+    borrador = borradores.obtener(request.user, borradores.CREAR)
+    if borrador is None:
         messages.warning(request, 'Por favor complete los pasos anteriores.')
         return redirect('crear_calificacion_paso1')
+    datos_paso1, montos_paso2, factores_calculados = borrador
     
-    datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
-    montos_paso2 = convertir_fechas_desde_sesion(montos_paso2_serializados)
-    factores_calculados = convertir_fechas_desde_sesion(factores_calculados_serializados)
+    # Verificar permisos para Corredor
+    if request.user.rol == 'Corredor' and datos_paso1.get('origen') != 'Corredor':
+        messages.error(request, 'No tienes permisos para crear calificaciones de este origen.')
+        return redirect('lista_calificaciones')
     
     if request.method == 'POST':
         form = FactoresForm(request.POST)
         if form.is_valid():
             try:
-                # Verificar si ya existe una calificación con los mismos datos únicos
-                existe_calificacion = CalificacionTributaria.objects.filter(
-                    ejercicio=datos_paso1['ejercicio'],
-                    mercado=datos_paso1['mercado'],
-                    instrumento=datos_paso1['instrumento'],
-                    secuencia_evento=datos_paso1['secuencia_evento'],
-                    estado=True
-                ).exists()
+                factores_data = form.cleaned_data
+                campos_modelo = [f.name for f in FactorCalificacion._meta.get_fields()]
+                factores_filtrados = {k: v for k, v in factores_data.items() if k in campos_modelo}
                 
-                if existe_calificacion:
+                # Calificación, factores y auditoría en una sola transacción; el
+                # duplicado lo detecta el unique_together (sin consulta previa)
+                with transaction.atomic():
+                    calificacion = CalificacionTributaria(usuario_creador=request.user, **datos_paso1)
+                    try:
+                        with transaction.atomic():
+                            calificacion.save()
+                    except IntegrityError:
+                        calificacion = None
+                    
+                    if calificacion is not None:
+                        FactorCalificacion.objects.create(id_calificacion=calificacion, **factores_filtrados)
+                        # Dentro de atomic la auditoría se escribe de forma síncrona
+                        registrar_auditoria(
+                            accion='CREATE',
+                            usuario_responsable=request.user,
+                            id_calificacion=calificacion,
+                            detalle='Creación manual de calificación tributaria',
+                            ip_origen=request.META.get('REMOTE_ADDR', '127.0.0.1')
+                        )
+                        borradores.descartar(request.user, borradores.CREAR)
+                
+                if calificacion is None:
                     messages.error(
                         request, 
                         f'Ya existe una calificación con los mismos datos: '
@@ -974,42 +923,6 @@ def crear_calificacion_paso3(request):
                     )
                     return redirect('crear_calificacion_paso1')
                 
-                usuario_creador = request.user
-                
-                # Crear calificación tributaria
-                calificacion = CalificacionTributaria(
-                    usuario_creador=usuario_creador,
-                    **datos_paso1
-                )
-                calificacion.save()
-                
-                # Crear factores de calificación
-                factores_data = form.cleaned_data
-                campos_modelo = [f.name for f in FactorCalificacion._meta.get_fields()]
-                factores_filtrados = {k: v for k, v in factores_data.items() if k in campos_modelo}
-                
-                factores = FactorCalificacion(
-                    id_calificacion=calificacion,
-                    **factores_filtrados
-                )
-                factores.save()
-                
-                LogAuditoria.objects.create(
-                    accion='CREATE',
-                    usuario_responsable=request.user,
-                    id_calificacion=calificacion,
-                    detalle='Creación manual de calificación tributaria',
-                    ip_origen=request.META.get('REMOTE_ADDR', '127.0.0.1')
-                )
-                
-                # Limpiar sesión
-                if 'calificacion_paso1' in request.session:
-                    del request.session['calificacion_paso1']
-                if 'montos_paso2' in request.session:
-                    del request.session['montos_paso2']
-                if 'factores_calculados' in request.session:
-                    del request.session['factores_calculados']
-                
                 messages.success(request, '¡Calificación tributaria creada exitosamente!')
                 return redirect('lista_calificaciones')
                 
@@ -1041,7 +954,7 @@ def eliminar_calificacion(request, id_calificacion):
             calificacion.save()
             
             # Log de eliminación
-            LogAuditoria.objects.create(
+            registrar_auditoria(
                 accion='DELETE',
                 usuario_responsable=request.user,  # CORREGIDO
                 id_calificacion=calificacion,
@@ -1073,9 +986,7 @@ def editar_calificacion_paso1(request, id_calificacion):
             if request.user.rol == 'Corredor':
                 datos['origen'] = 'Corredor'
             
-            datos_serializables = convertir_fechas_para_sesion(datos)
-            request.session['edicion_calificacion'] = id_calificacion
-            request.session['calificacion_paso1'] = datos_serializables
+            borradores.iniciar(request.user, borradores.clave_edicion(id_calificacion), datos)
             return redirect('editar_calificacion_paso2', id_calificacion=id_calificacion)
     else:
         form = CalificacionTributariaForm(instance=calificacion)
@@ -1099,17 +1010,12 @@ def editar_calificacion_paso2(request, id_calificacion):
     if request.user.rol == 'Corredor' and calificacion.origen != 'Corredor':
         return HttpResponseForbidden("No tienes permisos para editar esta calificación")
     
-    # Resto del código igual...
-    if request.session.get('edicion_calificacion') != id_calificacion:
+    clave = borradores.clave_edicion(id_calificacion)
+    borrador = borradores.obtener(request.user, clave)
+    if borrador is None:
         messages.warning(request, 'Por favor complete primero los datos básicos.')
         return redirect('editar_calificacion_paso1', id_calificacion=id_calificacion)
-    
-    datos_paso1_serializados = request.session.get('calificacion_paso1')
-    if not datos_paso1_serializados:
-        messages.warning(request, 'Por favor complete primero los datos básicos.')
-        return redirect('editar_calificacion_paso1', id_calificacion=id_calificacion)
-    
-    datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
+    datos_paso1 = borrador.datos_basicos
     
     if request.method == 'POST':
         form = MontosForm(request.POST)
@@ -1127,11 +1033,7 @@ def editar_calificacion_paso2(request, id_calificacion):
                             factor_key = f'factor{key[5:]}'
                             factores[factor_key] = value / base_value
             
-            montos_serializables = convertir_fechas_para_sesion(form.cleaned_data)
-            factores_serializables = convertir_fechas_para_sesion(factores)
-            
-            request.session['montos_paso2'] = montos_serializables
-            request.session['factores_calculados'] = factores_serializables
+            borradores.guardar_montos(request.user, clave, form.cleaned_data, factores)
             return redirect('editar_calificacion_paso3', id_calificacion=id_calificacion)
     else:
         form = MontosForm()
@@ -1157,20 +1059,12 @@ def editar_calificacion_paso3(request, id_calificacion):
     
     factores_existentes = get_object_or_404(FactorCalificacion, id_calificacion=calificacion)
     
-    # Resto del código igual...
-    if request.session.get('edicion_calificacion') != id_calificacion:
-        messages.warning(request, 'Por favor complete los pasos anteriores.')
-        return redirect('editar_calificacion_paso1', id_calificacion=id_calificacion)
-    
-    datos_paso1_serializados = request.session.get('calificacion_paso1')
-    factores_calculados_serializados = request.session.get('factores_calculados', {})
-    
-    if not datos_paso1_serializados:
+    clave = borradores.clave_edicion(id_calificacion)
+    borrador = borradores.obtener(request.user, clave)
+    if borrador is None:
         messages.warning(request, 'Por favor complete los pasos anteriores.')
         return redirect('editar_calificacion_paso1', id_calificacion=id_calificacion)
-    
-    datos_paso1 = convertir_fechas_desde_sesion(datos_paso1_serializados)
-    factores_calculados = convertir_fechas_desde_sesion(factores_calculados_serializados)
+    datos_paso1, factores_calculados = borrador.datos_basicos, borrador.factores
     
     if request.method == 'POST':
         form = FactoresForm(request.POST, instance=factores_existentes)
@@ -1186,7 +1080,7 @@ def editar_calificacion_paso3(request, id_calificacion):
                 factores.id_calificacion = calificacion
                 factores.save()
                 
-                LogAuditoria.objects.create(
+                registrar_auditoria(
                     accion='UPDATE',
                     usuario_responsable=request.user,
                     id_calificacion=calificacion,
@@ -1194,11 +1088,7 @@ def editar_calificacion_paso3(request, id_calificacion):
                     ip_origen=request.META.get('REMOTE_ADDR', '127.0.0.1')
                 )
                 
-                # Limpiar sesión
-                request.session.pop('edicion_calificacion', None)
-                request.session.pop('calificacion_paso1', None)
-                request.session.pop('montos_paso2', None)
-                request.session.pop('factores_calculados', None)
+                borradores.descartar(request.user, clave)
                 
                 messages.success(request, '¡Calificación tributaria actualizada exitosamente!')
                 return redirect('lista_calificaciones')
@@ -1236,8 +1126,9 @@ def detalle_calificacion(request, id_calificacion):
         factores = None
         messages.warning(request, 'No se encontraron factores asociados a esta calificación.')
     
-    # Obtener logs de auditoría relacionados
-    logs = LogAuditoria.objects.filter(id_calificacion=calificacion).order_by('-fecha_hora')
+    # Logs de auditoría relacionados, también los ya movidos al archivo mensual. Un día de
+    # margen antes de la creación: los eventos encolados conservan la hora en que ocurrieron
+    logs = buscar_logs(desde=calificacion.fecha_creacion - timedelta(days=1), id_calificacion_id=calificacion.pk)
     
     context = {
         'calificacion': calificacion,
@@ -1246,61 +1137,6 @@ def detalle_calificacion(request, id_calificacion):
     }
     return render(request, 'calificaciones/detalle.html', context)
 
-def login_view(request):
-    """Vista de login personalizada con bloqueo por intentos fallidos y soporte MFA"""
-    if request.user.is_authenticated:
-        return redirect('lista_calificaciones')
-
-    if request.method == 'POST':
-        form = LoginForm(request, data=request.POST)
-        if form.is_valid():
-            correo = form.cleaned_data.get('username')
-            password = form.cleaned_data.get('password')
-
-            # Intentar localizar usuario por correo para manejar bloqueo
-            usuario_obj = Usuario.objects.filter(correo__iexact=correo).first()
-
-            if usuario_obj and usuario_obj.is_locked():
-                locked_until = usuario_obj.locked_until
-                messages.error(request, f'Cuenta bloqueada hasta {locked_until.strftime("%Y-%m-%d %H:%M:%S")}. Intenta más tarde o contacta a un administrador.')
-            else:
-                user = authenticate(request, username=correo, password=password)
-                if user is not None and user.estado:
-                    # Reset de intentos fallidos en login exitoso
-                    try:
-                        usuario_obj.reset_failed_login()
-                    except Exception:
-                        pass
-
-                    # Si el usuario tiene MFA configurado, redirigir a verificación
-                    if user.has_mfa_enabled():
-                        request.session['mfa_user_id'] = user.id
-                        request.session['mfa_backend'] = user.backend
-                        return redirect('mfa_verify')
-                    else:
-                        # Login normal sin MFA
-                        auth_login(request, user)
-                        messages.success(request, f'¡Bienvenido {user.nombre}!')
-                        # Redirección según rol
-                        next_url = request.GET.get('next', 'lista_calificaciones')
-                        return redirect(next_url)
-                else:
-                    # Credenciales inválidas: aumentar contador si existe usuario
-                    if usuario_obj:
-                        usuario_obj.increment_failed_login()
-                        # Si quedó bloqueado al incrementar, notifica
-                        if usuario_obj.is_locked():
-                            messages.error(request, 'Has excedido los intentos permitidos. La cuenta ha sido bloqueada temporalmente.')
-                        else:
-                            remaining = max(0, 3 - (usuario_obj.failed_login_attempts or 0))
-                            messages.error(request, f'Credenciales inválidas. Te quedan {remaining} intentos antes del bloqueo.')
-                    else:
-                        messages.error(request, 'Credenciales inválidas')
-    else:
-        form = LoginForm()
-
-    return render(request, 'calificaciones/login.html', {'form': form})
-
 @csrf_protect
 def logout_view(request):
     """Vista de logout"""
@@ -1382,6 +1218,138 @@ def editar_usuario(request, user_id):
     
     return render(request, 'calificaciones/editar_usuario.html', {'form': form, 'usuario': usuario})
 
+@login_required
+@administrador_required
+def reporte_rendimiento(request):
+    """Reporte de rendimiento por vista (percentiles y SQL más lento) - solo administradores"""
+    if request.method == 'POST' and 'limpiar' in request.POST:
+        registro_rendimiento.limpiar()
+        messages.success(request, 'Muestras de rendimiento eliminadas.')
+        return redirect('reporte_rendimiento')
+
+    context = {
+        'resumen': registro_rendimiento.resumen_por_vista(),
+        'sql_lentos': registro_rendimiento.sql_mas_lentos(),
+        'total_muestras': len(registro_rendimiento.muestras()),
+        'tasa_muestreo': settings.PERFILAMIENTO_TASA_MUESTREO,
+    }
+    return render(request, 'calificaciones/reporte_rendimiento.html', context)
+
+@login_required
+@auditor_required
+def explorador_auditoria(request):
+    """Explorador de logs de auditoría con búsqueda de texto y paginación por cursor"""
+    form = FiltroAuditoriaForm(request.GET or None)
+    filtros = form.cleaned_data if form.is_valid() else {}
+
+    cursor = request.GET.get('cursor')
+    archivados = logs_archivados(filtros, cursor) if filtros.get('incluir_archivo') else None
+    logs, siguiente = pagina_logs(filtrar_logs(filtros), cursor, archivados)
+
+    parametros = request.GET.copy()
+    parametros.pop('cursor', None)
+    context = {
+        'form': form,
+        'logs': logs,
+        'cursor_siguiente': siguiente,
+        'parametros': parametros.urlencode(),
+    }
+    return render(request, 'calificaciones/explorador_auditoria.html', context)
+
+
+@login_required
+@auditor_required
+def reporte_integridad(request):
+    """Violaciones de las reglas de factores detectadas por el escáner de integridad"""
+    regla = request.GET.get('regla') or None
+    violaciones = ViolacionIntegridad.objects.select_related('id_calificacion').order_by('-fecha_deteccion', '-id_violacion')
+    if regla:
+        violaciones = violaciones.filter(regla=regla)
+    pagina = Paginator(violaciones, 50).get_page(request.GET.get('page'))
+
+    por_regla = dict(ViolacionIntegridad.objects.values_list('regla').annotate(total=Count('id_violacion')).order_by())
+    context = {
+        'pagina': pagina,
+        'regla': regla,
+        'reglas': [(codigo, nombre, por_regla.get(codigo, 0)) for codigo, nombre in ViolacionIntegridad.REGLA_OPCIONES],
+        'escaneos': EscaneoIntegridad.objects.order_by('-inicio')[:10],
+    }
+    return render(request, 'calificaciones/reporte_integridad.html', context)
+
+
+@login_required
+@analista_required
+def cola_anomalias(request):
+    """Cola de revisión de las anomalías de factores detectadas por anomalias.py"""
+    if request.method == 'POST':
+        estado = request.POST.get('estado')
+        if estado in ('CONFIRMADA', 'DESCARTADA'):
+            revisadas = AnomaliaFactor.objects.filter(pk=request.POST.get('id_anomalia'), estado='PENDIENTE').update(
+                estado=estado, revisado_por=request.user, fecha_revision=timezone.now(),
+            )
+            if revisadas:
+                messages.success(request, f'Anomalía marcada como {estado.lower()}')
+        return redirect(request.get_full_path())
+
+    estado = request.GET.get('estado') or 'PENDIENTE'
+    anomalias_filtradas = AnomaliaFactor.objects.select_related('id_calificacion', 'revisado_por').filter(estado=estado)
+    metodo = request.GET.get('metodo') or None
+    if metodo:
+        anomalias_filtradas = anomalias_filtradas.filter(metodo=metodo)
+    pagina = Paginator(anomalias_filtradas.order_by('-puntaje', 'id_anomalia'), 50).get_page(request.GET.get('page'))
+
+    por_metodo = dict(AnomaliaFactor.objects.filter(estado=estado).values_list('metodo').annotate(total=Count('id_anomalia')).order_by())
+    context = {
+        'pagina': pagina,
+        'estado': estado,
+        'estados': AnomaliaFactor.ESTADO_OPCIONES,
+        'metodo': metodo,
+        'metodos': [(codigo, nombre, por_metodo.get(codigo, 0)) for codigo, nombre in AnomaliaFactor.METODO_OPCIONES],
+    }
+    return render(request, 'calificaciones/cola_anomalias.html', context)
+
+
+class _EcoCSV:
+    """Pseudo-buffer para csv.writer: devuelve la línea en lugar de escribirla"""
+    def write(self, valor):
+        return valor
+
+
+@login_required
+@auditor_required
+def exportar_auditoria(request):
+    """Exporta a CSV (en streaming) todos los logs que cumplen los filtros"""
+    form = FiltroAuditoriaForm(request.GET or None)
+    filtros = form.cleaned_data if form.is_valid() else {}
+
+    def filas():
+        writer = csv.writer(_EcoCSV())
+        yield writer.writerow(['id_log', 'fecha_hora', 'accion', 'usuario', 'id_calificacion', 'detalle', 'ip_origen', 'archivado'])
+        columnas = ('id_log', 'fecha_hora', 'accion', 'usuario_nombre', 'id_calificacion_id', 'detalle', 'ip_origen')
+        for fila in filtrar_logs(filtros).order_by('-fecha_hora', '-id_log').values_list(*columnas).iterator(chunk_size=2000):
+            yield writer.writerow(list(fila) + [False])
+        if filtros.get('incluir_archivo'):
+            for log in logs_archivados(filtros):
+                yield writer.writerow([getattr(log, c) for c in columnas] + [True])
+
+    response = StreamingHttpResponse(filas(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="auditoria.csv"'
+    return response
+
+def metricas_prometheus(request):
+    """Endpoint /metrics en formato de exposición de Prometheus.
+
+    Exige "Authorization: Bearer <METRICAS_TOKEN>"; sin token configurado, solo
+    lo ve un usuario staff con sesión iniciada.
+    """
+    token = getattr(settings, 'METRICAS_TOKEN', '')
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            return HttpResponseForbidden("Token de métricas inválido")
+    elif not request.user.is_staff:
+        return HttpResponseForbidden("Configure METRICAS_TOKEN o inicie sesión como staff")
+    return HttpResponse(metricas.exposicion(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required
 @corredor_required
 def crear_calificacion_corredor_paso1(request):
@@ -1393,11 +1361,191 @@ def crear_calificacion_corredor_paso1(request):
             datos = form.cleaned_data
             datos['origen'] = 'Corredor'
             
-            datos_serializables = convertir_fechas_para_sesion(datos)
-            request.session['calificacion_paso1'] = datos_serializables
+            borradores.iniciar(request.user, borradores.CREAR, datos)
             return redirect('crear_calificacion_paso2')
     else:
         form = CalificacionTributariaForm()
     
     context = {'form': form, 'paso_actual': 1, 'es_corredor': True}
-    return render(request, 'calificaciones/crear_paso1.html', context)
\ No newline at end of file
+    return render(request, 'calificaciones/crear_paso1.html', context)
+
+@require_POST
+@api_editor_required
+def api_crear_calificaciones(request):
+    """API JSON: crea un lote de calificaciones con sus factores.
+
+    El cuerpo es una lista de objetos con los campos de CalificacionTributariaForm
+    y `factores` ({"factor_8": "0.5", ...}); la respuesta trae un resultado por ítem.
+    """
+    maximo_bytes = getattr(settings, 'API_MAX_BYTES', 20 * 1024 * 1024)
+    try:
+        if int(request.META.get('CONTENT_LENGTH') or 0) > maximo_bytes:
+            return JsonResponse({'error': f'El cuerpo supera {maximo_bytes} bytes'}, status=413)
+        # json.load lee del stream de la petición (sin el límite de request.body)
+        items = json.load(request, parse_float=Decimal)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    if not isinstance(items, list):
+        return JsonResponse({'error': 'Se esperaba una lista de calificaciones'}, status=400)
+    maximo = getattr(settings, 'API_MAX_CALIFICACIONES', 5000)
+    if len(items) > maximo:
+        return JsonResponse({'error': f'Máximo {maximo} calificaciones por petición'}, status=413)
+
+    resultados = crear_lote(items, request.user, ip_origen=request.META.get('REMOTE_ADDR'))
+    creados = sum(1 for resultado in resultados if resultado['estado'] == 'creado')
+    if creados:
+        anomalias.programar()
+    return JsonResponse({'creados': creados, 'errores': len(resultados) - creados, 'resultados': resultados})
+
+
+def _respuesta_carga(archivo, **kwargs):
+    return JsonResponse({
+        'archivo': archivo.id_archivo,
+        'estado': archivo.estado_proceso,
+        'procesados': archivo.registros_procesados,
+        'errores': archivo.registros_error,
+        'detalle_errores': json.loads(archivo.errores_detalle or '[]'),
+    }, **kwargs)
+
+@require_POST
+@api_editor_required
+def api_cargar_ndjson(request):
+    """API NDJSON: una calificación JSON por línea, procesada por lotes mientras se lee el cuerpo.
+
+    `?sobrescribir=1` actualiza las calificaciones existentes. Con el encabezado
+    Idempotency-Key, un reintento con la misma clave y el mismo cuerpo retorna el
+    resultado de la carga original sin volver a procesarla; con otro cuerpo, 422.
+    Si la carga original falló a mitad del cuerpo, el reintento sigue desde el
+    último lote confirmado.
+    """
+    if request.content_type not in ('application/x-ndjson', 'application/jsonl'):
+        return JsonResponse({'error': 'Se esperaba Content-Type application/x-ndjson'}, status=415)
+    clave = request.headers.get('Idempotency-Key') or None
+    if clave and len(clave) > 255:
+        return JsonResponse({'error': 'Idempotency-Key supera 255 caracteres'}, status=400)
+
+    archivo, reservado = reservar_archivo(
+        request.user, clave,
+        nombre_archivo=(request.GET.get('nombre') or 'carga.ndjson')[:255],
+        tipo_archivo='NDJSON',
+        tamano=int(request.META.get('CONTENT_LENGTH') or 0) or None,
+    )
+    if not reservado:
+        if archivo.estado_proceso == 'PENDIENTE':
+            return JsonResponse({'error': 'Ya hay una carga en curso con esta Idempotency-Key'}, status=409)
+        if archivo.hash_cuerpo and hash_cuerpo(request) != archivo.hash_cuerpo:
+            return JsonResponse({'error': 'La Idempotency-Key ya se usó con otro cuerpo'}, status=422)
+        respuesta = _respuesta_carga(archivo)
+        respuesta['Idempotent-Replayed'] = 'true'
+        return respuesta
+
+    ip_origen = request.META.get('REMOTE_ADDR')
+    try:
+        # HttpRequest se lee como archivo: nunca se materializa request.body
+        resumen = cargar_ndjson(
+            request, request.user, ip_origen, request.GET.get('sobrescribir') in ('1', 'true'),
+            al_procesar_lote=lambda linea, resumen, hash_hasta: registrar_avance(archivo, linea, resumen, hash_hasta),
+            avance=avance_archivo(archivo),
+        )
+    except Exception as e:
+        finalizar_archivo(archivo, error=str(e))
+        raise
+    if resumen is None:
+        finalizar_archivo(archivo, error='El reintento no coincide con el cuerpo ya procesado')
+        return JsonResponse({'error': 'La Idempotency-Key ya se usó con otro cuerpo'}, status=422)
+    finalizar_archivo(archivo, resumen)
+    if archivo.registros_procesados:
+        anomalias.programar()
+
+    registrar_auditoria(
+        accion='CARGA_MASIVA',
+        usuario_responsable=request.user,
+        detalle=(f'Carga NDJSON {archivo.id_archivo}: {resumen["creados"]} creados, '
+                 f'{resumen["actualizados"]} actualizados, {resumen["errores"]} errores'),
+        ip_origen=ip_origen,
+    )
+    return _respuesta_carga(archivo)
+
+@require_POST
+@api_solo_lectura_required
+def api_consultar_factores(request):
+    """API JSON: factores de las calificaciones que coinciden con una lista de claves.
+
+    El cuerpo es una lista de {"instrumento", "ejercicio"[, "secuencia_evento"]} (o
+    [instrumento, ejercicio, secuencia_evento]). La respuesta se entrega en streaming;
+    cada resultado trae el `indice` de la clave que lo encontró.
+    """
+    try:
+        items = json.load(request)
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    if not isinstance(items, list):
+        return JsonResponse({'error': 'Se esperaba una lista de claves'}, status=400)
+    maximo = getattr(settings, 'API_MAX_CLAVES_FACTORES', 5000)
+    if len(items) > maximo:
+        return JsonResponse({'error': f'Máximo {maximo} claves por petición'}, status=413)
+    claves = validar_claves(items)
+    if isinstance(claves, str):
+        return JsonResponse({'error': claves}, status=400)
+    return _respuesta_resultados(buscar_factores(claves, request.user), len(claves))
+
+def _respuesta_resultados(resultados, total):
+    """JSON en streaming: {"resultados": [...], "sin_resultados": [índices sin coincidencias]}"""
+    def contenido():
+        encontradas = set()
+        yield '{"resultados": ['
+        for numero, resultado in enumerate(resultados):
+            encontradas.add(resultado['indice'])
+            yield (',' if numero else '') + json.dumps(resultado, ensure_ascii=False)
+        sin_resultados = [indice for indice in range(total) if indice not in encontradas]
+        yield f'], "sin_resultados": {json.dumps(sin_resultados)}}}'
+
+    return StreamingHttpResponse(contenido(), content_type='application/json')
+
+@require_http_methods(['GET', 'POST'])
+@api_solo_lectura_required
+def api_factores_vigentes(request):
+    """API JSON: calificación vigente (último evento con fecha_pago <= fecha) por instrumento.
+
+    GET ?instrumento=X&fecha=AAAA-MM-DD para uno; POST con una lista de
+    {"instrumento", "fecha"} (o [instrumento, fecha]) para una cartera completa.
+    """
+    if request.method == 'GET':
+        items = [{'instrumento': request.GET.get('instrumento'), 'fecha': request.GET.get('fecha')}]
+    else:
+        try:
+            items = json.load(request)
+        except (ValueError, UnicodeDecodeError):
+            return JsonResponse({'error': 'JSON inválido'}, status=400)
+        if not isinstance(items, list):
+            return JsonResponse({'error': 'Se esperaba una lista de consultas'}, status=400)
+    maximo = getattr(settings, 'API_MAX_CLAVES_FACTORES', 5000)
+    if len(items) > maximo:
+        return JsonResponse({'error': f'Máximo {maximo} consultas por petición'}, status=413)
+    consultas = validar_consultas_vigentes(items)
+    if isinstance(consultas, str):
+        return JsonResponse({'error': consultas}, status=400)
+    return _respuesta_resultados(buscar_vigentes(consultas, request.user), len(consultas))
+
+@require_http_methods(['GET'])
+@api_solo_lectura_required
+def api_estadisticas_factores(request):
+    """API JSON: conteo, suma, mínimo, máximo, media y desviación por factor.
+
+    Filtros opcionales ?ejercicio=&mercado=&instrumento=. Se calcula sobre la
+    matriz de factores en memoria (ver matriz_factores.py), sin recorrer modelos.
+    """
+    ejercicio = request.GET.get('ejercicio')
+    if ejercicio is not None and not ejercicio.isdigit():
+        return JsonResponse({'error': 'ejercicio debe ser entero'}, status=400)
+    matriz = matriz_factores.obtener()
+    mascara = matriz.filtrar(
+        ejercicio=int(ejercicio) if ejercicio else None,
+        mercado=request.GET.get('mercado') or None,
+        instrumento=request.GET.get('instrumento') or None,
+        origen='Corredor' if request.user.rol == 'Corredor' else None,
+    )
+    return JsonResponse({
+        'calificaciones': int(mascara.sum()),
+        'factores': matriz_factores.estadisticas(matriz, mascara),
+    })
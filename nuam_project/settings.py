@@ -4,6 +4,8 @@ Django settings for nuam_project project.
 
 import environs
 import os
+import sys
+from django.core.exceptions import ImproperlyConfigured
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 AUTH_USER_MODEL = 'calificaciones.Usuario'
+AUTHENTICATION_BACKENDS = ['calificaciones.backends.CorreoBackend']
 
 # Para el admin
 LOGIN_URL = '/login/'
@@ -56,13 +59,15 @@ OTP_TOTP_ISSUER = "NUAM Calificaciones"  # Nombre que aparecerá en Google Authe
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'calificaciones.middleware.MetricasMiddleware',
+    'calificaciones.middleware.PerfilamientoMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     
     # MFA Middleware
-    'django_otp.middleware.OTPMiddleware',
+    'calificaciones.middleware.VerificacionMFAMiddleware',
     
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -70,9 +75,92 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'nuam_project.urls'
 
+# Perfilamiento de peticiones (reporte en /rendimiento/, solo Administrador)
+PERFILAMIENTO_TASA_MUESTREO = env.float('PERFILAMIENTO_TASA_MUESTREO', 0.1)  # 0 desactiva, 1 = todas
+PERFILAMIENTO_MAX_MUESTRAS = env.int('PERFILAMIENTO_MAX_MUESTRAS', 1000)
+PERFILAMIENTO_SQL_POR_MUESTRA = 5
+
+# Métricas Prometheus en /metrics (archivos compartidos entre workers de gunicorn)
+METRICAS_DIR = env.str('METRICAS_DIR', str(BASE_DIR / 'metricas'))
+if sys.argv[1:2] == ['test']:
+    # Las pruebas no escriben en el directorio real; MetricasTests usa uno temporal
+    METRICAS_DIR = ''
+METRICAS_INTERVALO_VOLCADO = 1.0  # segundos
+METRICAS_TOKEN = env.str('METRICAS_TOKEN', '')  # exige "Authorization: Bearer <token>"; vacío, solo usuarios staff
+
+# Auditoría: escritura en segundo plano por lotes (ver calificaciones/auditoria.py)
+AUDITORIA_ASINCRONA = env.bool('AUDITORIA_ASINCRONA', True)
+AUDITORIA_TAMANO_LOTE = 100
+AUDITORIA_INTERVALO_VOLCADO = 0.5  # segundos
+AUDITORIA_MAX_COLA = 10000
+AUDITORIA_ACCIONES_CRITICAS = ['LOCK_ACCOUNT', 'MFA_DISABLE', 'DELETE']  # siempre síncronas
+
+# Archivo de auditoría: python manage.py archivar_auditoria
+AUDITORIA_ARCHIVO_DIR = env.str('AUDITORIA_ARCHIVO_DIR', str(BASE_DIR / 'archivo_auditoria'))
+AUDITORIA_HORIZONTE_DIAS = env.int('AUDITORIA_HORIZONTE_DIAS', 365)
+AUDITORIA_TAMANO_BORRADO = 1000
+
+# Cache: contadores de login fallidos. LocMem es por proceso; con varios
+# workers usar un backend compartido (memcached/redis) vía CACHE_BACKEND/CACHE_LOCATION
+CACHES = {
+    'default': {
+        'BACKEND': env.str('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env.str('CACHE_LOCATION', 'nuam'),
+    }
+}
+
+# Bloqueo por intentos fallidos (ver calificaciones/bloqueo.py); con LocMemCache los contadores van a la base
+LOGIN_VENTANA_SEGUNDOS = 900
+LOGIN_MINUTOS_BLOQUEO = 15
+LOGIN_MAX_INTENTOS_IP = env.int('LOGIN_MAX_INTENTOS_IP', 20)
+
+# Borradores del asistente de calificaciones (ver calificaciones/borradores.py)
+BORRADOR_HORAS = 24
+
+# API JSON de calificaciones (ver calificaciones/carga_lotes.py)
+API_MAX_CALIFICACIONES = 5000
+API_MAX_BYTES = 20 * 1024 * 1024
+API_MAX_CLAVES_FACTORES = 5000
+# Carga NDJSON: calificaciones por transacción y tamaño máximo de una línea
+NDJSON_TAMANO_LOTE = 500
+NDJSON_MAX_LINEA = 1024 * 1024
+# Segundos sin avance tras los que una carga PENDIENTE se considera abandonada y se puede reintentar
+CARGA_RESERVA_SEGUNDOS = 600
+# Tokens de API: segundos que se cachea cada token resuelto (ver calificaciones/tokens_api.py)
+TOKEN_API_CACHE_SEGUNDOS = 60
+# Con un cache por proceso (LocMemCache) la revocación no llega a los demás workers hasta que vence la entrada
+TOKEN_API_CACHE_SEGUNDOS_LOCAL = 5
+
+# Matriz de factores en memoria (ver calificaciones/matriz_factores.py)
+MATRIZ_FACTORES_REFRESCO_SEGUNDOS = 30
+MATRIZ_FACTORES_RECONSTRUIR_SEGUNDOS = 3600
+MATRIZ_FACTORES_MARGEN_SEGUNDOS = 300  # relectura hacia atrás para transacciones que confirman tarde
+
+# Escáner de integridad de factores (ver calificaciones/integridad.py)
+INTEGRIDAD_TAMANO_LOTE = 5000
+INTEGRIDAD_MARGEN_SEGUNDOS = 300  # relectura hacia atrás para transacciones que confirman tarde
+
+# Detección de anomalías de factores (ver calificaciones/anomalias.py)
+ANOMALIAS_TRAS_CARGA = env.bool('ANOMALIAS_TRAS_CARGA', True)  # correrla en segundo plano tras cada carga
+ANOMALIAS_UMBRAL_MAD = 3.5  # z robusto
+ANOMALIAS_MINIMO_GRUPO = 20  # valores por mercado/ejercicio para evaluar un factor
+ANOMALIAS_DISTANCIA_MAXIMA = 1.0  # distancia L1 al ejercicio anterior
+
+# Estado MFA y dispositivo verificado en cache (ver calificaciones/estado_mfa.py)
+MFA_CACHE_SEGUNDOS = 300
+
+# Limitador de tasa por IP y cuenta (ver calificaciones/limite_tasa.py)
+LIMITE_TASA_ACTIVO = env.bool('LIMITE_TASA_ACTIVO', True)
+LIMITE_TASA = {
+    # endpoint: (capacidad, tokens por minuto)
+    'login': (10, 5),
+    'mfa_verify': (5, 3),
+    'password_reset': (3, 1),
+}
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'calificaciones.perfilamiento.DjangoTemplatesPerfilados',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -87,18 +175,6 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'nuam_project.wsgi.application'
 
-# POSTGRESQL DB --- IGNORE ---
-#DATABASES = {
-    #'default': {
-        #'ENGINE': 'django.db.backends.postgresql',
-        #'NAME': 'postgres',                    
-        #'USER': 'postgres',                  
-        #'PASSWORD': env('PASSWORD'),          
-        #'HOST': 'localhost',                  
-        #'PORT': '5432',                       
-    #}
-#}
-
 #ORACLE DB --- IGNORE ---
 #DATABASES = {
     #'default': {
@@ -111,12 +187,48 @@ WSGI_APPLICATION = 'nuam_project.wsgi.application'
     #}
 #}
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',   # o str(BASE_DIR / 'db.sqlite3') en caso de error
+# Base de datos según el entorno: DB_ENGINE=sqlite (por defecto) o postgresql.
+# Las conexiones se reutilizan entre peticiones durante DB_CONN_MAX_AGE segundos
+# (0 = una conexión nueva por petición) y se verifican antes de reutilizarlas.
+# DB_POOL=true usa el pool de conexiones de psycopg 3 (requiere psycopg[pool]);
+# el pool reemplaza a las conexiones persistentes, por eso fuerza CONN_MAX_AGE=0.
+# Medir con: python manage.py benchmark_conexiones
+DB_ENGINE = env.str('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = env.int('DB_CONN_MAX_AGE', 600)
+DB_CONN_HEALTH_CHECKS = env.bool('DB_CONN_HEALTH_CHECKS', True)
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': env.str('DB_NAME', 'postgres'),
+            'USER': env.str('DB_USER', 'postgres'),
+            'PASSWORD': env.str('DB_PASSWORD', env.str('PASSWORD', '')),
+            'HOST': env.str('DB_HOST', 'localhost'),
+            'PORT': env.str('DB_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+            'OPTIONS': {},
+        }
     }
-}
+    if env.bool('DB_POOL', False):
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': env.int('DB_POOL_MIN', 2),
+            'max_size': env.int('DB_POOL_MAX', 10),
+            'timeout': env.int('DB_POOL_TIMEOUT', 10),  # segundos esperando una conexión libre
+        }
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': env.str('DB_NAME', str(BASE_DIR / 'db.sqlite3')),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': DB_CONN_HEALTH_CHECKS,
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"DB_ENGINE debe ser 'sqlite' o 'postgresql', no {DB_ENGINE!r}")
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [